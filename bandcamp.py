@@ -19,22 +19,55 @@
 __author__ = 'eric@hardlycode.com'
 __version__ = '0.0.1'
 
+import atexit
+import BaseHTTPServer
 import base64
 import calendar
+import collections
 import datetime
+import errno
 import httplib
+import math
+import mmap
 import os
+import Queue
+import optparse
 import rfc822
+import socket
+import SocketServer
+import struct
 import sys
 import tempfile
 import textwrap
+import threading
 import time
 import calendar
 import urllib
 import urllib2
 import urlparse
-import gzip
-import StringIO
+import csv
+import weakref
+import cStringIO
+import zlib
+
+try:
+  import fcntl
+except ImportError:
+  # Windows
+  fcntl = None
+
+try:
+  import bz2
+except ImportError:
+  bz2 = None
+
+try:
+  import lzma
+except ImportError:
+  try:
+    from backports import lzma
+  except ImportError:
+    lzma = None
 
 try:
   # Python >= 2.6
@@ -57,15 +90,21 @@ except ImportError:
   from cgi import parse_qsl, parse_qs
 
 try:
-  from hashlib import md5
+  from hashlib import md5, sha1
 except ImportError:
   from md5 import md5
+  from sha import sha as sha1
 
 import oauth2 as oauth
 
 # A singleton representing a lazily instantiated FileCache.
 DEFAULT_CACHE = object()
 
+# Request priorities, from most to least urgent.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2
+
 class BandcampError(Exception):
   '''Base class for Bandcamp errors'''
 
@@ -74,6 +113,45 @@ class BandcampError(Exception):
     '''Returns the first argument used to construct this error.'''
     return self.args[0]
 
+class BandcampTimeoutError(BandcampError):
+  '''Raised when a request times out or its deadline runs out'''
+
+class Deadline(object):
+	'''A point in time by which a call, or a group of calls, must finish.
+	
+	Pass the same Deadline to several calls to give them one overall
+	budget.  Anywhere a deadline is accepted, a number of seconds from now
+	works too.
+	
+	Example usage:
+	
+		  >>> deadline = bandcamp.Deadline(2.0)
+		  >>> albums = api.GetDiscography(band_id, deadline=deadline)
+		  >>> albums = [api.GetAlbum(x.id, deadline=deadline) for x in albums]
+	'''
+	
+	def __init__(self, seconds):
+		'''Instantiate a new bandcamp.Deadline.
+		
+		Args:
+			seconds:
+				The budget, in seconds from now.
+		'''
+		self.expires_at = time.time() + seconds
+		
+	def Remaining(self):
+		'''Return the seconds left, which is negative once expired.'''
+		return self.expires_at - time.time()
+		
+	def Expired(self):
+		return self.Remaining() <= 0
+
+def _AsDeadline(deadline):
+	'''Turn a deadline argument, a Deadline or seconds, into a Deadline.'''
+	if deadline is None or isinstance(deadline, Deadline):
+		return deadline
+	return Deadline(deadline)
+
 class Band(object):
 	'''A class representing the Band structure used by the bandcamp API.
 	
@@ -84,6 +162,15 @@ class Band(object):
 	band.url
 	band.id
 	'''
+	
+	EXPORT_TYPE = 'band'
+	FIELDS = ('name', 'subdomain', 'url', 'id')
+	_JSON_KEYS = {'id': 'band_id'}
+	_INTERNED_FIELDS = ('_subdomain', '_url')
+	
+	# Defaults for properties left out of a projection
+	_name = _subdomain = _url = _id = None
+	
 	def __init__(self,
 				name=None,
 				subdomain=None,
@@ -180,14 +267,18 @@ class Band(object):
 		return data
 
 	@staticmethod
-	def NewFromJsonDict(data):
+	def NewFromJsonDict(data, fields=None):
 	  '''Create a new instance based on a JSON dict.
 
 	  Args:
 	    data: A JSON dict, as converted from the JSON in the bandcamp API
+	    fields: The names of the properties to fill in, from Band.FIELDS.
+	      The rest are left None. [Optional]
 	  Returns:
 	    A bandcamp.Band instance
 	  '''
+	  if fields is not None:
+	    return _NewProjected(Band, data, fields)
 	  return Band(name=data.get('name', None),
 	                subdomain=data.get('subdomain', None),
 	                url=data.get('url', None),
@@ -210,7 +301,19 @@ class Album(object):
 	album.small_art_url
 	album.large_art_url
 	album.artist
-	'''	
+	'''
+	
+	EXPORT_TYPE = 'album'
+	FIELDS = ('id', 'band_id', 'title', 'release_date', 'downloadable', 'url',
+			  'tracks', 'about', 'credits', 'small_art_url', 'large_art_url',
+			  'artist')
+	_JSON_KEYS = {'id': 'album_id'}
+	_INTERNED_FIELDS = ('_band_id', '_release_date', '_artist')
+	
+	# Defaults for properties left out of a projection
+	_id = _band_id = _title = _release_date = _downloadable = _url = None
+	_tracks = _about = _credits = _small_art_url = _large_art_url = _artist = None
+	
 	def __init__(self,
 				id=None,
 				band_id=None,
@@ -317,6 +420,7 @@ class Album(object):
 		
 	def _SetAbout(self, about):
 		'''Set the about info for this album.'''
+		self._about = about
 		
 	about = property(GetAbout, _SetAbout, doc='The about info for this album.')
 	
@@ -341,12 +445,12 @@ class Album(object):
 	small_art_url = property(GetSmallArtUrl, _SetSmallArtUrl, doc='The small album art url. Image size: 100x100')
 
 	def GetLargeArtUrl(self):
-		'''Get the small album art.  350x350'''
-		return self.large_art_url
+		'''Get the large album art.  350x350'''
+		return self._large_art_url
 		
 	def _SetLargeArtUrl(self, large_art_url):
-		'''Set the small album art for this album.'''
-		self.large_art_url = large_art_url
+		'''Set the large album art for this album.'''
+		self._large_art_url = large_art_url
 		
 	large_art_url = property(GetLargeArtUrl, _SetLargeArtUrl, doc='The large album art url. Image size: 350x350')
 	
@@ -390,7 +494,7 @@ class Album(object):
 		if self.url:
 			data['url'] = self.url
 		if self.tracks:
-			data['tracks'] = self.tracks
+			data['tracks'] = [x.AsDict() for x in self.tracks]
 		if self.about:
 			data['about'] = self.about
 		if self.credits:
@@ -405,16 +509,27 @@ class Album(object):
 		return data
 
 	@staticmethod
-	def NewFromJsonDict(data):
+	def NewFromJsonDict(data, fields=None):
 		'''Create a new instance based on a JSON dict.
 
 		Args:
 		  data: A JSON dict, as converted from the JSON in the bandcamp API
+		  fields: The names of the properties to fill in, from Album.FIELDS.
+		    The rest are left None.  Tracks get the same projection. [Optional]
 		Returns:
 		  A bandcamp.Album instance
 		'''
-		# need to convert json tracks to tracks
-		tracks = [Track.NewFromJsonDict(x) for x in data['tracks']]
+		if fields is not None:
+			album = _NewProjected(Album, data, fields)
+			if 'tracks' in fields and 'tracks' in data:
+				album._tracks = [Track.NewFromJsonDict(x, fields) for x in data['tracks']]
+			return album
+		
+		# need to convert json tracks to tracks.  Discography entries don't
+		# list them, so leave those as None rather than an empty album.
+		tracks = None
+		if 'tracks' in data:
+			tracks = [Track.NewFromJsonDict(x, fields) for x in data['tracks']]
 	
 		return Album(id=data.get("album_id", None),
 					band_id=data.get("band_id", None),
@@ -448,6 +563,16 @@ class Track(object):
 	track.lyrics
 	'''
 	
+	EXPORT_TYPE = 'track'
+	FIELDS = ('id', 'album_id', 'band_id', 'number', 'title', 'about', 'credits',
+			  'streaming_url', 'duration', 'downloadable', 'url', 'lyrics')
+	_JSON_KEYS = {'id': 'track_id'}
+	_INTERNED_FIELDS = ('_album_id', '_band_id')
+	
+	# Defaults for properties left out of a projection
+	_id = _album_id = _band_id = _number = _title = _about = _credits = None
+	_streaming_url = _duration = _downloadable = _url = _lyrics = None
+	
 	def __init__(self,
 				id=None,
 				album_id=None,
@@ -480,6 +605,7 @@ class Track(object):
 		
 	def _SetId(self, id):
 		'''Set the unique id of this track.'''
+		self._id = id
 	
 	id = property(GetId, _SetId, doc='The unique id of this track.')
 	
@@ -530,6 +656,7 @@ class Track(object):
 		
 	def _SetAbout(self, about):
 		'''Set the about info for this track.'''
+		self._about = about
 		
 	about = property(GetAbout, _SetAbout, doc='The about info for this track.')
 
@@ -638,14 +765,18 @@ class Track(object):
 		return data
 
 	@staticmethod
-	def NewFromJsonDict(data):
+	def NewFromJsonDict(data, fields=None):
 		'''Create a new instance based on a JSON dict.
 
 		Args:
 		  data: A JSON dict, as converted from the JSON in the bandcamp API
+		  fields: The names of the properties to fill in, from Track.FIELDS.
+		    The rest are left None. [Optional]
 		Returns:
 		  A bandcamp.Track instance
 		'''
+		if fields is not None:
+			return _NewProjected(Track, data, fields)
 		
 		return Track(id=data.get("track_id", None),
 					album_id=data.get("album_id", None),
@@ -660,453 +791,4472 @@ class Track(object):
 					url=data.get("url", None),
 					lyrics=data.get("lyrics", None))	
 						
-class Api(object):
-	'''A python interface into the Bandcamp API.
+def _NewProjected(model, data, fields):
+	'''Build a model instance holding only the given properties.
 	
-	By default, the Api caches results for 1 minute.
+	The constructor is skipped, so properties outside fields cost neither
+	a setter call nor a slot in the instance dict; they read as the None
+	defaults on the class.
+	'''
+	instance = model.__new__(model)
+	attributes = instance.__dict__
+	for name in fields:
+		if name == 'tracks':
+			continue
+		key = model._JSON_KEYS.get(name, name)
+		if key in data:
+			attributes['_' + name] = data[key]
+	return instance
+
+def _CheckFields(fields, *models):
+	'''Validate a fields argument against the FIELDS of some models.'''
+	if fields is None:
+		return None
+	fields = frozenset(fields)
+	known = set()
+	for model in models:
+		known.update(model.FIELDS)
+	unknown = fields.difference(known)
+	if unknown:
+		raise BandcampError('Unknown fields: %s' % ', '.join(sorted(unknown)))
+	return fields
+
+# The fixed column schema used by ExportCsv.  Columns a model doesn't have
+# are left empty, so bands, albums and tracks can share one file.
+EXPORT_COLUMNS = ('type',
+				  'id',
+				  'band_id',
+				  'album_id',
+				  'number',
+				  'name',
+				  'subdomain',
+				  'title',
+				  'artist',
+				  'release_date',
+				  'duration',
+				  'downloadable',
+				  'url',
+				  'streaming_url',
+				  'small_art_url',
+				  'large_art_url',
+				  'about',
+				  'credits',
+				  'lyrics')
+
+DEFAULT_EXPORT_CHUNK_SIZE = 1000 # rows buffered between writes
+
+def ExportNdjson(models,
+				 output,
+				 compression=None,
+				 compression_level=6,
+				 chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+	'''Write bandcamp models as newline-delimited JSON.
 	
-	Example usage:
+	Models are consumed one at a time and written out every chunk_size rows,
+	so any iterator (a discography, a crawl) can be exported in constant
+	memory.  Each line is the model's AsDict() with an extra 'type' key.
 	
-		To create an instance of the bandcamp.Api class:
+	Args:
+		models:
+			An iterable of bandcamp.Band, bandcamp.Album and bandcamp.Track
+			instances.
+		output:
+			A filename or a file-like object opened for binary writing.
+		compression:
+			'gzip', 'bz2' or 'lzma' to compress the output. [Optional]
+		compression_level:
+			The level passed to the compressor. [Optional]
+		chunk_size:
+			The number of rows to buffer between writes. [Optional]
+			
+	Returns:
+		The number of rows written.
+	'''
+	# One encoder for the whole export, and no sort_keys like AsJsonString
+	encode = simplejson.JSONEncoder(separators=(',', ':')).encode
+	
+	def Rows():
+		for model in models:
+			data = model.AsDict()
+			data['type'] = model.EXPORT_TYPE
+			yield encode(data) + '\n'
+	
+	return _WriteExport(Rows(), output, compression, compression_level, chunk_size)
+
+def ExportCsv(models,
+			  output,
+			  columns=EXPORT_COLUMNS,
+			  header=True,
+			  compression=None,
+			  compression_level=6,
+			  chunk_size=DEFAULT_EXPORT_CHUNK_SIZE):
+	'''Write bandcamp models as CSV with a fixed column schema.
+	
+	Models are consumed one at a time and written out every chunk_size rows,
+	so any iterator (a discography, a crawl) can be exported in constant
+	memory.  Album tracks are not flattened; export them as their own rows.
+	
+	Args:
+		models:
+			An iterable of bandcamp.Band, bandcamp.Album and bandcamp.Track
+			instances.
+		output:
+			A filename or a file-like object opened for binary writing.
+		columns:
+			The columns to write, from EXPORT_COLUMNS. [Optional]
+		header:
+			Whether to write a header row. [Optional]
+		compression:
+			'gzip', 'bz2' or 'lzma' to compress the output. [Optional]
+		compression_level:
+			The level passed to the compressor. [Optional]
+		chunk_size:
+			The number of rows to buffer between writes. [Optional]
+			
+	Returns:
+		The number of rows written, not counting the header.
+	'''
+	for column in columns:
+		if column not in EXPORT_COLUMNS:
+			raise BandcampError('Unknown export column: %s' % column)
+	
+	buffer = cStringIO.StringIO()
+	writer = csv.writer(buffer)
+	
+	def Cell(value):
+		if value is None:
+			return ''
+		if isinstance(value, unicode):
+			return value.encode('utf-8')
+		return value
+	
+	def Row(values):
+		writer.writerow(values)
+		row = buffer.getvalue()
+		buffer.seek(0)
+		buffer.truncate()
+		return row
+	
+	def Rows():
+		for model in models:
+			yield Row([Cell(model.EXPORT_TYPE if column == 'type'
+							else getattr(model, column, None))
+					   for column in columns])
+	
+	return _WriteExport(Rows(), output, compression, compression_level, chunk_size,
+						header=header and Row(columns) or None)
+
+def _WriteExport(rows, output, compression, compression_level, chunk_size,
+				 header=None):
+	'''Write an iterable of encoded rows to output in chunks.
+	
+	An encoded header row, if given, is written first and not counted.
+	'''
+	if isinstance(output, basestring):
+		raw_fp = open(output, 'wb')
+	else:
+		raw_fp = output
+	
+	if compression:
+		fp = _CompressedWriter(raw_fp, compression, compression_level)
+	else:
+		fp = raw_fp
+	
+	count = 0
+	chunk = header and [header] or []
+	try:
+		for row in rows:
+			chunk.append(row)
+			count += 1
+			if len(chunk) >= chunk_size:
+				fp.write(''.join(chunk))
+				chunk = []
+		if chunk:
+			fp.write(''.join(chunk))
+	finally:
+		if compression:
+			fp.finish()
+		if raw_fp is not output:
+			raw_fp.close()
+	return count
+
+class _CompressedWriter(object):
+	'''Wraps a file-like object, compressing everything written to it.'''
+	
+	def __init__(self, fp, compression, compression_level):
+		self._fp = fp
+		if compression == 'gzip':
+			# 16 + MAX_WBITS tells zlib to write a gzip header and trailer
+			self._compressor = zlib.compressobj(compression_level, zlib.DEFLATED,
+												16 + zlib.MAX_WBITS)
+		elif compression in ('bz2', 'lzma') and compression in CACHE_CODECS:
+			self._compressor = CACHE_CODECS[compression].Compressor(compression_level)
+		else:
+			raise BandcampError('Unsupported export compression: %s' % compression)
 		
-		  >>> import bandcamp
-		  >>> api = bandcamp.Api(key)
+	def write(self, data):
+		self._fp.write(self._compressor.compress(data))
 		
-		To fetch a band:
+	def finish(self):
+		'''Flush the compressor, leaving the wrapped file open.'''
+		self._fp.write(self._compressor.flush())
 		
-		  >>> band = api.GetBand(band_id)
-		  >>> print band
+def _GetRequestKey(endpoint, parameters):
+	'''Return a stable string naming a request, leaving out the developer key.'''
+	items = [(k, unicode(v).encode('utf-8')) for k, v in (parameters or {}).items()
+			 if v is not None and k != 'key']
+	items.sort()
+	return endpoint + '?' + urllib.urlencode(items)
 
+class SnapshotWriter(object):
+	'''Builds a snapshot file that a bandcamp.Api can be served from offline.
+	
+	Responses are streamed to disk as they are added; only the index is
+	kept in memory until Close() writes it out.
+	
+	Example usage:
+	
+		  >>> writer = bandcamp.SnapshotWriter('catalog.snapshot')
+		  >>> api.SetRecorder(writer)
+		  >>> ... run the crawl ...
+		  >>> writer.Close()
+		  
+		  >>> offline = bandcamp.Api(snapshot='catalog.snapshot')
+	'''
+	
+	def __init__(self, path, compression=None, compression_level=6):
+		'''Instantiate a new bandcamp.SnapshotWriter.
+		
+		Args:
+			path:
+				The filename to write the snapshot to.  It only appears
+				there, complete, once Close() is called.
+			compression:
+				The codec to compress each response with, as for
+				bandcamp._FileCache. [Optional]
+			compression_level:
+				The level passed to the codec. [Optional]
+		'''
+		if compression is not None and compression not in CACHE_CODECS:
+			raise BandcampError('Unsupported snapshot compression: %s' % compression)
+		self._path = path
+		self._codec = compression and CACHE_CODECS[compression]
+		self._compression_level = compression_level
+		temp_fd, self._temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+		self._fp = os.fdopen(temp_fd, 'wb')
+		self._fp.write(struct.pack(Snapshot._HEADER_FORMAT, Snapshot.MAGIC, 0, 0))
+		self._offset = struct.calcsize(Snapshot._HEADER_FORMAT)
+		self._index = {}
+		self._lock = threading.Lock()
+		
+	def Add(self, endpoint, parameters, body):
+		'''Add the response body for a request, replacing any earlier one.'''
+		self._AddEntry(_GetRequestKey(endpoint, parameters), body)
+		
+	def AddResolution(self, band_host, band_id):
+		'''Record which band id a normalized band host resolves to.'''
+		self._AddEntry('resolve:%s' % band_host.encode('utf-8'), simplejson.dumps(band_id))
+		
+	def Close(self):
+		'''Write the index and move the finished snapshot into place.'''
+		self._lock.acquire()
+		try:
+			entries = [(md5(key).digest(), offset, length)
+					   for key, (offset, length) in self._index.iteritems()]
+			entries.sort()
+			index_offset = self._offset
+			for entry in entries:
+				self._fp.write(struct.pack(Snapshot._ENTRY_FORMAT, *entry))
+			self._fp.seek(0)
+			self._fp.write(struct.pack(Snapshot._HEADER_FORMAT, Snapshot.MAGIC,
+									   len(entries), index_offset))
+			self._fp.close()
+			_ReplaceFile(self._temp_path, self._path)
+		finally:
+			self._lock.release()
+			
+	def _AddEntry(self, key, body):
+		if self._codec:
+			compressor = self._codec.Compressor(self._compression_level)
+			body = CACHE_ENTRY_MAGIC + self._codec.id + compressor.compress(body) + compressor.flush()
+		self._lock.acquire()
+		try:
+			self._fp.write(body)
+			self._index[key] = (self._offset, len(body))
+			self._offset += len(body)
+		finally:
+			self._lock.release()
 
-	Included Methods:
-		api.GetBand(band_id, band_subdomain, band_url)
-		api.GetAlbum(album_id)
-		api.GetTrack(track_id)
+class Snapshot(object):
+	'''A read-only, memory-mapped snapshot written by bandcamp.SnapshotWriter.
+	
+	The file is a header, the response bodies, then an index of fixed-size
+	(md5 of request, offset, length) entries sorted by digest, so a lookup
+	is a binary search over the mapped index with no parsing up front.
 	'''
 	
-	DEFAULT_CACHE_TIMEOUT = 60 # cache for 1 minute
-	_API_REALM = 'Bandcamp API'
+	MAGIC = 'BCSNAP01'
+	_HEADER_FORMAT = '<8sIQ'
+	_ENTRY_FORMAT = '<16sQI'
 	
-	def __init__(self,
-				developer_key=None,
-				cache_timeout=DEFAULT_CACHE_TIMEOUT,
-				cache=DEFAULT_CACHE,
-				base_url=None,
-				debugHTTP=False):
-		'''Instantiate a new bandcamp.Api object.
+	def __init__(self, path):
+		'''Open a snapshot file.
 		
 		Args:
-			key:
-				Your Bandcamp developer key.
-			cache:
-				The cache instance to use.  Defaults to DEFAULT_CACHE.
-				Use None to disable caching. [Optional]
-			debugHTTP:
-				Set to True to enable deboug output from urllib2 when performing
-				any HTTP requests.  Defaults to False. [Optional]
-		
+			path:
+				The filename of the snapshot.
 		'''
-		self.SetCache(cache)
-		self._urllib			= urllib2
-		self._cache_timeout		= cache_timeout
-		self._debugHTTP			= debugHTTP
-		#self._InitializeUserAgent()
-		self._InitializeDefaultParameters()
-
-		if base_url is None:
-			self.base_url = 'https://api.bandcamp.com/api/'
-		else:
-			self.base_url = base_url
-
-		if developer_key is None:
-			raise BandcampError('Bandcamp requires a developer key for all API access. \
-							Please email support@bandcamp.com with your name and contact email to get access.')
-
-		self.SetCredentials(developer_key)
-
-	def SetCredentials(self,
-						developer_key=None):
-		'''Set the developer key for this instance
+		fp = open(path, 'rb')
+		try:
+			self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			fp.close()
+		magic, self._count, self._index_offset = struct.unpack_from(
+			Snapshot._HEADER_FORMAT, self._map, 0)
+		if magic != Snapshot.MAGIC:
+			raise BandcampError('%s is not a bandcamp snapshot' % path)
+		self._entry_size = struct.calcsize(Snapshot._ENTRY_FORMAT)
+		
+	def Get(self, endpoint, parameters):
+		'''Return the response body for a request, or None if it isn't there.'''
+		return self._GetEntry(_GetRequestKey(endpoint, parameters))
+		
+	def GetBandId(self, band_host):
+		'''Return the band id a normalized band host resolves to, or None.'''
+		data = self._GetEntry('resolve:%s' % band_host.encode('utf-8'))
+		if data is None:
+			return None
+		return simplejson.loads(data)
+		
+	def __len__(self):
+		return self._count
+		
+	def Close(self):
+		self._map.close()
+		
+	def _GetEntry(self, key):
+		digest = md5(key).digest()
+		low, high = 0, self._count
+		while low < high:
+			middle = (low + high) // 2
+			position = self._index_offset + middle * self._entry_size
+			if self._map[position:position + 16] < digest:
+				low = middle + 1
+			else:
+				high = middle
+		if low == self._count:
+			return None
+		found, offset, length = struct.unpack_from(
+			Snapshot._ENTRY_FORMAT, self._map,
+			self._index_offset + low * self._entry_size)
+		if found != digest:
+			return None
+		data = self._map[offset:offset + length]
+		if data.startswith(CACHE_ENTRY_MAGIC):
+			return CACHE_CODECS[data[len(CACHE_ENTRY_MAGIC)]].Decompress(
+				data[len(CACHE_ENTRY_MAGIC) + 1:])
+		return data
 
-	    Args:
-	      key:
-	        The developer key of the bancamp account.
-		'''
-		self._developer_key = developer_key
-		self._default_params['key'] = self._developer_key
+MEDIA_URLS = ('small_art_url', 'large_art_url', 'streaming_url')
 
-	def ClearCredentials(self):
-		'''Clear the any credentials for this instance.'''
-		self._developer_key = None
-		self._default_params['key'] = None
+class MediaDownloader(object):
+	'''Downloads album art and track streams into content-addressed storage.
+	
+	Files are stored under directory/objects by the sha1 of their
+	content, so the same image shared by several albums is only stored
+	once, and the url each came from is remembered so it is not fetched
+	again.  Downloads run in parallel, reuse one HTTP connection per host
+	per worker, and resume from a partial file left by an interrupted run
+	with a Range request.
+	
+	Example usage:
+	
+		  >>> downloader = bandcamp.MediaDownloader('/tmp/media')
+		  >>> paths = downloader.Download(api.GetDiscography(band_url='...'))
+		  >>> print downloader.GetStats()
+	'''
+	
+	DEFAULT_MAX_WORKERS = 4
+	MAX_REDIRECTS = 5
+	_CHUNK_SIZE = 64 * 1024
+	
+	def __init__(self,
+				directory,
+				max_workers=DEFAULT_MAX_WORKERS,
+				timeout=None,
+				user_agent=None):
+		'''Instantiate a new bandcamp.MediaDownloader.
 		
-	def GetBand(self,
-				band_id=None,
-				band_subdomain=None,
-				band_url=None):
-		'''Fetch the bandcamp.Band for the given band_id.
+		Args:
+			directory:
+				The directory to store files under.
+			max_workers:
+				The most downloads to run at once. [Optional]
+			timeout:
+				The socket timeout, in seconds, for each connection. [Optional]
+			user_agent:
+				The User-Agent header to send. [Optional]
+		'''
+		self._directory = directory
+		self._max_workers = max_workers
+		self._timeout = timeout
+		self._user_agent = user_agent
+		# (scheme, netloc) -> idle kept-alive connections
+		self._connections = {}
+		self._lock = threading.Lock()
+		self._stats = {'files': 0, 'cached': 0, 'duplicates': 0, 'errors': 0,
+					   'bytes_downloaded': 0, 'bytes_resumed': 0,
+					   'bytes_deduplicated': 0, 'seconds': 0.0}
+		for name in ('objects', 'urls', 'partial'):
+			path = os.path.join(directory, name)
+			if not os.path.exists(path):
+				try:
+					os.makedirs(path)
+				except OSError, e:
+					if e.errno != errno.EEXIST:
+						raise
+					
+	def Download(self, models, kinds=MEDIA_URLS):
+		'''Download the media referenced by bands, albums and tracks.
 		
-		Must provide one of the three arguments.
+		Albums contribute the media of their tracks as well.
 		
 		Args:
-			band_id:
-				The band id you want to fetch. [Optional]
-			band_subdomain:
-				The band subdomain you want to fetch. [Optional]
-			band_url:
-				The band url you want to fetch. [Optional]
+			models:
+				A bandcamp.Album or bandcamp.Track, or an iterable of them.
+			kinds:
+				The url properties to download. [Optional]
 				
 		Returns:
-			A bandcamp.Band instance
+			A dict mapping each url to the path of its local copy, or to the
+			error raised downloading it.
 		'''
+		urls = []
+		seen = set()
+		for url in self._IterUrls(models, kinds):
+			if url not in seen:
+				seen.add(url)
+				urls.append(url)
+		results = {}
+		def Fetch(url):
+			try:
+				results[url] = self.DownloadUrl(url)
+			except (BandcampError, EnvironmentError, httplib.HTTPException), e:
+				self._Count('errors')
+				results[url] = e
+		start = time.time()
+		_ParallelMap(Fetch, urls, self._max_workers)
+		self._Count('seconds', time.time() - start)
+		return results
 		
-		if band_id is None and band_subdomain is None and band_url is None:
-			raise BandcampError('GetBand requires at least one of the three arguments: band_id, band_subdomain, band_url.')
-			
-		parameters = {}
-		
-		if band_id:
-			parameters['band_id'] = band_id
-		elif band_subdomain:
-			parameters['band_url'] = band_subdomain
-		elif band_url:
-			parameters['band_url'] = band_url
-			
-		url = '%s/band/1/info' % self.base_url
-		json = self._FetchUrl(url, parameters=parameters)
-		data = simplejson.loads(json)
-		
-		return Band.NewFromJsonDict(data)
-	
-	def GetDiscography(self,
-						band_id=None,
-						band_subdomain=None,
-						band_url=None):
-		'''Fetch the '''
+	def DownloadUrl(self, url):
+		'''Download a single url, unless it is already stored.
 		
-		if band_id is None and band_subdomain is None and band_url is None:
-			raise BandcampError('GetDiscography requires at least one of the three arguments: band_id, band_subdomain, band_url.')
+		Returns:
+			The path of the local copy.
+		'''
+		path = self.GetPath(url)
+		if path:
+			self._Count('cached')
+			return path
+		partial_path = os.path.join(self._directory, 'partial', self._GetUrlKey(url))
+		digest, size = self._Fetch(url, partial_path)
+		path = self._GetObjectPath(digest)
+		if os.path.exists(path):
+			os.remove(partial_path)
+			self._Count('duplicates')
+			self._Count('bytes_deduplicated', size)
+		else:
+			directory = os.path.dirname(path)
+			if not os.path.exists(directory):
+				try:
+					os.makedirs(directory)
+				except OSError, e:
+					if e.errno != errno.EEXIST:
+						raise
+			_ReplaceFile(partial_path, path)
+		self._Count('files')
+		self._WriteUrlIndex(url, digest)
+		return path
 		
-		parameters = {}
+	def GetPath(self, url):
+		'''Return the path of a url's local copy, or None if it has none.'''
+		try:
+			fp = open(os.path.join(self._directory, 'urls', self._GetUrlKey(url)))
+		except IOError, e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		try:
+			path = self._GetObjectPath(fp.read().strip())
+		finally:
+			fp.close()
+		if os.path.exists(path):
+			return path
+		return None
 		
-		if band_id:
-			parameters['band_id'] = band_id
-		elif band_subdomain:
-			parameters['band_url'] = band_subdomain
-		elif band_url:
-			parameters['band_url'] = band_url
-			
-		url = '%s/band/1/discography' % self.base_url
-		json = self._FetchUrl(url, parameters=parameters)
-		data = simplejson.loads(json)
+	def GetStats(self):
+		'''Return download counts, bytes and throughput.
 		
-		self._CheckForBandcampError(data)
+		Files is the number of urls stored, cached the number found already
+		stored, and duplicates the number whose content was already stored
+		under another url; bytes_deduplicated counts the bytes those would
+		have taken.  Throughput is bytes_downloaded per second spent in
+		Download.
+		'''
+		self._lock.acquire()
+		try:
+			stats = dict(self._stats)
+		finally:
+			self._lock.release()
+		if stats['seconds']:
+			stats['throughput'] = stats['bytes_downloaded'] / stats['seconds']
+		else:
+			stats['throughput'] = 0.0
+		return stats
 		
-		results = []		
-		for x in data['discography']:
-			if x['track_id']:
-				results.append(Track.NewFromJsonDict(x))
-			if x['album_id']:
-				results.append(Album.NewFromJsonDict(x))
+	def Close(self):
+		'''Close the connections kept alive for reuse.'''
+		self._lock.acquire()
+		try:
+			connections = self._connections
+			self._connections = {}
+		finally:
+			self._lock.release()
+		for idle in connections.values():
+			for connection in idle:
+				connection.close()
 		
-		# Return built list of discography
-		return results
+	def _IterUrls(self, models, kinds):
+		if isinstance(models, (Band, Album, Track)):
+			models = [models]
+		for model in models:
+			for kind in kinds:
+				url = getattr(model, kind, None)
+				if url:
+					yield url
+			if isinstance(model, Album) and model.tracks:
+				for url in self._IterUrls(model.tracks, kinds):
+					yield url
 		
-	def GetAlbum(self, album_id):
-		'''Fetch the bandcamp.Album for the given album_id.
-
-		Args:
-			album_id:
-				The album id you want to fetch.
+	def _Fetch(self, url, partial_path):
+		'''Download url into partial_path, resuming what is already there.
 		
 		Returns:
-			A bandcamp.Album instance
+			A (sha1 hexdigest, size) tuple for the finished file.
 		'''
-		parameters = {}
-		parameters['album_id'] = album_id
+		digest = sha1()
+		offset = 0
+		if os.path.exists(partial_path):
+			fp = open(partial_path, 'rb')
+			try:
+				for chunk in iter(lambda: fp.read(MediaDownloader._CHUNK_SIZE), ''):
+					digest.update(chunk)
+					offset += len(chunk)
+			finally:
+				fp.close()
+		key, connection, response = self._Request(url, offset)
+		try:
+			if offset and response.status == 206:
+				self._Count('bytes_resumed', offset)
+				fp = open(partial_path, 'ab')
+			else:
+				digest = sha1()
+				offset = 0
+				fp = open(partial_path, 'wb')
+			try:
+				for chunk in iter(lambda: response.read(MediaDownloader._CHUNK_SIZE), ''):
+					fp.write(chunk)
+					digest.update(chunk)
+					offset += len(chunk)
+					self._Count('bytes_downloaded', len(chunk))
+			finally:
+				fp.close()
+		except:
+			connection.close()
+			raise
+		self._Release(key, connection, response)
+		return digest.hexdigest(), offset
+		
+	def _Request(self, url, offset):
+		'''GET url, following redirects, over a pooled connection.'''
+		for i in range(MediaDownloader.MAX_REDIRECTS + 1):
+			(scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+			if query:
+				path += '?' + query
+			headers = {}
+			if self._user_agent:
+				headers['User-Agent'] = self._user_agent
+			if offset:
+				headers['Range'] = 'bytes=%d-' % offset
+			key = (scheme, netloc)
+			connection, response = self._Send(key, path or '/', headers)
+			if response.status in (200, 206):
+				return key, connection, response
+			response.read()
+			self._Release(key, connection, response)
+			if response.status in (301, 302, 303, 307, 308):
+				location = response.getheader('location')
+				if not location:
+					raise BandcampError('Redirect without a location downloading %s' % url)
+				url = urlparse.urljoin(url, location)
+			elif response.status == 416 and offset:
+				# The partial file is already complete, or stale
+				offset = 0
+			else:
+				raise BandcampError('HTTP Error %d downloading %s' % (response.status, url))
+		raise BandcampError('Too many redirects downloading %s' % url)
+		
+	def _Send(self, key, path, headers):
+		'''Send a GET on an idle connection to key, or a new one.'''
+		self._lock.acquire()
+		try:
+			idle = self._connections.get(key)
+			connection = idle and idle.pop() or None
+		finally:
+			self._lock.release()
+		if connection:
+			try:
+				connection.request('GET', path, headers=headers)
+				return connection, connection.getresponse()
+			except (httplib.HTTPException, socket.error):
+				# The server closed it since; fall through to a new one
+				connection.close()
+		scheme, netloc = key
+		if scheme == 'https':
+			connection = httplib.HTTPSConnection(netloc, timeout=self._timeout)
+		else:
+			connection = httplib.HTTPConnection(netloc, timeout=self._timeout)
+		try:
+			connection.request('GET', path, headers=headers)
+			return connection, connection.getresponse()
+		except:
+			connection.close()
+			raise
 			
-		url = '%s/album/1/info' % self.base_url
-		json = self._FetchUrl(url, parameters=parameters)
-		data = simplejson.loads(json)
+	def _Release(self, key, connection, response):
+		'''Keep a connection whose response has been read for reuse.'''
+		if response.will_close:
+			connection.close()
+			return
+		self._lock.acquire()
+		try:
+			self._connections.setdefault(key, []).append(connection)
+		finally:
+			self._lock.release()
 		
-		self._CheckForBandcampError(data)
+	def _GetUrlKey(self, url):
+		return sha1(url).hexdigest()
 		
-		return Album.NewFromJsonDict(data)
+	def _GetObjectPath(self, digest):
+		return os.path.join(self._directory, 'objects', digest[:2], digest[2:])
 		
-	def GetTrack(self, track_id):
-		'''Fetch the bandcamp.Track for the given track_id.
+	def _WriteUrlIndex(self, url, digest):
+		path = os.path.join(self._directory, 'urls', self._GetUrlKey(url))
+		temp_fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+		os.write(temp_fd, digest)
+		os.close(temp_fd)
+		_ReplaceFile(temp_path, path)
+		
+	def _Count(self, name, amount=1):
+		self._lock.acquire()
+		try:
+			self._stats[name] += amount
+		finally:
+			self._lock.release()
+
+class CachePolicy(object):
+	'''Decides how long each cached API response stays fresh.
+	
+	Timeouts are looked up from the most to the least specific rule: a
+	timeout for one entity, then one for its endpoint, then the default.
+	
+	Example usage:
+	
+		Keep album and track info for a day, but discographies for an hour:
+		
+		  >>> policy = bandcamp.CachePolicy(jitter=0.1)
+		  >>> policy.SetEndpointTimeout('album/1/info', 24 * 60 * 60)
+		  >>> policy.SetEndpointTimeout('track/1/info', 24 * 60 * 60)
+		  >>> policy.SetEndpointTimeout('band/1/discography', 60 * 60)
+		  >>> api.SetCachePolicy(policy)
+	'''
+	
+	# Query parameters naming the entity an endpoint returns
+	_ENTITY_PARAMETERS = (('band', 'band_id'),
+						  ('album', 'album_id'),
+						  ('track', 'track_id'))
+	
+	def __init__(self,
+				default_timeout=None,
+				endpoint_timeouts=None,
+				jitter=0):
+		'''Instantiate a new bandcamp.CachePolicy.
 		
 		Args:
-			track_id:
-				The track id you want to fetch.
-				
-		Returns:
-			A bandcamp.Track instance
+			default_timeout:
+				Time, in seconds, for endpoints without their own timeout.
+				Defaults to None, which uses the Api's cache timeout. [Optional]
+			endpoint_timeouts:
+				A dict mapping endpoints, such as 'album/1/info', to their
+				timeout in seconds. [Optional]
+			jitter:
+				A fraction, such as 0.1, by which each timeout is spread up
+				or down so entries cached together don't all expire at
+				once.  The spread is fixed per request. [Optional]
 		'''
-		parameters = {}
-		parameters['track_id'] = track_id
-			
-		url = '%s/track/1/info' % self.base_url
-		json = self._FetchUrl(url, parameters=parameters)
-		data = simplejson.loads(json)
-		
-		self._CheckForBandcampError(data)
+		self._default_timeout = default_timeout
+		self._endpoint_timeouts = dict(endpoint_timeouts or {})
+		self._entity_timeouts = {}
+		self._jitter = jitter
 		
-		return Track.NewFromJsonDict(data)
-	
-	def SetCache(self, cache):
-		'''Override the default cache.  Set to None to prevent caching.
+	def SetEndpointTimeout(self, endpoint, timeout):
+		'''Set the timeout for every response from one endpoint.
 		
 		Args:
-			cache:
-				An instance that supports the same API as the bandcamp._FileCache
+			endpoint:
+				The endpoint path, such as 'band/1/discography'.
+			timeout:
+				Time, in seconds, that its responses should be reused.
 		'''
-		if cache == DEFAULT_CACHE:
+		self._endpoint_timeouts[endpoint] = timeout
+		
+	def SetEntityTimeout(self, entity_type, entity_id, timeout):
+		'''Set the timeout for every response about one band, album or track.
+		
+		Args:
+			entity_type:
+				One of 'band', 'album' or 'track'.
+			entity_id:
+				The id of the entity.
+			timeout:
+				Time, in seconds, that its responses should be reused.
+		'''
+		self._entity_timeouts[(entity_type, str(entity_id))] = timeout
+		
+	def GetTimeout(self, endpoint, parameters=None):
+		'''Return the timeout for a request, or None for the Api's default.
+		
+		Args:
+			endpoint:
+				The endpoint path, such as 'album/1/info'.
+			parameters:
+				The query parameters of the request. [Optional]
+		'''
+		timeout = self._default_timeout
+		if endpoint in self._endpoint_timeouts:
+			timeout = self._endpoint_timeouts[endpoint]
+		if parameters and self._entity_timeouts:
+			for entity_type, name in CachePolicy._ENTITY_PARAMETERS:
+				key = (entity_type, str(parameters.get(name)))
+				if key in self._entity_timeouts:
+					timeout = self._entity_timeouts[key]
+					break
+		if timeout and self._jitter:
+			timeout *= 1 + self._jitter * self._GetSpread(endpoint, parameters)
+		return timeout
+		
+	def _GetSpread(self, endpoint, parameters):
+		'''Return a number in [-1, 1) that is stable for one request.'''
+		seed = endpoint + '?' + repr(sorted((parameters or {}).items()))
+		return int(md5(seed).hexdigest()[:8], 16) / float(0x80000000) - 1
+
+class RequestScheduler(object):
+	'''Shares a connection and rate budget between requests by priority.
+	
+	Requests wait for one of max_in_flight slots, and for a token when a
+	rate is set.  Waiting requests are served by weighted fair queuing
+	across the priority classes, so interactive calls overtake a backlog
+	of batch work without starving it.  Background requests never get a
+	slot while an interactive one is waiting, and hold at most
+	background_share of the slots, so some are always free for the next
+	interactive call.  Prefetches are always background requests.
+	
+	Example usage:
+	
+		  >>> api.SetRequestScheduler(bandcamp.RequestScheduler(max_in_flight=8, rate=10))
+		  >>> api.GetTrack(track_id, priority=bandcamp.PRIORITY_INTERACTIVE)
+	'''
+	
+	DEFAULT_MAX_IN_FLIGHT = 4
+	DEFAULT_WEIGHTS = {PRIORITY_INTERACTIVE: 16,
+					   PRIORITY_NORMAL: 4,
+					   PRIORITY_BACKGROUND: 1}
+	
+	def __init__(self,
+				max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+				rate=None,
+				weights=None,
+				background_share=0.5):
+		'''Instantiate a new bandcamp.RequestScheduler.
+		
+		Args:
+			max_in_flight:
+				The number of requests that may be in flight at once.
+				[Optional]
+			rate:
+				The most requests to start per second.  Defaults to None,
+				for no limit. [Optional]
+			weights:
+				A dict mapping each priority to its relative share of
+				slots while several classes are waiting.  Defaults to
+				DEFAULT_WEIGHTS. [Optional]
+			background_share:
+				The fraction of max_in_flight that background requests may
+				hold at once. [Optional]
+		'''
+		self._max_in_flight = max_in_flight
+		self._rate = rate and float(rate)
+		self._weights = weights or RequestScheduler.DEFAULT_WEIGHTS
+		self._background_share = background_share
+		self._condition = threading.Condition()
+		self._waiting = dict((x, collections.deque()) for x in self._weights)
+		self._in_flight = dict.fromkeys(self._weights, 0)
+		# Weighted fair queuing state: each class's last finish tag, and
+		# the start tag of the last request granted.
+		self._finish = dict.fromkeys(self._weights, 0.0)
+		self._virtual_time = 0.0
+		self._tokens = 1.0
+		self._last_refill = time.time()
+		
+	def Acquire(self, priority, deadline=None):
+		'''Block until a request of this priority may start.
+		
+		Raises:
+			BandcampTimeoutError if the deadline runs out while waiting.
+		'''
+		ticket = object()
+		self._condition.acquire()
+		try:
+			self._waiting[priority].append(ticket)
+			try:
+				while True:
+					delay = self._TryGrant(priority, ticket)
+					if delay == 0:
+						return
+					if deadline:
+						remaining = deadline.Remaining()
+						if remaining <= 0:
+							raise BandcampTimeoutError('Deadline expired waiting to be scheduled')
+						delay = min(delay or remaining, remaining)
+					self._condition.wait(delay)
+			except:
+				self._waiting[priority].remove(ticket)
+				self._condition.notifyAll()
+				raise
+		finally:
+			self._condition.release()
+			
+	def Release(self, priority):
+		'''Give back the slot taken by Acquire.'''
+		self._condition.acquire()
+		try:
+			self._in_flight[priority] -= 1
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+			
+	def GetStats(self):
+		'''Return the requests in flight and waiting, per priority.'''
+		self._condition.acquire()
+		try:
+			return {'in_flight': dict(self._in_flight),
+					'waiting': dict((x, len(y)) for x, y in self._waiting.items())}
+		finally:
+			self._condition.release()
+			
+	def _GetLimit(self):
+		return self._max_in_flight
+			
+	def _TryGrant(self, priority, ticket):
+		'''Grant ticket a slot if it is next in line.
+		
+		Returns:
+			0 if granted, the seconds until the next token if only the
+			rate is holding it back, or None to wait for a notification.
+		'''
+		limit = self._GetLimit()
+		if sum(self._in_flight.values()) >= limit:
+			return None
+		if self._GetNextPriority(limit) != priority or self._waiting[priority][0] is not ticket:
+			return None
+		if self._rate:
+			now = time.time()
+			self._tokens = min(1.0, self._tokens + (now - self._last_refill) * self._rate)
+			self._last_refill = now
+			if self._tokens < 1:
+				return (1 - self._tokens) / self._rate
+			self._tokens -= 1
+		
+		self._waiting[priority].popleft()
+		self._in_flight[priority] += 1
+		start = max(self._finish[priority], self._virtual_time)
+		self._finish[priority] = start + 1.0 / self._weights[priority]
+		self._virtual_time = start
+		# Someone else may be next in line now
+		self._condition.notifyAll()
+		return 0
+		
+	def _GetNextPriority(self, limit):
+		'''Pick the waiting class with the earliest finish tag.'''
+		best = None
+		for priority, waiting in self._waiting.items():
+			if not waiting:
+				continue
+			if priority == PRIORITY_BACKGROUND and not self._CanStartBackground(limit):
+				continue
+			finish = max(self._finish[priority], self._virtual_time) + 1.0 / self._weights[priority]
+			if best is None or finish < best_finish:
+				best, best_finish = priority, finish
+		return best
+		
+	def _CanStartBackground(self, limit):
+		if self._waiting.get(PRIORITY_INTERACTIVE):
+			return False
+		background_limit = max(int(limit * self._background_share), 1)
+		return self._in_flight[PRIORITY_BACKGROUND] < background_limit
+
+class AdaptiveConcurrency(object):
+	'''Finds the most requests an Api can keep in flight, by AIMD.
+	
+	The limit grows by one after each limit's worth of requests that
+	come back without trouble, and is cut by backoff (halved, by
+	default) when a request is throttled (HTTP 429 or 503), times out,
+	or takes latency_tolerance times longer than the running baseline.
+	The baseline is a moving average that spikes pull on more slowly, so
+	it catches up with a lasting change in latency.  At most one cut is
+	made per round trip, so a burst of failures from requests that were
+	already in flight counts once.
+	
+	Example usage:
+	
+		  >>> concurrency = bandcamp.AdaptiveConcurrency(maximum=32)
+		  >>> api.SetAdaptiveConcurrency(concurrency)
+		  >>> albums = api.GetAlbums(album_ids)
+		  >>> print concurrency.GetLimit(), concurrency.GetHistory()[-5:]
+	'''
+	
+	def __init__(self,
+				initial=4,
+				minimum=1,
+				maximum=32,
+				backoff=0.5,
+				latency_tolerance=2.0,
+				history_size=1000):
+		'''Instantiate a new bandcamp.AdaptiveConcurrency.
+		
+		Args:
+			initial:
+				The limit to start from. [Optional]
+			minimum:
+				The lowest the limit is ever cut to. [Optional]
+			maximum:
+				The highest the limit ever grows to. [Optional]
+			backoff:
+				The factor the limit is multiplied by on trouble. [Optional]
+			latency_tolerance:
+				How many times the baseline latency counts as a spike.
+				[Optional]
+			history_size:
+				The number of limit changes kept for GetHistory. [Optional]
+		'''
+		self.minimum = minimum
+		self.maximum = maximum
+		self._limit = max(min(initial, maximum), minimum)
+		self._backoff = backoff
+		self._latency_tolerance = latency_tolerance
+		self._in_flight = 0
+		self._successes = 0
+		self._baseline = None
+		self._last_decrease = 0
+		self._history = collections.deque([(time.time(), self._limit, 'initial')],
+										  history_size)
+		self._condition = threading.Condition()
+		
+	def GetLimit(self):
+		'''Return the current number of requests allowed in flight.'''
+		return self._limit
+		
+	def GetHistory(self):
+		'''Return the recent limit changes as (time, limit, reason) tuples.
+		
+		Reasons are 'initial', 'increase', 'throttled', 'timeout' and
+		'latency'.
+		'''
+		self._condition.acquire()
+		try:
+			return list(self._history)
+		finally:
+			self._condition.release()
+		
+	def Acquire(self, deadline=None):
+		'''Block until another request may start.
+		
+		Raises:
+			BandcampTimeoutError if the deadline runs out while waiting.
+		'''
+		self._condition.acquire()
+		try:
+			while self._in_flight >= self._limit:
+				timeout = None
+				if deadline:
+					timeout = deadline.Remaining()
+					if timeout <= 0:
+						raise BandcampTimeoutError('Deadline expired waiting for a request slot')
+				self._condition.wait(timeout)
+			self._in_flight += 1
+		finally:
+			self._condition.release()
+			
+	def Release(self, outcome, latency=None):
+		'''Finish a request started with Acquire and learn from how it went.
+		
+		Args:
+			outcome:
+				'ok', 'throttled', 'timeout', or 'error' for failures that
+				say nothing about load.
+			latency:
+				The seconds the request took, for 'ok'. [Optional]
+		'''
+		self._condition.acquire()
+		try:
+			self._in_flight -= 1
+			if outcome == 'ok':
+				self._OnSuccess(latency)
+			elif outcome in ('throttled', 'timeout'):
+				self._Decrease(outcome)
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+			
+	def _OnSuccess(self, latency):
+		if self._baseline is None:
+			self._baseline = latency
+		elif latency > self._baseline * self._latency_tolerance:
+			self._Decrease('latency')
+			# Spikes count for less, but a lasting shift still moves the
+			# baseline, so the limit can grow again at the new latency
+			self._baseline = 0.98 * self._baseline + 0.02 * latency
+			return
+		else:
+			self._baseline = 0.9 * self._baseline + 0.1 * latency
+		self._successes += 1
+		if self._successes >= self._limit and self._limit < self.maximum:
+			self._limit += 1
+			self._successes = 0
+			self._history.append((time.time(), self._limit, 'increase'))
+			
+	def _Decrease(self, reason):
+		now = time.time()
+		if now - self._last_decrease < (self._baseline or 1.0):
+			return
+		self._last_decrease = now
+		self._limit = max(int(self._limit * self._backoff), self.minimum)
+		self._successes = 0
+		self._history.append((now, self._limit, reason))
+
+class KeyPool(object):
+	'''Spreads requests across several developer keys.
+	
+	Each request goes out under the key with the most budget left in the
+	current period; with no budgets given, that is the least used key.
+	A key that gets throttled is left out of rotation for its Retry-After
+	time, or for cooldown seconds, doubled each time it is throttled again
+	without a success in between.
+	
+	Example usage:
+	
+		  >>> pool = bandcamp.KeyPool({'key-a': 5000, 'key-b': 2000})
+		  >>> api = bandcamp.Api(pool)
+	'''
+	
+	DEFAULT_PERIOD = 3600
+	DEFAULT_COOLDOWN = 60
+	MAX_COOLDOWN = 3600
+	
+	def __init__(self,
+				keys,
+				period=DEFAULT_PERIOD,
+				cooldown=DEFAULT_COOLDOWN):
+		'''Instantiate a new bandcamp.KeyPool.
+		
+		Args:
+			keys:
+				A list of developer keys, or a dict mapping each key to the
+				number of requests it may make per period.
+			period:
+				The seconds after which every key's budget is renewed.
+				[Optional]
+			cooldown:
+				The seconds a throttled key is left out of rotation. [Optional]
+		'''
+		if not keys:
+			raise BandcampError('A KeyPool needs at least one developer key')
+		if not isinstance(keys, dict):
+			keys = dict((key, None) for key in keys)
+		self._keys = {}
+		for key, budget in keys.items():
+			self._keys[key] = {'budget': budget, 'used': 0, 'requests': 0,
+							   'throttles': 0, 'strikes': 0, 'cooling_until': 0}
+		self._period = period
+		self._cooldown = cooldown
+		self._window_start = time.time()
+		self._condition = threading.Condition()
+		
+	def Acquire(self, deadline=None):
+		'''Pick the key for the next request, waiting if none is usable.
+		
+		Returns:
+			A developer key.
+			
+		Raises:
+			BandcampTimeoutError if the deadline runs out first.
+		'''
+		self._condition.acquire()
+		try:
+			while True:
+				now = time.time()
+				self._RenewBudgets(now)
+				key = self._GetBestKey(now)
+				if key is not None:
+					state = self._keys[key]
+					state['used'] += 1
+					state['requests'] += 1
+					return key
+				wait = self._GetNextChange(now) - now
+				if deadline:
+					remaining = deadline.Remaining()
+					if remaining <= 0:
+						raise BandcampTimeoutError('Deadline expired waiting for a developer key')
+					wait = min(wait, remaining)
+				self._condition.wait(max(wait, 0.01))
+		finally:
+			self._condition.release()
+			
+	def HasAvailable(self):
+		'''Return True if a key could be handed out without waiting.'''
+		self._condition.acquire()
+		try:
+			now = time.time()
+			self._RenewBudgets(now)
+			return self._GetBestKey(now) is not None
+		finally:
+			self._condition.release()
+			
+	def MarkSucceeded(self, key):
+		'''Note that a request made under key was not throttled.'''
+		self._condition.acquire()
+		try:
+			self._keys[key]['strikes'] = 0
+		finally:
+			self._condition.release()
+			
+	def MarkThrottled(self, key, retry_after=None):
+		'''Take key out of rotation after it was throttled.
+		
+		Args:
+			key:
+				The throttled developer key.
+			retry_after:
+				The Retry-After header of the response, if any. [Optional]
+		'''
+		self._condition.acquire()
+		try:
+			state = self._keys[key]
+			try:
+				cooldown = int(retry_after)
+			except (TypeError, ValueError):
+				cooldown = min(self._cooldown * 2 ** state['strikes'], KeyPool.MAX_COOLDOWN)
+			state['strikes'] += 1
+			state['throttles'] += 1
+			state['cooling_until'] = time.time() + cooldown
+		finally:
+			self._condition.release()
+			
+	def GetStats(self):
+		'''Return a dict mapping each key to its requests, throttles,
+		budget remaining this period (None if unlimited), and the seconds
+		left until it is back in rotation.'''
+		self._condition.acquire()
+		try:
+			now = time.time()
+			self._RenewBudgets(now)
+			stats = {}
+			for key, state in self._keys.items():
+				remaining = None
+				if state['budget'] is not None:
+					remaining = max(state['budget'] - state['used'], 0)
+				stats[key] = {'requests': state['requests'],
+							  'throttles': state['throttles'],
+							  'remaining': remaining,
+							  'cooling': max(state['cooling_until'] - now, 0)}
+			return stats
+		finally:
+			self._condition.release()
+			
+	def _RenewBudgets(self, now):
+		if now - self._window_start >= self._period:
+			self._window_start = now
+			for state in self._keys.values():
+				state['used'] = 0
+				
+	def _GetBestKey(self, now):
+		best = None
+		best_remaining = None
+		for key, state in self._keys.items():
+			if state['cooling_until'] > now:
+				continue
+			if state['budget'] is None:
+				remaining = -state['used']
+			else:
+				remaining = state['budget'] - state['used']
+				if remaining <= 0:
+					continue
+			if best is None or remaining > best_remaining:
+				best = key
+				best_remaining = remaining
+		return best
+		
+	def _GetNextChange(self, now):
+		'''Return when a key may next become usable.'''
+		change = self._window_start + self._period
+		for state in self._keys.values():
+			if state['cooling_until'] > now:
+				change = min(change, state['cooling_until'])
+		return change
+
+class FetchRequest(object):
+	'''A request on its way through the fetch pipeline.
+	
+	Attributes:
+		url:
+			The full URL, with every parameter but the developer key.
+		post_data:
+			The URL-encoded POST body, or None for a GET.
+		no_cache:
+			If true, the cache is bypassed.
+		cache_timeout:
+			Time, in seconds, a cached response is reused for.
+		prefetch:
+			If true, only warm the cache.
+		deadline:
+			A bandcamp.Deadline to finish within, or None.
+		priority:
+			The priority of the request for the scheduler.
+		cache_key:
+			Set by the cache when a response should be stored under it.
+	'''
+	
+	def __init__(self, url, post_data=None, no_cache=None, cache_timeout=None,
+				 prefetch=False, deadline=None, priority=PRIORITY_NORMAL):
+		self.url = url
+		self.post_data = post_data
+		self.no_cache = no_cache
+		self.cache_timeout = cache_timeout
+		self.prefetch = prefetch
+		self.deadline = deadline
+		self.priority = priority
+		self.cache_key = None
+
+class FetchResponse(object):
+	'''The response to a bandcamp.FetchRequest.
+	
+	Attributes:
+		body:
+			The decompressed body, or None for a prefetch that found the
+			response already cached.
+		from_cache:
+			True if the body was read from the cache.
+		stale:
+			True if it was an expired cached body, served on a timeout.
+		stored:
+			True if the body is already in the cache under the request's
+			cache_key; otherwise the cache stores it.
+	'''
+	
+	def __init__(self, body, from_cache=False, stale=False, stored=False):
+		self.body = body
+		self.from_cache = from_cache
+		self.stale = stale
+		self.stored = stored
+
+class Middleware(object):
+	'''Base class for fetch pipeline middleware.  See Api.SetMiddleware.'''
+	
+	def Handle(self, request, next):
+		'''Return the bandcamp.FetchResponse for request.
+		
+		Args:
+			request:
+				The bandcamp.FetchRequest.
+			next:
+				Call with the request to run the rest of the chain.
+		'''
+		return next(request)
+
+class MetricsMiddleware(Middleware):
+	'''Counts fetches, cache hits and errors, and times them.'''
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._stats = {'requests': 0, 'cache_hits': 0, 'errors': 0, 'seconds': 0.0}
+		
+	def Handle(self, request, next):
+		start = time.time()
+		error = False
+		from_cache = False
+		try:
+			response = next(request)
+			from_cache = response.from_cache
+			return response
+		except:
+			error = True
+			raise
+		finally:
+			elapsed = time.time() - start
+			self._lock.acquire()
+			try:
+				self._stats['requests'] += 1
+				self._stats['cache_hits'] += from_cache
+				self._stats['errors'] += error
+				self._stats['seconds'] += elapsed
+			finally:
+				self._lock.release()
+				
+	def GetStats(self):
+		'''Return counts of requests, cache hits and errors, the total
+		seconds spent, and the mean seconds per request.'''
+		self._lock.acquire()
+		try:
+			stats = dict(self._stats)
+		finally:
+			self._lock.release()
+		stats['mean_seconds'] = stats['requests'] and stats['seconds'] / stats['requests']
+		return stats
+
+class RetryMiddleware(Middleware):
+	'''Retries fetches that time out, are throttled, or fail on the server.
+	
+	Waits backoff seconds before the first retry, doubling each time, but
+	never past the request's deadline.
+	'''
+	
+	RETRY_CODES = (429, 500, 502, 503, 504)
+	
+	def __init__(self, retries=2, backoff=0.5):
+		self._retries = retries
+		self._backoff = backoff
+		
+	def Handle(self, request, next):
+		delay = self._backoff
+		for attempt in range(self._retries + 1):
+			try:
+				return next(request)
+			except Exception, e:
+				if attempt == self._retries or not self._ShouldRetry(e):
+					raise
+				if request.deadline:
+					if request.deadline.Remaining() <= delay:
+						raise
+				time.sleep(delay)
+				delay *= 2
+				
+	def _ShouldRetry(self, error):
+		if isinstance(error, urllib2.HTTPError):
+			return error.code in RetryMiddleware.RETRY_CODES
+		return _IsTimeout(error) or isinstance(error, (urllib2.URLError, socket.error))
+
+class FetchFuture(object):
+	'''The result of Api.FetchAsync, once it is done.'''
+	
+	def __init__(self):
+		self._done = threading.Event()
+		self._result = None
+		self._error = None
+		self._callbacks = []
+		self._lock = threading.Lock()
+		
+	def Done(self):
+		return self._done.isSet()
+		
+	def Result(self, timeout=None):
+		'''Wait for the bandcamp.FetchResponse, raising whatever the fetch raised.
+		
+		Raises:
+			BandcampTimeoutError if timeout seconds pass first.
+		'''
+		if not self._done.wait(timeout) and not self._done.isSet():
+			raise BandcampTimeoutError('Timed out waiting for a fetch')
+		if self._error is not None:
+			raise self._error[0], self._error[1], self._error[2]
+		return self._result
+		
+	def AddCallback(self, callback):
+		'''Call callback with this future once it is done, or now if it is.'''
+		self._lock.acquire()
+		try:
+			if not self._done.isSet():
+				self._callbacks.append(callback)
+				return
+		finally:
+			self._lock.release()
+		callback(self)
+		
+	def _Finish(self, result=None, error=None):
+		self._lock.acquire()
+		try:
+			self._result = result
+			self._error = error
+			self._done.set()
+			callbacks = self._callbacks
+			self._callbacks = []
+		finally:
+			self._lock.release()
+		for callback in callbacks:
+			callback(self)
+
+class PrefetchPolicy(object):
+	'''Decides which follow-up requests an Api warms the cache for.
+	
+	After GetDiscography the Api can fetch album info for every album it
+	listed, and after GetAlbum the track info for every track, on
+	background threads, so the calls that usually follow are served from
+	the cache.  Prefetching needs a cache.
+	
+	Example usage:
+	
+		  >>> api.SetPrefetchPolicy(bandcamp.PrefetchPolicy(tracks=True, rate=5))
+		  >>> albums = api.GetDiscography(band_id)
+		  >>> ...
+		  >>> print api.GetPrefetchStats()
+	'''
+	
+	def __init__(self,
+				albums=True,
+				tracks=False,
+				max_workers=2,
+				max_queue=1000,
+				rate=None):
+		'''Instantiate a new bandcamp.PrefetchPolicy.
+		
+		Args:
+			albums:
+				Prefetch album info for albums listed by GetDiscography.
+				[Optional]
+			tracks:
+				Prefetch track info for tracks listed by GetAlbum. [Optional]
+			max_workers:
+				The number of prefetch requests that may be in flight at
+				once. [Optional]
+			max_queue:
+				The number of prefetches that may wait for a worker.  Any
+				beyond that are dropped. [Optional]
+			rate:
+				The most prefetch requests to send per second.  Defaults to
+				None, for no limit. [Optional]
+		'''
+		self.albums = albums
+		self.tracks = tracks
+		self.max_workers = max_workers
+		self.max_queue = max_queue
+		self.rate = rate
+
+class Api(object):
+	'''A python interface into the Bandcamp API.
+	
+	By default, the Api caches results for 1 minute.
+	
+	Example usage:
+	
+		To create an instance of the bandcamp.Api class:
+		
+		  >>> import bandcamp
+		  >>> api = bandcamp.Api(key)
+		
+		To fetch a band:
+		
+		  >>> band = api.GetBand(band_id)
+		  >>> print band
+
+
+	Included Methods:
+		api.GetBand(band_id, band_subdomain, band_url)
+		api.GetAlbum(album_id)
+		api.GetTrack(track_id)
+	'''
+	
+	DEFAULT_CACHE_TIMEOUT = 60 # cache for 1 minute
+	DEFAULT_NEGATIVE_CACHE_TIMEOUT = 60 * 60 # remember missing ids for 1 hour
+	DEFAULT_BULK_WORKERS = 4
+	MISSING_INDEX_CAPACITY = 1000000
+	MISSING_INDEX_ERROR_RATE = 0.01
+	MISSING_INDEX_REFRESH = 1.0 # reread shards other processes wrote at most every second
+	_READ_CHUNK_SIZE = 64 * 1024 # read responses 64KB at a time
+	_API_REALM = 'Bandcamp API'
+	
+	def __init__(self,
+				developer_key=None,
+				cache_timeout=DEFAULT_CACHE_TIMEOUT,
+				cache=DEFAULT_CACHE,
+				base_url=None,
+				debugHTTP=False,
+				snapshot=None):
+		'''Instantiate a new bandcamp.Api object.
+		
+		Args:
+			key:
+				Your Bandcamp developer key, or a bandcamp.KeyPool of them.
+			cache:
+				The cache instance to use.  Defaults to DEFAULT_CACHE.
+				Use None to disable caching. [Optional]
+			debugHTTP:
+				Set to True to enable deboug output from urllib2 when performing
+				any HTTP requests.  Defaults to False. [Optional]
+			snapshot:
+				A bandcamp.Snapshot, or the filename of one, to serve every
+				request from instead of the network.  No developer key is
+				needed then, and the cache defaults to None. [Optional]
+		
+		'''
+		if snapshot is not None and cache is DEFAULT_CACHE:
+			cache = None
+		self.SetCache(cache)
+		self._urllib			= urllib2
+		self._cache_timeout		= cache_timeout
+		self._cache_policy		= None
+		self._negative_cache_timeout = Api.DEFAULT_NEGATIVE_CACHE_TIMEOUT
+		self._missing			= _BloomFilter(Api.MISSING_INDEX_CAPACITY,
+											   Api.MISSING_INDEX_ERROR_RATE)
+		# shard -> (time last checked, cached time merged)
+		self._missing_shards	= {}
+		self._debugHTTP			= debugHTTP
+		self._identity_map		= None
+		self._prefetcher		= None
+		self._connect_timeout	= None
+		self._read_timeout		= None
+		self._serve_stale		= True
+		self._recorder			= None
+		self._snapshot			= None
+		self._scheduler			= None
+		self._concurrency		= None
+		self._developer_key		= None
+		self._key_pool			= None
+		self._cascade			= False
+		self._cascade_refresh	= False
+		self._track_relations	= False
+		self._middleware		= []
+		self._network_middleware = []
+		self._executor			= None
+		self._BuildPipeline()
+		#self._InitializeUserAgent()
+		self._InitializeDefaultParameters()
+
+		if base_url is None:
+			self.base_url = 'https://api.bandcamp.com/api/'
+		else:
+			self.base_url = base_url
+
+		if snapshot is not None:
+			self.SetSnapshot(snapshot)
+		elif developer_key is None:
+			raise BandcampError('Bandcamp requires a developer key for all API access. \
+							Please email support@bandcamp.com with your name and contact email to get access.')
+
+		if isinstance(developer_key, KeyPool):
+			self.SetKeyPool(developer_key)
+		else:
+			self.SetCredentials(developer_key)
+
+	def SetCredentials(self,
+						developer_key=None):
+		'''Set the developer key for this instance
+
+	    Args:
+	      key:
+	        The developer key of the bancamp account.
+		'''
+		self._developer_key = developer_key
+		self._key_pool = None
+		
+	def SetKeyPool(self, key_pool):
+		'''Spread requests across several developer keys.
+		
+		A request throttled under one key is retried under another, if one
+		is usable straight away.  Cached responses are shared by every key.
+		
+		Args:
+			key_pool:
+				A bandcamp.KeyPool, or None to go back to the single key set
+				with SetCredentials.
+		'''
+		self._key_pool = key_pool
+
+	def ClearCredentials(self):
+		'''Clear the any credentials for this instance.'''
+		self._developer_key = None
+		self._key_pool = None
+		
+	def GetBand(self,
+				band_id=None,
+				band_subdomain=None,
+				band_url=None,
+				deadline=None,
+				priority=PRIORITY_NORMAL,
+				fields=None):
+		'''Fetch the bandcamp.Band for the given band_id.
+		
+		Must provide one of the three arguments.
+		
+		Args:
+			band_id:
+				The band id you want to fetch. [Optional]
+			band_subdomain:
+				The band subdomain you want to fetch. [Optional]
+			band_url:
+				The band url you want to fetch. [Optional]
+			deadline:
+				A bandcamp.Deadline, or seconds, to finish within. [Optional]
+			priority:
+				PRIORITY_INTERACTIVE, PRIORITY_NORMAL or PRIORITY_BACKGROUND,
+				for the request scheduler. [Optional]
+			fields:
+				The properties to fill in on the returned models, such as
+				('id', 'title', 'duration', 'url').  The rest are never
+				set and read as None. [Optional]
+				
+		Returns:
+			A bandcamp.Band instance
+		'''
+		
+		if band_id is None and band_subdomain is None and band_url is None:
+			raise BandcampError('GetBand requires at least one of the three arguments: band_id, band_subdomain, band_url.')
+			
+		parameters, band_id, band_host = self._GetBandParameters(band_id, band_subdomain, band_url)
+			
+		fields = _CheckFields(fields, Band)
+		data = self._FetchJson('band/1/info', parameters, 'band', band_id,
+							   deadline=_AsDeadline(deadline), priority=priority)
+		band = Band.NewFromJsonDict(data)
+		
+		self._LearnBandHost(band_host, band.id)
+		if band.subdomain:
+			self._LearnBandHost(_NormalizeBandUrl(band.subdomain), band.id)
+		if band.url:
+			self._LearnBandHost(_NormalizeBandUrl(band.url), band.id)
+		self._RecordByBandId('band/1/info', parameters, band.id, data)
+		
+		if fields is not None:
+			# Every field was needed above to learn the band's urls
+			band = Band.NewFromJsonDict(data, fields)
+		return self._Canonical(band)
+	
+	def GetDiscography(self,
+						band_id=None,
+						band_subdomain=None,
+						band_url=None,
+						deadline=None,
+						priority=PRIORITY_NORMAL,
+						fields=None):
+		'''Fetch the bandcamp.Album and bandcamp.Track releases of a band.
+		
+		Must provide one of the first three arguments.
+		
+		Args:
+			band_id:
+				The id of the band. [Optional]
+			band_subdomain:
+				The subdomain of the band. [Optional]
+			band_url:
+				The url of the band. [Optional]
+			deadline:
+				A bandcamp.Deadline, or seconds, to finish within. [Optional]
+			priority:
+				PRIORITY_INTERACTIVE, PRIORITY_NORMAL or PRIORITY_BACKGROUND,
+				for the request scheduler. [Optional]
+			fields:
+				The properties to fill in on the returned models, such as
+				('id', 'title', 'duration', 'url').  The rest are never
+				set and read as None. [Optional]
+				
+		Returns:
+			A list of bandcamp.Album and bandcamp.Track instances
+		'''
+		deadline = _AsDeadline(deadline)
+		
+		if band_id is None and band_subdomain is None and band_url is None:
+			raise BandcampError('GetDiscography requires at least one of the three arguments: band_id, band_subdomain, band_url.')
+		
+		parameters, band_id, band_host = self._GetBandParameters(band_id, band_subdomain, band_url)
+			
+		fields = _CheckFields(fields, Album, Track)
+		data = self._FetchJson('band/1/discography', parameters, 'band', band_id,
+							   deadline=deadline, priority=priority)
+		
+		results = []		
+		relations = []
+		for x in data['discography']:
+			self._LearnBandHost(band_host, x.get('band_id'))
+			if x.get('track_id'):
+				results.append(self._Canonical(Track.NewFromJsonDict(x, fields)))
+				self._ForgetMissing('track', x['track_id'])
+				relations.append((('band', x.get('band_id')), ('track', x['track_id'])))
+				relations.append((('album', x.get('album_id')), ('track', x['track_id'])))
+			elif x.get('album_id'):
+				relations.append((('band', x.get('band_id')), ('album', x['album_id'])))
+			if x.get('album_id'):
+				results.append(self._Canonical(Album.NewFromJsonDict(x, fields)))
+				self._ForgetMissing('album', x['album_id'])
+			if x.get('band_id'):
+				self._ForgetMissing('band', x['band_id'])
+		self._LearnRelations(relations)
+		
+		if data['discography']:
+			self._RecordByBandId('band/1/discography', parameters,
+								 data['discography'][0].get('band_id'), data)
+		
+		if self._prefetcher and self._prefetcher.policy.albums:
+			# Track entries carry their album_id too
+			for album_id in _Unique([x.get('album_id') for x in data['discography']]):
+				if album_id:
+					self._prefetcher.Submit('album/1/info', {'album_id': album_id},
+											'album', album_id, deadline)
+		
+		# Return built list of discography
+		return results
+		
+	def GetAlbum(self, album_id, deadline=None, priority=PRIORITY_NORMAL,
+				 fields=None):
+		'''Fetch the bandcamp.Album for the given album_id.
+
+		Args:
+			album_id:
+				The album id you want to fetch.
+			deadline:
+				A bandcamp.Deadline, or seconds, to finish within. [Optional]
+			priority:
+				PRIORITY_INTERACTIVE, PRIORITY_NORMAL or PRIORITY_BACKGROUND,
+				for the request scheduler. [Optional]
+			fields:
+				The properties to fill in on the returned models, such as
+				('id', 'title', 'duration', 'url').  The rest are never
+				set and read as None. [Optional]
+		
+		Returns:
+			A bandcamp.Album instance
+		'''
+		deadline = _AsDeadline(deadline)
+		parameters = {}
+		parameters['album_id'] = album_id
+			
+		fields = _CheckFields(fields, Album, Track)
+		data = self._FetchJson('album/1/info', parameters, 'album', album_id,
+							   deadline=deadline, priority=priority)
+		self._LearnBandUrl(data)
+		relations = [(('band', data.get('band_id')), ('album', album_id))]
+		for x in data.get('tracks') or []:
+			relations.append((('album', album_id), ('track', x.get('track_id'))))
+		self._LearnRelations(relations)
+		
+		if self._prefetcher and self._prefetcher.policy.tracks:
+			for x in data.get('tracks') or []:
+				if x.get('track_id'):
+					self._prefetcher.Submit('track/1/info', {'track_id': x['track_id']},
+											'track', x['track_id'], deadline)
+		
+		return self._Canonical(Album.NewFromJsonDict(data, fields))
+		
+	def GetTrack(self, track_id, deadline=None, priority=PRIORITY_NORMAL,
+				 fields=None):
+		'''Fetch the bandcamp.Track for the given track_id.
+		
+		Args:
+			track_id:
+				The track id you want to fetch.
+			deadline:
+				A bandcamp.Deadline, or seconds, to finish within. [Optional]
+			priority:
+				PRIORITY_INTERACTIVE, PRIORITY_NORMAL or PRIORITY_BACKGROUND,
+				for the request scheduler. [Optional]
+			fields:
+				The properties to fill in on the returned models, such as
+				('id', 'title', 'duration', 'url').  The rest are never
+				set and read as None. [Optional]
+				
+		Returns:
+			A bandcamp.Track instance
+		'''
+		parameters = {}
+		parameters['track_id'] = track_id
+			
+		fields = _CheckFields(fields, Track)
+		data = self._FetchJson('track/1/info', parameters, 'track', track_id,
+							   deadline=_AsDeadline(deadline), priority=priority)
+		self._LearnBandUrl(data)
+		self._LearnRelations([(('album', data.get('album_id')), ('track', track_id)),
+							  (('band', data.get('band_id')), ('track', track_id))])
+		
+		return self._Canonical(Track.NewFromJsonDict(data, fields))
+		
+	def GetAlbums(self, album_ids, deadline=None, priority=PRIORITY_NORMAL,
+				  fields=None, max_workers=None):
+		'''Fetch many albums at once.
+		
+		Args:
+			album_ids:
+				The album ids you want to fetch.
+			deadline:
+				A bandcamp.Deadline, or seconds, for the whole batch. [Optional]
+			priority:
+				The priority of every request, for the scheduler. [Optional]
+			fields:
+				The properties to fill in, as for GetAlbum. [Optional]
+			max_workers:
+				The most requests to run at once.  Defaults to the adaptive
+				concurrency maximum, if set, or DEFAULT_BULK_WORKERS.  An
+				adaptive limit keeps the actual number at or below it.
+				[Optional]
+				
+		Returns:
+			A dict mapping each album id to a bandcamp.Album, or to the
+			BandcampError raised fetching it.
+		'''
+		deadline = _AsDeadline(deadline)
+		return self._GetMany(lambda x: self.GetAlbum(x, deadline, priority, fields),
+							 album_ids, max_workers)
+		
+	def GetTracks(self, track_ids, deadline=None, priority=PRIORITY_NORMAL,
+				  fields=None, max_workers=None):
+		'''Fetch many tracks at once.
+		
+		Args:
+			track_ids:
+				The track ids you want to fetch.
+			deadline:
+				A bandcamp.Deadline, or seconds, for the whole batch. [Optional]
+			priority:
+				The priority of every request, for the scheduler. [Optional]
+			fields:
+				The properties to fill in, as for GetTrack. [Optional]
+			max_workers:
+				The most requests to run at once, as for GetAlbums. [Optional]
+				
+		Returns:
+			A dict mapping each track id to a bandcamp.Track, or to the
+			BandcampError raised fetching it.
+		'''
+		deadline = _AsDeadline(deadline)
+		return self._GetMany(lambda x: self.GetTrack(x, deadline, priority, fields),
+							 track_ids, max_workers)
+		
+	def Plan(self, band_ids=(), band_urls=(), album_ids=(), track_ids=()):
+		'''Plan the fewest upstream calls that fetch a mixed set of entities.
+		
+		Tracks whose album is known, from an earlier album or track
+		response seen with relation tracking on, are folded into one album
+		call when that album is requested anyway, already cached, or holds
+		more than one of them.
+		
+		Example usage:
+		
+			  >>> plan = api.Plan(album_ids=[1], track_ids=[11, 12, 20])
+			  >>> print plan.Explain()
+			  >>> results = plan.Execute()
+			  >>> results[('track', 11)].title
+			  
+		Args:
+			band_ids:
+				The ids of bands to fetch. [Optional]
+			band_urls:
+				The urls or subdomains of bands to fetch. [Optional]
+			album_ids:
+				The ids of albums to fetch. [Optional]
+			track_ids:
+				The ids of tracks to fetch. [Optional]
+				
+		Returns:
+			A bandcamp.RequestPlan
+		'''
+		return RequestPlan(self, band_ids, band_urls, album_ids, track_ids)
+		
+	def ResolveBandId(self, band_subdomain=None, band_url=None):
+		'''Look up a band id from the resolution index, without any request.
+		
+		The index maps band subdomains and urls to band ids as soon as any
+		response reveals the mapping, and is kept in the cache so it
+		outlives this Api.  GetBand and GetDiscography use it to fetch by
+		band id, so every form of the same band shares one cache entry.
+		
+		Args:
+			band_subdomain:
+				The band subdomain to resolve. [Optional]
+			band_url:
+				The band url to resolve. [Optional]
+				
+		Returns:
+			The band id, or None if it hasn't been seen yet.
+		'''
+		if not band_subdomain and not band_url:
+			return None
+		band_host = _NormalizeBandUrl(band_subdomain or band_url)
+		if self._snapshot:
+			return self._snapshot.GetBandId(band_host)
+		return self._resolution_index.Get(band_host)
+		
+	def IsKnownMissing(self, entity_type, entity_id):
+		'''Check whether an id recently failed to resolve.
+		
+		Ids that made the API return an error or a 404 are remembered for the
+		negative cache timeout.  Ids that were never missing are answered
+		from a Bloom filter without touching the cache, which makes this
+		cheap enough to filter bulk lookups with.  The filter is kept in
+		the cache too, so other processes and later runs sharing the cache
+		see ids found missing here within MISSING_INDEX_REFRESH seconds.
+		
+		Args:
+			entity_type:
+				One of 'band', 'album' or 'track'.
+			entity_id:
+				The id to check.
+				
+		Returns:
+			True if fetching the id would raise a cached BandcampError.
+		'''
+		return self._GetMissingError(entity_type, entity_id) is not None
+	
+	def SetCache(self, cache):
+		'''Override the default cache.  Set to None to prevent caching.
+		
+		Args:
+			cache:
+				An instance that supports the same API as the bandcamp._FileCache
+		'''
+		if cache == DEFAULT_CACHE:
 			self._cache = _FileCache()
 		else:
-			self._cache = cache
+			self._cache = cache
+		self._resolution_index = _ResolutionIndex(self._cache)
+		self._relations = _RelationIndex(self._cache)
+		
+	def SetWriteBehind(self, enabled=True, max_pending=None, max_pending_bytes=None):
+		'''Persist cache entries from a background thread.
+		
+		Responses are then returned as soon as they are read, and written
+		to the cache afterwards.  Pending writes to the same key are
+		coalesced, are visible to reads straight away, and are flushed when
+		the interpreter exits.  Once max_pending entries or
+		max_pending_bytes of data are waiting, further writes block until
+		the disk catches up.
+		
+		Args:
+			enabled:
+				False turns write-behind off again, after flushing. [Optional]
+			max_pending:
+				The most entries waiting to be written.  Defaults to
+				_WriteBehindCache.DEFAULT_MAX_PENDING. [Optional]
+			max_pending_bytes:
+				The most bytes of data waiting to be written.  Defaults to
+				_WriteBehindCache.DEFAULT_MAX_PENDING_BYTES. [Optional]
+		'''
+		cache = self._cache
+		if isinstance(cache, _WriteBehindCache):
+			cache.Close()
+			cache = cache.GetCache()
+		if enabled and cache:
+			cache = _WriteBehindCache(cache, max_pending, max_pending_bytes)
+		self._cache = cache
+		self._resolution_index = _ResolutionIndex(self._cache)
+		self._relations = _RelationIndex(self._cache)
+		
+	def FlushCache(self, timeout=None):
+		'''Wait for write-behind cache writes to reach the cache.
+		
+		Args:
+			timeout:
+				The most seconds to wait. [Optional]
+				
+		Returns:
+			True if every pending write has been made.
+		'''
+		if isinstance(self._cache, _WriteBehindCache):
+			return self._cache.Flush(timeout)
+		return True
+
+	def SetCacheTimeout(self, cache_timeout):
+		'''Override the default cache timeout.
+
+		Args:
+			cache_timeout:
+				Time, in seconds, that response should be reused.
+		'''
+		self._cache_timeout = cache_timeout
+		
+	def SetCascadingInvalidation(self, enabled=True, refresh=False):
+		'''Invalidate related responses when an album or track changes.
+		
+		Every album and track response is then compared with the last one
+		seen for it.  When it has changed, the cached responses that embed
+		it are dropped: the album's tracks and its band's discography, or
+		the track's album and its band's discography.  This makes long
+		cache timeouts safe to use.  Relationships are recorded, as for
+		SetRelationTracking, while it is on.
+		
+		Args:
+			enabled:
+				False turns it off again. [Optional]
+			refresh:
+				Also fetch the dropped responses again straight away.
+				[Optional]
+		'''
+		self._cascade = enabled
+		self._cascade_refresh = refresh
+		
+	def SetRelationTracking(self, enabled=True):
+		'''Record which bands hold which albums and tracks, and which albums
+		hold which tracks, from the responses seen.
+		
+		Invalidate and Plan use the relationships to find an entity's
+		dependents and a track's album.  They are kept in the cache, one
+		entry per entity written once per response, so they outlive this
+		Api.  Off by default, as they cost a cache write per related entity.
+		
+		Args:
+			enabled:
+				False turns it off again.  Relationships recorded so far
+				are kept. [Optional]
+		'''
+		self._track_relations = enabled
+		
+	def Invalidate(self, entity_type, entity_id, dependents=True, refresh=False):
+		'''Drop the cached responses for an entity and those that depend on it.
+		
+		Relationships between bands, albums and tracks are learned from the
+		responses seen while relation tracking or cascading invalidation is
+		on, and kept in the cache.  An album's dependents
+		are its tracks and its band's discography, a track's are its album
+		and its band's discography, and a band's are all its albums and
+		tracks.
+		
+		Args:
+			entity_type:
+				One of 'band', 'album' or 'track'.
+			entity_id:
+				The id of the entity.
+			dependents:
+				Also drop the responses that depend on it. [Optional]
+			refresh:
+				Fetch the dropped responses again before returning. [Optional]
+				
+		Returns:
+			The dropped requests, as 'endpoint?parameters' strings.
+		'''
+		self._ForgetMissing(entity_type, entity_id)
+		requests = _GetEntityRequests(entity_type, entity_id)
+		if dependents:
+			requests.extend(self._GetDependentRequests(entity_type, entity_id))
+		return self._InvalidateRequests(requests, refresh)
+		
+	def SetIdentityMap(self, enabled=True):
+		'''Return one shared instance per band, album and track.
+		
+		With the identity map on, fetching an entity that is still referenced
+		elsewhere returns that same instance, updated in place with any new
+		data, and repeated values such as band ids, artists and release
+		dates share a single copy, from a pool of the MAX_INTERNED most
+		recently seen.  Instances are held weakly, so memory grows with the
+		number of unique entities rather than fetches.
+		
+		Args:
+			enabled:
+				Set to False to turn the identity map back off. [Optional]
+		'''
+		if enabled:
+			if self._identity_map is None:
+				self._identity_map = _IdentityMap()
+		else:
+			self._identity_map = None
+		
+	def SetTimeout(self, connect_timeout=None, read_timeout=None, serve_stale=True):
+		'''Stop waiting on slow connections.
+		
+		Args:
+			connect_timeout:
+				Time, in seconds, to wait for a connection, and then for
+				each read of the response headers.  Defaults to None,
+				which waits forever. [Optional]
+			read_timeout:
+				Time, in seconds, to wait for each read of the response
+				body.  Defaults to None, which waits forever. [Optional]
+			serve_stale:
+				If a request times out or its deadline runs out and an
+				expired response is still cached, return that instead of
+				raising a BandcampTimeoutError. [Optional]
+		'''
+		self._connect_timeout = connect_timeout
+		self._read_timeout = read_timeout
+		self._serve_stale = serve_stale
+		
+	def SetAdaptiveConcurrency(self, concurrency):
+		'''Let observed latency and errors decide how many requests to run.
+		
+		Every network request then waits for a slot under the adaptive
+		limit and reports back how it went.  GetAlbums and GetTracks run as
+		many requests at once as the limit allows.
+		
+		Args:
+			concurrency:
+				A bandcamp.AdaptiveConcurrency, or None to turn it off.
+		'''
+		self._concurrency = concurrency
+		
+	def SetRequestScheduler(self, scheduler):
+		'''Send every request through a priority-aware scheduler.
+		
+		Args:
+			scheduler:
+				A bandcamp.RequestScheduler, which may be shared by several
+				Api instances, or None to send requests straight away.
+		'''
+		self._scheduler = scheduler
+		
+	def SetSnapshot(self, snapshot):
+		'''Serve every request from a snapshot, with no network I/O at all.
+		
+		Requests missing from the snapshot raise a BandcampError.  The
+		cache, negative cache and resolution index are neither read nor
+		written meanwhile.
+		
+		Args:
+			snapshot:
+				A bandcamp.Snapshot, the filename of one, or None to go back
+				to the network.
+		'''
+		if isinstance(snapshot, basestring):
+			snapshot = Snapshot(snapshot)
+		self._snapshot = snapshot
+		
+	def SetRecorder(self, recorder):
+		'''Copy every response this Api returns into a snapshot.
+		
+		Responses served from the cache are recorded too, so re-running a
+		crawl against a warm cache exports it without refetching.
+		
+		Args:
+			recorder:
+				A bandcamp.SnapshotWriter, or None to stop recording.
+		'''
+		self._recorder = recorder
+		
+	def SetCachePolicy(self, cache_policy):
+		'''Set per-endpoint and per-entity cache timeouts.
+		
+		Args:
+			cache_policy:
+				A bandcamp.CachePolicy.  Requests it has no timeout for use
+				the cache timeout.  Use None to go back to the cache timeout
+				for everything.
+		'''
+		self._cache_policy = cache_policy
+		
+	def SetPrefetchPolicy(self, prefetch_policy):
+		'''Start warming the cache for likely follow-up requests.
+		
+		Args:
+			prefetch_policy:
+				A bandcamp.PrefetchPolicy, or None to stop prefetching.
+		'''
+		if self._prefetcher:
+			self._prefetcher.Close()
+			self._prefetcher = None
+		if prefetch_policy:
+			self._prefetcher = _Prefetcher(self, prefetch_policy)
+			
+	def GetPrefetchStats(self):
+		'''Report how useful prefetching has been so far.
+		
+		Returns:
+			None if prefetching is off, otherwise a dict of counts:
+			submitted, dropped (queue full), skipped (already cached or
+			known missing), fetched, errors and hits (fetched entries a
+			later call was served from), plus hit_ratio and waste_ratio,
+			the fractions of fetched entries that were and weren't used.
+		'''
+		if not self._prefetcher:
+			return None
+		return self._prefetcher.GetStats()
+		
+	def SetNegativeCacheTimeout(self, negative_cache_timeout):
+		'''Override how long ids that failed to resolve are remembered.
+		
+		Args:
+			negative_cache_timeout:
+				Time, in seconds, that an API error or 404 for an id should
+				be reused.  Use None to disable negative caching.
+		'''
+		self._negative_cache_timeout = negative_cache_timeout
+			
+	def SetMiddleware(self, middleware=(), network_middleware=()):
+		'''Run every fetch through a chain of middleware.
+		
+		A middleware is an object with a Handle(request, next) method, such
+		as a bandcamp.Middleware subclass.  It gets a bandcamp.FetchRequest,
+		and returns the bandcamp.FetchResponse of next(request), changed as
+		it likes, or one of its own without calling next.
+		
+		The chain runs middleware, in order, then the cache, then
+		network_middleware, in order, then the transport.  So middleware
+		sees every fetch, even those answered from the cache, while
+		network_middleware only sees those going upstream.  A network
+		middleware that doesn't call next replaces the transport; set the
+		cache to None and add a middleware to replace the cache.
+		
+		Example usage:
+		
+			  >>> metrics = bandcamp.MetricsMiddleware()
+			  >>> api.SetMiddleware([metrics], [bandcamp.RetryMiddleware(retries=2)])
+			  >>> api.GetAlbum(album_id)
+			  >>> print metrics.GetStats()
+		
+		Args:
+			middleware:
+				The middleware run before the cache. [Optional]
+			network_middleware:
+				The middleware run between the cache and the transport.
+				[Optional]
+		'''
+		self._middleware = list(middleware)
+		self._network_middleware = list(network_middleware)
+		self._BuildPipeline()
+		
+	def Fetch(self, endpoint, parameters=None, deadline=None, priority=PRIORITY_NORMAL):
+		'''Fetch an API endpoint through the pipeline, without decoding it.
+		
+		Args:
+			endpoint:
+				The path of the endpoint under base_url, e.g. 'album/1/info'.
+			parameters:
+				A dict of query parameters for the endpoint. [Optional]
+			deadline:
+				A bandcamp.Deadline, or seconds, to finish within. [Optional]
+			priority:
+				The priority of the request for the scheduler. [Optional]
+				
+		Returns:
+			A bandcamp.FetchResponse
+		'''
+		parameters = parameters or {}
+		request = FetchRequest(self._GetRequestUrl('%s/%s' % (self.base_url, endpoint), parameters),
+							   cache_timeout=self._GetCacheTimeout(endpoint, parameters),
+							   deadline=_AsDeadline(deadline), priority=priority)
+		return self._pipeline(request)
+		
+	def FetchAsync(self, endpoint, parameters=None, deadline=None,
+				   priority=PRIORITY_NORMAL, callback=None):
+		'''Fetch an API endpoint through the pipeline in the background.
+		
+		The same chain as Fetch runs on one of DEFAULT_BULK_WORKERS threads
+		shared by this Api.
+		
+		Args:
+			endpoint:
+				The path of the endpoint under base_url, e.g. 'album/1/info'.
+			parameters:
+				A dict of query parameters for the endpoint. [Optional]
+			deadline:
+				A bandcamp.Deadline, or seconds, to finish within. [Optional]
+			priority:
+				The priority of the request for the scheduler. [Optional]
+			callback:
+				Called with the bandcamp.FetchFuture once it is done. [Optional]
+				
+		Returns:
+			A bandcamp.FetchFuture for the bandcamp.FetchResponse
+		'''
+		future = FetchFuture()
+		if callback:
+			future.AddCallback(callback)
+		deadline = _AsDeadline(deadline)
+		if self._executor is None:
+			self._executor = _Executor(Api.DEFAULT_BULK_WORKERS)
+		self._executor.Submit(future, lambda: self.Fetch(endpoint, parameters,
+														 deadline, priority))
+		return future
+		
+	def SetUrllib(self, urllib):
+		'''Override the default urllib implmentation.
+		
+		Args:
+			urllib:
+				An instance that supporst the same API as the urllib2 module
+			
+		'''
+		self._urllib = urllib
+		
+	def _InitializeDefaultParameters(self):
+		self._default_params = {}
+		
+	def _GetBandParameters(self, band_id, band_subdomain, band_url):
+		'''Build the query parameters identifying a band.
+		
+		A subdomain or url already in the resolution index is rewritten to
+		its band id.
+		
+		Returns:
+			A (parameters, band_id, band_host) tuple, where band_id is None if
+			the band is still identified by url and band_host is the
+			normalized subdomain or url, if one was given.
+		'''
+		band_host = None
+		if not band_id:
+			band_host = _NormalizeBandUrl(band_subdomain or band_url)
+			if self._snapshot:
+				band_id = self._snapshot.GetBandId(band_host)
+			else:
+				band_id = self._resolution_index.Get(band_host)
+		if band_id:
+			return {'band_id': band_id}, band_id, band_host
+		return {'band_url': band_subdomain or band_url}, None, band_host
+		
+	def _LearnBandUrl(self, data):
+		'''Record the band behind an album or track url in the index.'''
+		if data.get('url') and data.get('band_id'):
+			self._LearnBandHost(_NormalizeBandUrl(data['url']), data['band_id'])
+			
+	def _GetMany(self, get, ids, max_workers):
+		'''Call get for every id from a pool of threads.'''
+		if max_workers is None:
+			if self._concurrency:
+				max_workers = self._concurrency.maximum
+			else:
+				max_workers = Api.DEFAULT_BULK_WORKERS
+		results = {}
+		def Get(x):
+			try:
+				results[x] = get(x)
+			except BandcampError, e:
+				results[x] = e
+		_ParallelMap(Get, ids, max_workers)
+		return results
+		
+	def _RecordByBandId(self, endpoint, parameters, band_id, data):
+		'''Also cache and record a response fetched by band url under its band id.
+		
+		Once the url resolves, the same request is made by band id, so the
+		cache and a snapshot need the response under that form too.
+		'''
+		if band_id is None or 'band_url' not in parameters or self._snapshot:
+			return
+		json = simplejson.dumps(data)
+		if self._cache:
+			self._cache.Set(self._GetRequestUrl('%s/%s' % (self.base_url, endpoint),
+												{'band_id': band_id}), json)
+		if self._recorder:
+			self._recorder.Add(endpoint, {'band_id': band_id}, json)
+			
+	def _LearnBandResponse(self, endpoint, parameters, band_host, data):
+		'''Learn what a raw band info or discography response says about
+		the band's urls, as GetBand and GetDiscography do.'''
+		band_id = _GetResponseBandId(data)
+		self._LearnBandHost(band_host, band_id)
+		if endpoint == 'band/1/info':
+			for band_url in (data.get('subdomain'), data.get('url')):
+				if band_url:
+					self._LearnBandHost(_NormalizeBandUrl(band_url), band_id)
+		self._RecordByBandId(endpoint, parameters, band_id, data)
+		
+	def _LearnBandHost(self, band_host, band_id):
+		'''Add a band host to band id mapping to the index and any recorder.'''
+		if self._snapshot:
+			return
+		self._resolution_index.Learn(band_host, band_id)
+		if self._recorder and band_host and band_id is not None:
+			self._recorder.AddResolution(band_host, band_id)
+		
+	def _LearnRelations(self, relations):
+		'''Record (parent, child) entity pairs, if anything will use them.'''
+		if (self._cascade or self._track_relations) and not self._snapshot:
+			self._relations.Learn(relations)
+			
+	def _Canonical(self, instance):
+		'''Pass a new model instance through the identity map, if enabled.'''
+		if self._identity_map is None:
+			return instance
+		return self._identity_map.Merge(instance)
+		
+	def _CheckForBandcampError(self, data):
+		'''Raises a BandcampError if bandcamp returns an error message.
+		
+		Args:
+			data:
+				A python dict created from the Bandcamp json response
+				
+		Raises:
+			BandcampError wrapping the bandcamp error message if one exists.
+		'''
+		
+		# Bandcamp errors are relatively unlikely, so it is faster
+		# to check first, rather than try and catch the exception.
+		if 'error' in data:
+			raise BandcampError(data.get('error_message', data['error']))
+			
+	def _FetchJson(self, endpoint, parameters, entity_type=None, entity_id=None,
+				   prefetch=False, deadline=None, priority=PRIORITY_NORMAL,
+				   cascade=True):
+		'''Fetch an API endpoint and return its checked, decoded JSON.
+		
+		If entity_id is given, errors for it are negatively cached and
+		known-missing ids are rejected without a request.
+		
+		Args:
+			endpoint:
+				The path of the endpoint under base_url, e.g. 'album/1/info'.
+			parameters:
+				A dict of query parameters for the endpoint.
+			entity_type:
+				One of 'band', 'album' or 'track'. [Optional]
+			entity_id:
+				The id of the entity being fetched. [Optional]
+			prefetch:
+				Set by prefetch workers.  See _FetchUrl. [Optional]
+			deadline:
+				A bandcamp.Deadline to finish within. [Optional]
+			priority:
+				The priority of the request for the scheduler. [Optional]
+			cascade:
+				Set to False to not invalidate dependents if the response
+				has changed, when refreshing them already. [Optional]
+				
+		Returns:
+			A python dict created from the Bandcamp json response, or None
+			for a prefetch that found the response already cached.
+			
+		Raises:
+			BandcampError for error responses and for connection failures.
+		'''
+		# Offline results depend on the snapshot alone, never the cache
+		if self._snapshot:
+			if prefetch:
+				return None
+			json = self._snapshot.Get(endpoint, parameters)
+			if json is None:
+				raise BandcampError('%s is not in the snapshot' %
+									_GetRequestKey(endpoint, parameters))
+			return simplejson.loads(json)
+		
+		if entity_id is not None:
+			error = self._GetMissingError(entity_type, entity_id)
+			if error is not None:
+				raise BandcampError(error)
+		
+		url = '%s/%s' % (self.base_url, endpoint)
+		try:
+			json = self._FetchUrl(url, parameters=parameters,
+								  cache_timeout=self._GetCacheTimeout(endpoint, parameters),
+								  prefetch=prefetch,
+								  deadline=deadline,
+								  priority=priority)
+		except urllib2.HTTPError, e:
+			if e.code == 404 and entity_id is not None:
+				self._RecordMissing(entity_type, entity_id, str(e))
+			raise BandcampError(str(e))
+		except (urllib2.URLError, socket.error, httplib.HTTPException), e:
+			# Connection failures say nothing about the id, so aren't recorded
+			if _IsTimeout(e):
+				raise BandcampTimeoutError(str(e))
+			raise BandcampError(str(e) or e.__class__.__name__)
+		if json is None:
+			return None
+		try:
+			data = simplejson.loads(json)
+		except ValueError, e:
+			self._RemoveCached(url, parameters)
+			raise BandcampError('Invalid JSON from %s: %s' % (endpoint, e))
+		
+		try:
+			self._CheckForBandcampError(data)
+		except BandcampError, e:
+			# The body was cached as it streamed in; errors are only
+			# remembered as a negative entry, for the negative timeout
+			self._RemoveCached(url, parameters)
+			if entity_id is not None:
+				self._RecordMissing(entity_type, entity_id, e.message)
+			raise
+		
+		if self._recorder:
+			self._recorder.Add(endpoint, parameters, json)
+		if (self._cascade and cascade and entity_id is not None and
+			entity_type in ('album', 'track')):
+			self._NoteVersion(endpoint, parameters, entity_type, entity_id, json)
+		return data
+		
+	def _GetDependentRequests(self, entity_type, entity_id):
+		'''List the requests whose responses embed an entity.'''
+		requests = []
+		if entity_type == 'band':
+			for related in self._relations.GetChildren('band', entity_id):
+				requests.extend(_GetEntityRequests(*related))
+			return requests
+		if entity_type == 'album':
+			for related in self._relations.GetChildren('album', entity_id):
+				requests.extend(_GetEntityRequests(*related))
+		for related_type, related_id in self._relations.GetParents(entity_type, entity_id):
+			if related_type == 'band':
+				requests.append(('band/1/discography', {'band_id': related_id},
+								 related_type, related_id))
+			else:
+				requests.extend(_GetEntityRequests(related_type, related_id))
+		return requests
+		
+	def _InvalidateRequests(self, requests, refresh):
+		'''Drop the cached responses to requests, and refetch them if asked.'''
+		requests = [x for key, x in sorted(
+			dict((_GetRequestKey(x[0], x[1]), x) for x in requests).items())]
+		if self._cache:
+			for endpoint, parameters, entity_type, entity_id in requests:
+				self._cache.Remove(self._GetRequestUrl('%s/%s' % (self.base_url, endpoint),
+													   parameters))
+		if refresh and not self._snapshot:
+			def Refresh(request):
+				endpoint, parameters, entity_type, entity_id = request
+				try:
+					self._FetchJson(endpoint, parameters, entity_type, entity_id,
+									cascade=False)
+				except BandcampError:
+					pass
+			_ParallelMap(Refresh, requests, Api.DEFAULT_BULK_WORKERS)
+		return [_GetRequestKey(endpoint, parameters)
+				for endpoint, parameters, entity_type, entity_id in requests]
+		
+	def _NoteVersion(self, endpoint, parameters, entity_type, entity_id, json):
+		'''Invalidate an entity's dependents if its response has changed.
+		
+		The last digest is only kept in the cache, so memory stays flat
+		however many entities are fetched.  Without a cache there are no
+		dependents to drop.
+		'''
+		if not self._cache:
+			return
+		key = 'digest:' + _GetRequestKey(endpoint, parameters)
+		digest = md5(json).hexdigest()
+		previous = self._cache.Get(key)
+		if previous == digest:
+			return
+		self._cache.Set(key, digest)
+		if previous is not None:
+			self._InvalidateRequests(self._GetDependentRequests(entity_type, entity_id),
+									 self._cascade_refresh)
+		
+	def _GetRequestUrl(self, url, parameters):
+		'''Add the default and given parameters to url.  Also the cache key.'''
+		extra_params = {}
+		if self._default_params:
+			extra_params.update(self._default_params)
+		if parameters:
+			extra_params.update(parameters)
+		return self._BuildUrl(url, extra_params=extra_params)
+		
+	def _IsCached(self, endpoint, parameters):
+		'''Check whether a request would be answered without going upstream.'''
+		if self._snapshot:
+			return self._snapshot.Get(endpoint, parameters) is not None
+		cache_timeout = self._GetCacheTimeout(endpoint, parameters)
+		if not self._cache or not cache_timeout:
+			return False
+		last_cached = self._cache.GetCachedTime(
+			self._GetRequestUrl('%s/%s' % (self.base_url, endpoint), parameters))
+		return bool(last_cached) and time.time() < last_cached + cache_timeout
+		
+	def _GetCacheTimeout(self, endpoint, parameters):
+		'''Return how long a response from endpoint should be reused.'''
+		if self._cache_policy:
+			timeout = self._cache_policy.GetTimeout(endpoint, parameters)
+			if timeout is not None:
+				return timeout
+		return self._cache_timeout
+		
+	def _GetMissingKey(self, entity_type, entity_id):
+		return 'missing:%s:%s' % (entity_type, entity_id)
+		
+	def _GetMissingError(self, entity_type, entity_id):
+		'''Return the cached error for a known-missing id, or None.'''
+		if not self._negative_cache_timeout or not self._cache or self._snapshot:
+			return None
+		key = self._GetMissingKey(entity_type, entity_id)
+		self._RefreshMissingShard(self._missing.GetShard(key))
+		# Most ids were never missing; the filter says so without any I/O
+		if key not in self._missing:
+			return None
+		last_cached = self._cache.GetCachedTime(key)
+		if not last_cached or time.time() >= last_cached + self._negative_cache_timeout:
+			return None
+		return self._cache.Get(key)
+		
+	def _RecordMissing(self, entity_type, entity_id, error):
+		if not self._negative_cache_timeout or not self._cache or self._snapshot:
+			return
+		key = self._GetMissingKey(entity_type, entity_id)
+		if isinstance(error, unicode):
+			error = error.encode('utf-8')
+		self._cache.Set(key, str(error))
+		self._SaveMissingShard(self._missing.Add(key))
+		
+	def _ForgetMissing(self, entity_type, entity_id):
+		'''Drop the negative entry for an id that has turned up after all,
+		along with any cached responses for it.'''
+		if not self._cache or self._snapshot:
+			return
+		key = self._GetMissingKey(entity_type, entity_id)
+		self._RefreshMissingShard(self._missing.GetShard(key))
+		# Filters can't delete, but the removed entry makes this a miss
+		if key not in self._missing or not self._cache.GetCachedTime(key):
+			return
+		self._cache.Remove(key)
+		for endpoint, parameters, related_type, related_id in _GetEntityRequests(
+				entity_type, entity_id):
+			self._RemoveCached('%s/%s' % (self.base_url, endpoint), parameters)
+			
+	def _RemoveCached(self, url, parameters):
+		'''Drop the cached response to a request, if there is one.'''
+		if self._cache:
+			self._cache.Remove(self._GetRequestUrl(url, parameters))
+			
+	def _GetMissingShardKey(self, shard):
+		return 'missing-index:%d' % shard
+		
+	def _RefreshMissingShard(self, shard):
+		'''Merge in a shard of the missing-id filter that others have saved.'''
+		now = time.time()
+		checked, merged = self._missing_shards.get(shard, (0, None))
+		if now - checked < Api.MISSING_INDEX_REFRESH:
+			return
+		key = self._GetMissingShardKey(shard)
+		last_cached = self._cache.GetCachedTime(key)
+		if last_cached and last_cached != merged:
+			data = self._cache.Get(key)
+			if data:
+				self._missing.MergeShard(shard, data)
+		self._missing_shards[shard] = (now, last_cached or merged)
+		
+	def _SaveMissingShard(self, shard):
+		'''Save a shard of the missing-id filter, merged with the saved copy.'''
+		key = self._GetMissingShardKey(shard)
+		lock = None
+		if hasattr(self._cache, 'Lock'):
+			lock = self._cache.Lock(key)
+		try:
+			data = self._cache.Get(key)
+			if data:
+				self._missing.MergeShard(shard, data)
+			self._cache.Set(key, self._missing.GetShardData(shard))
+		finally:
+			if lock:
+				lock.Release()
+		self._missing_shards[shard] = (time.time(), self._cache.GetCachedTime(key))
+			
+	def _FetchUrl(self,
+				  url,
+				  post_data=None,
+				  parameters=None,
+				  no_cache=None,
+				  cache_timeout=None,
+				  prefetch=False,
+				  deadline=None,
+				  priority=PRIORITY_NORMAL):
+		'''Fetch a URL, optional caching for a sepcified time.
+		
+		Args:
+			url:
+				The URL to retrieve
+			post_data:
+				A dict of (str, unicode) key/value pairs.
+				If set, POST will be used [Optional]
+			parameters:
+				A dict whose key/value pairs should be encoded
+				and added to the query string. [Optional]
+			no_cache:
+				If true, overrides the cache on the current request.
+			cache_timeout:
+				Time, in seconds, to reuse this response for.  Defaults to
+				the Api's cache timeout. [Optional]
+			prefetch:
+				If true, only warm the cache: an already cached response
+				is left unread and None is returned. [Optional]
+			deadline:
+				A bandcamp.Deadline to finish within.  Once it runs out, an
+				expired cached response may be served instead. [Optional]
+			priority:
+				The priority of the request for the scheduler. [Optional]
+				
+		Returns:
+			A string containing the body of the response.
+		'''
+		if cache_timeout is None:
+			cache_timeout = self._cache_timeout
+		request = FetchRequest(self._GetRequestUrl(url, parameters),
+							   self._EncodePostData(post_data),
+							   no_cache, cache_timeout, prefetch, deadline, priority)
+		return self._pipeline(request).body
+		
+	def _BuildPipeline(self):
+		'''Compose the middleware, cache and transport into one callable.
+		
+		Done whenever the middleware changes, so a fetch only pays one
+		function call per layer.
+		'''
+		handler = self._Transport
+		for middleware in reversed(self._network_middleware):
+			handler = _BindMiddleware(middleware.Handle, handler)
+		handler = _BindMiddleware(self._HandleCache, handler)
+		for middleware in reversed(self._middleware):
+			handler = _BindMiddleware(middleware.Handle, handler)
+		self._pipeline = handler
+		
+	def _HandleCache(self, request, next):
+		'''The cache layer of the fetch pipeline.
+		
+		Answers request from the cache when it can, and otherwise passes it
+		on, after setting request.cache_key so the transport can stream the
+		body into the cache.  A cache with a Lock method, such as a
+		_FileCache with locking on, is locked while a stale entry is
+		refetched, so processes sharing it don't all fetch it at once.
+		'''
+		# Open and return the URL immediately if we're not going to cache
+		if (request.post_data or request.no_cache or not self._cache or
+			not request.cache_timeout):
+			try:
+				return next(request)
+			except Exception, e:
+				if not _IsTimeout(e) or isinstance(e, BandcampTimeoutError):
+					raise
+				raise BandcampTimeoutError(str(e))
+		
+		# The developer key is only added when the request is sent, so
+		# every key shares the cached responses
+		key = request.url
+		cache_timeout = request.cache_timeout
+		prefetch = request.prefetch
+			
+		# See if it has been cached before
+		last_cached = self._cache.GetCachedTime(key)
+		
+		# A prefetch of this same response may be about to land
+		if (self._prefetcher and not prefetch and
+			(not last_cached or time.time() >= last_cached + cache_timeout) and
+			self._prefetcher.WaitFor(key, request.deadline)):
+			last_cached = self._cache.GetCachedTime(key)
+		
+		# Another process sharing the cache may be fetching it already
+		lock = None
+		if ((not last_cached or time.time() >= last_cached + cache_timeout) and
+			hasattr(self._cache, 'Lock')):
+			lock = self._cache.Lock(key, request.deadline)
+			if lock:
+				last_cached = self._cache.GetCachedTime(key)
+		try:
+			return self._HandleCacheLocked(request, next, key, last_cached)
+		finally:
+			if lock:
+				lock.Release()
+			
+	def _HandleCacheLocked(self, request, next, key, last_cached):
+		'''The rest of _HandleCache, once any cache lock on key is held.'''
+		cache_timeout = request.cache_timeout
+		prefetch = request.prefetch
+		
+		# If the cached version is outdated then fetch another and store it
+		if not last_cached or time.time() >= last_cached + cache_timeout:
+			if prefetch and not self._prefetcher.StartFetch(key):
+				self._prefetcher.NoteSkipped()
+				return FetchResponse(None, from_cache=True)
+			fetched = False
+			request.cache_key = key
+			try:
+				try:
+					response = next(request)
+					if not response.stored:
+						self._cache.Set(key, response.body)
+					fetched = True
+				except Exception, e:
+					if not _IsTimeout(e):
+						raise
+					# Better late data than none, if the caller allows it
+					if not (self._serve_stale and last_cached and not prefetch):
+						raise BandcampTimeoutError(str(e))
+					response = FetchResponse(self._cache.Get(key), from_cache=True,
+											 stale=True)
+			finally:
+				if prefetch:
+					self._prefetcher.FinishFetch(key, fetched)
+			return response
+		elif prefetch:
+			self._prefetcher.NoteSkipped()
+			return FetchResponse(None, from_cache=True)
+		if self._prefetcher:
+			self._prefetcher.NoteHit(key)
+		return FetchResponse(self._cache.Get(key), from_cache=True)
+		
+	def _Transport(self, request):
+		'''The last layer of the fetch pipeline: send request upstream.'''
+		_debug = 0
+		if self._debugHTTP:
+			_debug = 1
+			
+		http_handler = self._urllib.HTTPHandler(debuglevel=_debug)
+		https_handler = self._urllib.HTTPSHandler(debuglevel=_debug)
+		
+		opener = self._urllib.OpenerDirector()
+		opener.add_handler(http_handler)
+		opener.add_handler(https_handler)
+		try:
+			url_data = self._OpenAndRead(opener, request.url, request.post_data,
+										 cache_key=request.cache_key,
+										 deadline=request.deadline,
+										 priority=request.priority)
+		finally:
+			opener.close()
+		return FetchResponse(url_data, stored=request.cache_key is not None)
+		
+	def _BuildUrl(self, url, path_elements=None, extra_params=None):
+		# Break url into consituent parts
+		(scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+		
+		# Add any additional path elements to the path
+		if path_elements:
+			#Filter out the path elements that have a value of None
+			p = [i for i in path_elemnts if i]
+			if not path.endswith('/'):
+				path += '/'
+			path += '/'.join(p)
+		
+		# Add any additional query parameters to the query string
+		if extra_params and len(extra_params) > 0:
+			extra_query = self._EncodeParameters(extra_params)
+			# Add it to the existing query
+			if query:
+				query += '&' + extra_query
+			else:
+				query = extra_query
+		
+		# Return the rebuilt URL
+		return urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
+
+	def _OpenAndRead(self, opener, url, encoded_post_data, cache_key=None,
+					 deadline=None, priority=PRIORITY_NORMAL):
+		'''Open a URL, asking for a gzipped response, and read the body.
+		
+		The body is decompressed as it arrives.  If cache_key is set and the
+		cache supports streaming writes, each chunk is also written into the
+		cache as it is read, instead of the whole body being written out
+		again afterwards.  The chunks are joined into the returned string,
+		so the decompressed body is briefly held twice.
+		
+		Args:
+			opener:
+				The urllib2.OpenerDirector used to open the URL.
+			url:
+				The URL to retrieve.
+			encoded_post_data:
+				The URL-encoded POST body, or None for a GET.
+			cache_key:
+				The key to store the body under in the cache. [Optional]
+			deadline:
+				A bandcamp.Deadline to finish within. [Optional]
+			priority:
+				The priority of the request for the scheduler. [Optional]
+				
+		Returns:
+			A string containing the decompressed body of the response.
+		'''
+		scheduler = self._scheduler
+		if scheduler:
+			scheduler.Acquire(priority, deadline)
+		try:
+			return self._OpenWithKey(opener, url, encoded_post_data, cache_key, deadline)
+		finally:
+			if scheduler:
+				scheduler.Release(priority)
+			
+	def _OpenWithKey(self, opener, url, encoded_post_data, cache_key, deadline):
+		'''Add a developer key to url, from the key pool if there is one, and read it.'''
+		key_pool = self._key_pool
+		if not key_pool:
+			if self._developer_key:
+				url = self._BuildUrl(url, extra_params={'key': self._developer_key})
+			return self._OpenAndReadLimited(opener, url, encoded_post_data,
+											cache_key, deadline)
+		while True:
+			developer_key = key_pool.Acquire(deadline)
+			try:
+				url_data = self._OpenAndReadLimited(
+					opener, self._BuildUrl(url, extra_params={'key': developer_key}),
+					encoded_post_data, cache_key, deadline)
+			except urllib2.HTTPError, e:
+				if e.code not in (429, 503):
+					raise
+				key_pool.MarkThrottled(developer_key, e.hdrs and e.hdrs.get('Retry-After'))
+				if not key_pool.HasAvailable():
+					raise
+				continue
+			key_pool.MarkSucceeded(developer_key)
+			return url_data
+		
+	def _OpenAndReadLimited(self, opener, url, encoded_post_data, cache_key,
+							deadline):
+		'''Make one upstream attempt under the adaptive concurrency limit.
+		
+		Each attempt reports its own outcome, so a throttled attempt that is
+		retried under another developer key still backs the limit off.
+		'''
+		concurrency = self._concurrency
+		if not concurrency:
+			return self._OpenAndReadScheduled(opener, url, encoded_post_data,
+											  cache_key, deadline)
+		concurrency.Acquire(deadline)
+		outcome = 'error'
+		start = time.time()
+		try:
+			try:
+				url_data = self._OpenAndReadScheduled(opener, url, encoded_post_data,
+													  cache_key, deadline)
+				outcome = 'ok'
+				return url_data
+			except urllib2.HTTPError, e:
+				if e.code in (429, 503):
+					outcome = 'throttled'
+				raise
+			except Exception, e:
+				if _IsTimeout(e):
+					outcome = 'timeout'
+				raise
+		finally:
+			concurrency.Release(outcome, time.time() - start)
+		
+	def _OpenAndReadScheduled(self, opener, url, encoded_post_data, cache_key,
+							  deadline):
+		request = self._urllib.Request(url, encoded_post_data,
+									   {'Accept-Encoding': 'gzip'})
+		connect_timeout = self._GetTimeout(self._connect_timeout, deadline)
+		if connect_timeout is None:
+			response = opener.open(request)
+		else:
+			response = opener.open(request, timeout=connect_timeout)
+		# The opener has no HTTPErrorProcessor, so error responses come back
+		# like any other; raise them here so they never reach the cache
+		code = getattr(response, 'code', None)
+		if code is not None and not 200 <= code < 300:
+			raise urllib2.HTTPError(url, code, getattr(response, 'msg', ''),
+									response.info(), response)
+		
+		# The connect timeout is set on the socket itself, and bounded the
+		# wait for the headers too; the body gets the read timeout instead
+		read_timeout = self._GetTimeout(self._read_timeout, deadline)
+		if read_timeout is not None or connect_timeout is not None:
+			_SetReadTimeout(response, read_timeout)
+		
+		writer = None
+		if cache_key is not None and hasattr(self._cache, 'Open'):
+			writer = self._cache.Open(cache_key)
+		
+		chunks = []
+		try:
+			for chunk in self._IterDecompressedResponse(response):
+				chunks.append(chunk)
+				if writer:
+					writer.write(chunk)
+				if deadline and deadline.Expired():
+					raise BandcampTimeoutError('Deadline expired reading %s' % url)
+		except:
+			if writer:
+				writer.abort()
+			raise
+		
+		url_data = ''.join(chunks)
+		del chunks
+		
+		if writer:
+			writer.commit()
+		elif cache_key is not None:
+			self._cache.Set(cache_key, url_data)
+		return url_data
 
-	def SetCacheTimeout(self, cache_timeout):
-		'''Override the default cache timeout.
+	def _GetTimeout(self, timeout, deadline):
+		'''Cap a socket timeout by what is left of a deadline.
+		
+		Raises:
+			BandcampTimeoutError if the deadline has already run out.
+		'''
+		if deadline is None:
+			return timeout
+		remaining = deadline.Remaining()
+		if remaining <= 0:
+			raise BandcampTimeoutError('Deadline expired')
+		if timeout is None:
+			return remaining
+		return min(timeout, remaining)
+
+	def _IterDecompressedResponse(self, response):
+		'''Yield the body of a response in decompressed chunks.'''
+		decompressor = None
+		if response.headers.get('content-encoding', None) == 'gzip':
+			# 16 + MAX_WBITS tells zlib to expect a gzip header and trailer
+			decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+		
+		while True:
+			chunk = response.read(self._READ_CHUNK_SIZE)
+			if not chunk:
+				break
+			if decompressor:
+				chunk = decompressor.decompress(chunk)
+			if chunk:
+				yield chunk
+		
+		if decompressor:
+			chunk = decompressor.flush()
+			if chunk:
+				yield chunk
+
+	def _Encode(self, s):
+		'''if self._input_encoding:
+			return unicode(s, self._input_encoding).encode('utf-8')
+		else:'''
+		return unicode(s).encode('utf-8')
 
+	def _EncodeParameters(self, parameters):
+		'''Return a string in key=value&key=value form
+		
+		Values of None are not included in the output string.
+		
 		Args:
-			cache_timeout:
-				Time, in seconds, that response should be reused.
+			parameters:
+				A dict of (key, value) tuples, where value is encoded as
+				specified by self._encoding
+				
+		Returns:
+			A URL-encoded string in "key=value&key=value" form
 		'''
-		self._cache_timeout = cache_timeout
+		
+		if parameters is None:
+			return None
+		else:
+			return urllib.urlencode(dict([(k, self._Encode(v)) for k, v in parameters.items() if v is not None]))
+	
+	def _EncodePostData(self, post_data):
+		'''Return a string in key=value&key=value form
+		
+		Values are assumed to be encoded in the format sprecified by self._encoding,
+		and are subsequently URL encoded.
+		
+		Args:
+			post_data:
+				A dict of (key, value) tuples, where value is encoded as specified by self._encoding
+				
+		Returns:
+			A URL-encoded string in "key=value&key=value" form
+		'''
+		if post_data is None:
+			return None
+		else:
+			return urllib.urlencode(dict([(k, self._Encode(v)) for k, v in post_data.items()]))
+
+class RequestPlan(object):
+	'''A set of upstream calls chosen to fetch a mixed set of entities.
+	
+	Made by Api.Plan.  Each step is one API call, marked cached if it
+	will be answered from the cache, and lists the requested entities it
+	covers.  Results are keyed by ('band', band id or url),
+	('album', album id) and ('track', track id), as requested.
+	'''
+	
+	def __init__(self, api, band_ids=(), band_urls=(), album_ids=(), track_ids=()):
+		self._api = api
+		self._steps = []
+		self._requested = 0
+		self._PlanBands(band_ids, band_urls)
+		self._PlanAlbumsAndTracks(album_ids, track_ids)
+		
+	def GetSteps(self):
+		'''Return the steps as (endpoint, parameters, cached, covers, reason) tuples.'''
+		return [(step.endpoint, step.parameters, step.cached, step.covers, step.reason)
+				for step in self._steps]
+		
+	def GetUpstreamCalls(self):
+		'''Return the number of steps that will go upstream.'''
+		return len([step for step in self._steps if not step.cached])
+		
+	def Explain(self):
+		'''Return a readable description of the plan and why it was chosen.'''
+		lines = []
+		for i, step in enumerate(self._steps):
+			lines.append('%d. %s %s [%s] -> %s: %s' % (
+				i + 1, step.endpoint, _GetRequestKey('', step.parameters)[1:],
+				step.cached and 'cached' or 'fetch',
+				', '.join('%s %s' % key for key in step.covers), step.reason))
+		upstream = self.GetUpstreamCalls()
+		lines.append('%d entities requested: %d upstream calls, %d from the cache, '
+					 '%d calls saved by folding' % (
+					 self._requested, upstream, len(self._steps) - upstream,
+					 self._requested - len(self._steps)))
+		return '\n'.join(lines)
+		
+	def Execute(self, deadline=None, priority=PRIORITY_NORMAL, max_workers=None):
+		'''Run the steps concurrently.
+		
+		Args:
+			deadline:
+				A bandcamp.Deadline, or seconds, for the whole plan. [Optional]
+			priority:
+				The priority of every request, for the scheduler. [Optional]
+			max_workers:
+				The most steps to run at once, as for Api.GetAlbums. [Optional]
+				
+		Returns:
+			A dict mapping each requested entity to its model, or to the
+			BandcampError raised fetching it.
+		'''
+		deadline = _AsDeadline(deadline)
+		results = {}
+		def Run(step):
+			try:
+				results.update(step.Run(self._api, deadline, priority))
+			except BandcampError, e:
+				for key in step.covers:
+					results[key] = e
+		if max_workers is None:
+			if self._api._concurrency:
+				max_workers = self._api._concurrency.maximum
+			else:
+				max_workers = Api.DEFAULT_BULK_WORKERS
+		_ParallelMap(Run, self._steps, max_workers)
+		return results
+		
+	def _AddStep(self, endpoint, parameters, covers, reason):
+		self._steps.append(_PlanStep(endpoint, parameters, covers, reason,
+									 self._api._IsCached(endpoint, parameters)))
+		
+	def _PlanBands(self, band_ids, band_urls):
+		# Urls already resolved share a call with the same band id
+		bands = collections.OrderedDict()
+		for band_id in band_ids:
+			bands.setdefault(('band_id', band_id), []).append(('band', band_id))
+		for band_url in band_urls:
+			parameters, band_id, band_host = self._api._GetBandParameters(None, None, band_url)
+			if band_id:
+				bands.setdefault(('band_id', band_id), []).append(('band', band_url))
+			else:
+				bands.setdefault(('band_url', band_host), []).append(('band', band_url))
+		for (name, value), covers in bands.items():
+			covers = _Unique(covers)
+			self._requested += len(covers)
+			if len(covers) > 1:
+				reason = 'one call for %d names of the same band' % len(covers)
+			else:
+				reason = 'band info'
+			self._AddStep('band/1/info', {name: value}, covers, reason)
 			
-	def SetUrllib(self, urllib):
-		'''Override the default urllib implmentation.
+	def _PlanAlbumsAndTracks(self, album_ids, track_ids):
+		album_ids = _Unique(album_ids)
+		track_ids = _Unique(track_ids)
+		self._requested += len(album_ids) + len(track_ids)
+		requested_albums = set(album_ids)
+		tracks_by_album = collections.OrderedDict()
+		loose_tracks = []
+		for track_id in track_ids:
+			album_id = self._api._relations.GetParent('track', track_id, 'album')
+			if album_id is None:
+				loose_tracks.append(track_id)
+			else:
+				tracks_by_album.setdefault(album_id, []).append(track_id)
+		for album_id in album_ids + [x for x in tracks_by_album if x not in requested_albums]:
+			tracks = tracks_by_album.get(album_id, [])
+			parameters = {'album_id': album_id}
+			covers = [('track', x) for x in tracks]
+			if album_id in requested_albums:
+				covers.insert(0, ('album', album_id))
+				if tracks:
+					reason = 'album info, also covers %d requested tracks' % len(tracks)
+				else:
+					reason = 'album info'
+			elif self._api._IsCached('album/1/info', parameters):
+				reason = 'the cached album covers %d requested tracks' % len(tracks)
+			else:
+				# Tracks answered from the cache cost nothing on their own
+				uncached = [x for x in tracks
+							if not self._api._IsCached('track/1/info', {'track_id': x})]
+				if len(uncached) <= 1:
+					loose_tracks.extend(tracks)
+					continue
+				reason = 'one album call instead of %d track calls' % len(uncached)
+				loose_tracks.extend([x for x in tracks if x not in uncached])
+				covers = [('track', x) for x in uncached]
+			self._AddStep('album/1/info', parameters, covers, reason)
+		for track_id in loose_tracks:
+			self._AddStep('track/1/info', {'track_id': track_id}, [('track', track_id)],
+						  'track info')
+
+class _PlanStep(object):
+	'''One API call of a RequestPlan and the requested entities it covers.'''
+	
+	def __init__(self, endpoint, parameters, covers, reason, cached):
+		self.endpoint = endpoint
+		self.parameters = parameters
+		self.covers = covers
+		self.reason = reason
+		self.cached = cached
+		
+	def Run(self, api, deadline, priority):
+		if self.endpoint == 'band/1/info':
+			if 'band_id' in self.parameters:
+				band = api.GetBand(band_id=self.parameters['band_id'], deadline=deadline,
+								   priority=priority)
+			else:
+				band = api.GetBand(band_url=self.parameters['band_url'], deadline=deadline,
+								   priority=priority)
+			return dict((key, band) for key in self.covers)
+		if self.endpoint == 'track/1/info':
+			return {self.covers[0]: api.GetTrack(self.parameters['track_id'], deadline,
+												 priority)}
+		album = api.GetAlbum(self.parameters['album_id'], deadline, priority)
+		tracks = dict((x.id, x) for x in album.tracks or [])
+		results = {}
+		for key in self.covers:
+			entity_type, entity_id = key
+			if entity_type == 'album':
+				results[key] = album
+				continue
+			track = tracks.get(entity_id)
+			if track is None:
+				# The track has moved since it was indexed
+				try:
+					results[key] = api.GetTrack(entity_id, deadline, priority)
+				except BandcampError, e:
+					results[key] = e
+				continue
+			# Tracks listed in album info leave out what the album says
+			if track.album_id is None:
+				track.album_id = album.id
+			if track.band_id is None:
+				track.band_id = album.band_id
+			results[key] = track
+		return results
+
+def _Unique(items):
+	'''Return items as a list, without repeats, in their first order.'''
+	seen = set()
+	unique = []
+	for item in items:
+		if item not in seen:
+			seen.add(item)
+			unique.append(item)
+	return unique
+
+class Gateway(object):
+	'''A local HTTP server that answers Bandcamp API requests for many clients.
+	
+	It serves band/1/info, band/1/discography, album/1/info and
+	track/1/info from one bandcamp.Api, so every client shares its cache,
+	developer keys and rate limit.  Identical requests that arrive while
+	one is being fetched wait for it instead of going upstream again.
+	A POST to batch with a JSON list of request paths, such as
+	"album/1/info?album_id=1", answers them all in one round trip.
+	
+	Point clients at it with base_url:
+	
+		  >>> api = bandcamp.Api('unused', base_url='http://127.0.0.1:8080')
+		  
+	Or start one from the command line:
+	
+		  $ python bandcamp.py --key KEY --port 8080 --rate 10
+	'''
+	
+	DEFAULT_PORT = 8080
+	ENDPOINTS = {'band/1/info': 'band',
+				 'band/1/discography': 'band',
+				 'album/1/info': 'album',
+				 'track/1/info': 'track'}
+	MAX_BATCH_SIZE = 100
+	
+	def __init__(self,
+				api,
+				host='127.0.0.1',
+				port=DEFAULT_PORT,
+				rate=None,
+				max_in_flight=None,
+				max_workers=4):
+		'''Instantiate a new bandcamp.Gateway.
 		
 		Args:
-			urllib:
-				An instance that supporst the same API as the urllib2 module
+			api:
+				The bandcamp.Api to answer requests with.
+			host:
+				The address to listen on. [Optional]
+			port:
+				The port to listen on, or 0 for any free port. [Optional]
+			rate:
+				The most upstream requests per second. [Optional]
+			max_in_flight:
+				The most upstream requests at once.  Defaults to
+				RequestScheduler.DEFAULT_MAX_IN_FLIGHT when rate is set.
+				[Optional]
+			max_workers:
+				The most requests of one batch fetched at once. [Optional]
+		'''
+		self._api = api
+		if rate or max_in_flight:
+			api.SetRequestScheduler(RequestScheduler(
+				max_in_flight or RequestScheduler.DEFAULT_MAX_IN_FLIGHT, rate=rate))
+		self._max_workers = max_workers
+		self._coalescer = _Coalescer()
+		self._lock = threading.Lock()
+		self._stats = {'requests': 0, 'batches': 0, 'errors': 0}
+		self._server = _GatewayServer((host, port), _GatewayRequestHandler)
+		self._server.gateway = self
+		self._thread = None
+		
+	def GetAddress(self):
+		'''Return the (host, port) the gateway is listening on.'''
+		return self._server.server_address
+		
+	def Serve(self):
+		'''Serve requests until Shutdown is called.'''
+		self._server.serve_forever()
+		
+	def Start(self):
+		'''Serve requests from a background thread.'''
+		self._thread = threading.Thread(target=self.Serve)
+		self._thread.setDaemon(True)
+		self._thread.start()
+		
+	def Shutdown(self):
+		'''Stop serving and close the listening socket.'''
+		self._server.shutdown()
+		self._server.server_close()
+		if self._thread:
+			self._thread.join()
+			self._thread = None
+			
+	def GetStats(self):
+		'''Return counts of requests, batches, errors and coalesced requests.'''
+		self._lock.acquire()
+		try:
+			stats = dict(self._stats)
+		finally:
+			self._lock.release()
+		stats['coalesced'] = self._coalescer.GetCoalesced()
+		return stats
+		
+	def Handle(self, endpoint, parameters):
+		'''Answer one API request.
+		
+		Ids the upstream Api found missing are answered as Bandcamp does,
+		with an error object.  Other failures, such as timeouts, throttling
+		and server errors, are answered with a 504 or 502 status, which
+		clients neither cache nor take to mean the id is missing.  Requests
+		without the id they need get a 400 status.
+		
+		Returns:
+			A (HTTP status, python object) tuple.
+		'''
+		self._Count('requests')
+		entity_type = Gateway.ENDPOINTS.get(endpoint)
+		if entity_type is None:
+			self._Count('errors')
+			return 404, {'gateway_error': 'Unknown endpoint: %s' % endpoint}
+		parameters = dict((k, v) for k, v in parameters.items() if k != 'key')
+		if entity_type == 'band':
+			required = ('band_id', 'band_url')
+		else:
+			required = ('%s_id' % entity_type,)
+		if not [x for x in required if parameters.get(x)]:
+			self._Count('errors')
+			return 400, {'gateway_error': '%s requires %s' % (endpoint, ' or '.join(required))}
+		if entity_type == 'band':
+			# Share one cache entry, and one fetch, between a band's urls and id
+			parameters, entity_id, band_host = self._api._GetBandParameters(
+				parameters.get('band_id'), None, parameters.get('band_url'))
+		else:
+			entity_id = parameters.get('%s_id' % entity_type)
+		try:
+			data = self._coalescer.Call(
+				_GetRequestKey(endpoint, parameters),
+				lambda: self._api._FetchJson(endpoint, parameters, entity_type, entity_id))
+		except BandcampTimeoutError, e:
+			self._Count('errors')
+			return 504, {'gateway_error': str(e)}
+		except BandcampError, e:
+			self._Count('errors')
+			if entity_id is not None and self._api.IsKnownMissing(entity_type, entity_id):
+				return 200, {'error': True, 'error_message': str(e)}
+			return 502, {'gateway_error': str(e)}
+		if entity_type == 'band':
+			self._api._LearnBandResponse(endpoint, parameters, band_host, data)
+		return 200, data
 			
+	def HandleBatch(self, paths):
+		'''Answer several API requests, given as paths with query strings.
+		
+		Returns:
+			A list of the answers, in the order of paths.
 		'''
-		self._urllib = urllib
+		self._Count('batches')
+		results = [None] * len(paths)
+		def Handle(i):
+			if not isinstance(paths[i], basestring):
+				self._Count('errors')
+				results[i] = {'gateway_error': 'Not a request path: %r' % (paths[i],)}
+				return
+			endpoint, parameters = _ParseGatewayPath(paths[i])
+			results[i] = self.Handle(endpoint, parameters)[1]
+		_ParallelMap(Handle, range(len(paths)), self._max_workers)
+		return results
 		
-	def _InitializeDefaultParameters(self):
-		self._default_params = {}
+	def _Count(self, name):
+		self._lock.acquire()
+		try:
+			self._stats[name] += 1
+		finally:
+			self._lock.release()
+
+def _GetResponseBandId(data):
+	'''Return the band id in a band info or discography response.'''
+	if data.get('band_id'):
+		return data['band_id']
+	for x in data.get('discography') or []:
+		if x.get('band_id'):
+			return x['band_id']
+	return None
+
+def _ParseGatewayPath(path):
+	'''Split a request path into an endpoint and a dict of parameters.
+	
+	Leading slashes and an api/ prefix are dropped, so both base_url
+	'http://host:port' and 'http://host:port/api/' work.
+	'''
+	(scheme, netloc, path, query, fragment) = urlparse.urlsplit(path)
+	endpoint = path.lstrip('/')
+	if endpoint.startswith('api/'):
+		endpoint = endpoint[len('api/'):].lstrip('/')
+	return endpoint, dict(parse_qsl(query))
+
+class _Coalescer(object):
+	'''Runs one call per key at a time; callers with the same key share it.'''
+	
+	def __init__(self):
+		self._lock = threading.Lock()
+		# key -> [done event, result, exception]
+		self._calls = {}
+		self._coalesced = 0
+		
+	def Call(self, key, function):
+		self._lock.acquire()
+		try:
+			call = self._calls.get(key)
+			leader = call is None
+			if leader:
+				call = self._calls[key] = [threading.Event(), None, None]
+			else:
+				self._coalesced += 1
+		finally:
+			self._lock.release()
+		if leader:
+			try:
+				call[1] = function()
+			except Exception, e:
+				call[2] = e
+			self._lock.acquire()
+			try:
+				del self._calls[key]
+			finally:
+				self._lock.release()
+			call[0].set()
+		else:
+			call[0].wait()
+		if call[2] is not None:
+			raise call[2]
+		return call[1]
+		
+	def GetCoalesced(self):
+		return self._coalesced
+
+class _GatewayServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+class _GatewayRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''Serves one client connection for a Gateway.'''
+	
+	protocol_version = 'HTTP/1.1'
+	
+	_GZIP_THRESHOLD = 1024 # don't compress responses under 1KB
+	
+	def do_GET(self):
+		endpoint, parameters = _ParseGatewayPath(self.path)
+		status, data = self.server.gateway.Handle(endpoint, parameters)
+		self._Reply(status, data)
+		
+	def do_POST(self):
+		endpoint, parameters = _ParseGatewayPath(self.path)
+		if endpoint != 'batch':
+			self._Reply(404, {'gateway_error': 'POST only serves batch'})
+			return
+		try:
+			paths = simplejson.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+		except ValueError, e:
+			self._Reply(400, {'gateway_error': str(e)})
+			return
+		if (not isinstance(paths, list) or len(paths) > Gateway.MAX_BATCH_SIZE or
+			[x for x in paths if not isinstance(x, basestring)]):
+			self._Reply(400, {'gateway_error':
+							  'A batch is a JSON list of at most %d paths' % Gateway.MAX_BATCH_SIZE})
+			return
+		self._Reply(200, self.server.gateway.HandleBatch(paths))
+		
+	def _Reply(self, status, data):
+		body = simplejson.dumps(data)
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		if (len(body) >= self._GZIP_THRESHOLD and
+			'gzip' in self.headers.get('Accept-Encoding', '')):
+			compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+			body = compressor.compress(body) + compressor.flush()
+			self.send_header('Content-Encoding', 'gzip')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+		
+	def log_message(self, format, *args):
+		pass
+
+def _NormalizeBandUrl(band_url):
+	'''Reduce a band subdomain or any url on a band's site to its host.
+	
+	'foo', 'foo.bandcamp.com' and 'http://Foo.bandcamp.com/album/bar' all
+	normalize to 'foo.bandcamp.com'.  Custom domains keep their own host.
+	'''
+	band_url = band_url.strip().lower()
+	if '://' not in band_url:
+		if '.' not in band_url and '/' not in band_url:
+			band_url += '.bandcamp.com'
+		band_url = 'http://' + band_url
+	host = urlparse.urlparse(band_url)[1].split(':')[0]
+	if host.startswith('www.'):
+		host = host[4:]
+	return host
+
+class _ResolutionIndex(object):
+	'''Maps normalized band hosts to band ids.
+	
+	Mappings don't change, so they are kept in memory and written to the
+	cache, when there is one, under keys that never expire.
+	'''
+	
+	def __init__(self, cache=None):
+		self._cache = cache
+		self._band_ids = {}
+		
+	def Get(self, band_host):
+		band_id = self._band_ids.get(band_host)
+		if band_id is None and self._cache:
+			data = self._cache.Get(self._GetKey(band_host))
+			if data:
+				band_id = self._band_ids[band_host] = simplejson.loads(data)
+		return band_id
+		
+	def _GetKey(self, band_host):
+		return 'resolve:%s' % band_host.encode('utf-8')
+		
+	def Learn(self, band_host, band_id):
+		if not band_host or band_id is None or self._band_ids.get(band_host) == band_id:
+			return
+		self._band_ids[band_host] = band_id
+		if self._cache:
+			self._cache.Set(self._GetKey(band_host), simplejson.dumps(band_id))
+
+def _GetEntityRequests(entity_type, entity_id):
+	'''List the requests, as (endpoint, parameters, type, id), that fetch an entity.'''
+	parameters = {'%s_id' % entity_type: entity_id}
+	if entity_type == 'band':
+		return [('band/1/info', parameters, entity_type, entity_id),
+				('band/1/discography', parameters, entity_type, entity_id)]
+	return [('%s/1/info' % entity_type, parameters, entity_type, entity_id)]
+
+class _RelationIndex(object):
+	'''Records which bands hold which albums and tracks, and which albums
+	hold which tracks.
+	
+	Kept like the _ResolutionIndex: in memory, and in the cache under keys
+	that never expire, one per entity with both its parents and children.
+	'''
+	
+	def __init__(self, cache=None):
+		self._cache = cache
+		# (type, id) -> {'parents': [(type, id)], 'children': [(type, id)]}
+		self._relations = {}
+		# (type, id) -> set of ('parents' or 'children', (type, id))
+		self._known = {}
+		self._lock = threading.Lock()
+		
+	def GetParents(self, entity_type, entity_id):
+		return list(self._Get((entity_type, entity_id))['parents'])
+		
+	def GetChildren(self, entity_type, entity_id):
+		return list(self._Get((entity_type, entity_id))['children'])
+		
+	def GetParent(self, entity_type, entity_id, parent_type):
+		'''Return the id of the first parent of parent_type, or None.'''
+		for related_type, related_id in self._Get((entity_type, entity_id))['parents']:
+			if related_type == parent_type:
+				return related_id
+		return None
+		
+	def Learn(self, relations):
+		'''Record (parent, child) pairs of (type, id) entities.
+		
+		Each entity that gained a relation is written to the cache once,
+		however many pairs name it.
+		'''
+		changed = set()
+		self._lock.acquire()
+		try:
+			for parent, child in relations:
+				if parent[1] is None or child[1] is None:
+					continue
+				if self._Add(parent, 'children', child):
+					changed.add(parent)
+				if self._Add(child, 'parents', parent):
+					changed.add(child)
+			updates = [(self._GetKey(x), simplejson.dumps(self._relations[x]))
+					   for x in changed]
+		finally:
+			self._lock.release()
+		if self._cache:
+			for key, data in updates:
+				self._cache.Set(key, data)
+			
+	def _Get(self, entity):
+		relations = self._relations.get(entity)
+		if relations is None:
+			relations = {'parents': [], 'children': []}
+			if self._cache:
+				data = self._cache.Get(self._GetKey(entity))
+				if data:
+					for name, related in simplejson.loads(data).items():
+						relations[name] = [tuple(x) for x in related]
+			self._relations[entity] = relations
+			self._known[entity] = set((name, x) for name in relations
+									  for x in relations[name])
+		return relations
+		
+	def _Add(self, entity, name, related):
+		'''Add one relation in memory.  Returns True if it is new.'''
+		relations = self._Get(entity)
+		known = self._known[entity]
+		if (name, related) in known:
+			return False
+		known.add((name, related))
+		relations[name].append(related)
+		return True
+			
+	def _GetKey(self, entity):
+		return 'related:%s:%s' % entity
+
+def _BindMiddleware(handle, next):
+	'''Return a callable that runs handle with next as the rest of the chain.'''
+	return lambda request: handle(request, next)
+
+class _Executor(object):
+	'''A fixed pool of daemon threads running submitted calls for FetchFutures.'''
+	
+	def __init__(self, max_workers):
+		self._queue = Queue.Queue()
+		for i in range(max_workers):
+			worker = threading.Thread(target=self._Run)
+			worker.setDaemon(True)
+			worker.start()
+			
+	def Submit(self, future, function):
+		self._queue.put((future, function))
 		
-	def _CheckForBandcampError(self, data):
-		'''Raises a BandcampError if bandcamp returns an error message.
+	def _Run(self):
+		while True:
+			future, function = self._queue.get()
+			try:
+				result = function()
+			except:
+				future._Finish(error=sys.exc_info())
+			else:
+				future._Finish(result)
+
+def _IsTimeout(error):
+	'''Check whether an exception from fetching a URL was a timeout.'''
+	if isinstance(error, (BandcampTimeoutError, socket.timeout)):
+		return True
+	# urllib2 wraps timeouts while connecting in a URLError
+	return (isinstance(error, urllib2.URLError) and
+			isinstance(getattr(error, 'reason', None), socket.timeout))
+
+def _SetReadTimeout(response, timeout):
+	'''Set the timeout of the socket under a urllib2 response, if found.
+	
+	urllib2 nests the socket a few file objects deep, so look for it.
+	'''
+	fp = response
+	for i in range(5):
+		if hasattr(fp, 'settimeout'):
+			fp.settimeout(timeout)
+			return
+		fp = getattr(fp, 'fp', None) or getattr(fp, '_sock', None)
+		if fp is None:
+			return
+
+def _ParallelMap(function, items, max_workers):
+	'''Call function on every item, from up to max_workers threads.
+	
+	The first exception raised by function is raised again here, once
+	every worker has stopped; the remaining items are skipped.
+	'''
+	items = list(items)
+	if max_workers <= 1 or len(items) <= 1:
+		for item in items:
+			function(item)
+		return
+	queue = Queue.Queue()
+	for item in items:
+		queue.put(item)
+	errors = []
+	def Work():
+		while not errors:
+			try:
+				item = queue.get_nowait()
+			except Queue.Empty:
+				return
+			try:
+				function(item)
+			except:
+				errors.append(sys.exc_info())
+	workers = [threading.Thread(target=Work) for i in range(min(max_workers, len(items)))]
+	for worker in workers:
+		worker.setDaemon(True)
+		worker.start()
+	for worker in workers:
+		worker.join()
+	if errors:
+		raise errors[0][0], errors[0][1], errors[0][2]
+
+class _RateLimiter(object):
+	'''A token bucket that lets through rate calls per second on average.'''
+	
+	def __init__(self, rate, burst=1):
+		self._rate = float(rate)
+		self._burst = burst
+		self._tokens = burst
+		self._last = time.time()
+		self._lock = threading.Lock()
 		
-		Args:
-			data:
-				A python dict created from the Bandcamp json response
-				
-		Raises:
-			BandcampError wrapping the bandcamp error message if one exists.
-		'''
+	def Wait(self):
+		'''Block until the caller may make one call.'''
+		self._lock.acquire()
+		try:
+			now = time.time()
+			self._tokens = min(self._burst,
+							   self._tokens + (now - self._last) * self._rate)
+			self._last = now
+			# Going negative reserves a future token for this caller
+			self._tokens -= 1
+			delay = max(-self._tokens / self._rate, 0)
+		finally:
+			self._lock.release()
+		if delay:
+			time.sleep(delay)
+
+class _Prefetcher(object):
+	'''Warms an Api's cache on background threads, per a PrefetchPolicy.'''
+	
+	def __init__(self, api, policy):
+		self.policy = policy
+		self._api = api
+		self._queue = Queue.Queue(policy.max_queue)
+		self._rate_limiter = None
+		if policy.rate:
+			self._rate_limiter = _RateLimiter(policy.rate)
+		self._lock = threading.Lock()
+		self._in_flight = {}
+		# Request keys queued or being worked on, so each is submitted once
+		self._pending = set()
+		# Keys fetched by a prefetch that no later call has been served yet
+		self._unused = set()
+		self._stats = dict.fromkeys(('submitted', 'dropped', 'skipped',
+									 'fetched', 'errors', 'hits'), 0)
+		self._workers = []
+		for i in range(policy.max_workers):
+			worker = threading.Thread(target=self._Work, name='bandcamp-prefetch-%d' % i)
+			worker.setDaemon(True)
+			worker.start()
+			self._workers.append(worker)
+			
+	def Submit(self, endpoint, parameters, entity_type, entity_id, deadline=None):
+		if self._api.IsKnownMissing(entity_type, entity_id):
+			self._Count('skipped')
+			return
+		request_key = _GetRequestKey(endpoint, parameters)
+		self._lock.acquire()
+		try:
+			if request_key in self._pending:
+				self._stats['skipped'] += 1
+				return
+			self._pending.add(request_key)
+		finally:
+			self._lock.release()
+		try:
+			self._queue.put_nowait((endpoint, parameters, entity_type, entity_id,
+									deadline))
+		except Queue.Full:
+			self._Done(request_key)
+			self._Count('dropped')
+			return
+		self._Count('submitted')
 		
-		# Bandcamp errors are relatively unlikely, so it is faster
-		# to check first, rather than try and catch the exception.
-		if 'error' in data:
-			raise BandcampError(data['error'])
+	def Close(self):
+		'''Stop the workers once they finish what is already queued.'''
+		for worker in self._workers:
+			self._queue.put(None)
 			
-	def _FetchUrl(self,
-				  url,
-				  post_data=None,
-				  parameters=None,
-				  no_cache=None):
-		'''Fetch a URL, optional caching for a sepcified time.
+	def StartFetch(self, key):
+		'''Mark key as being prefetched.
 		
-		Args:
-			url:
-				The URL to retrieve
-			post_data:
-				A dict of (str, unicode) key/value pairs.
-				If set, POST will be used [Optional]
-			parameters:
-				A dict whose key/value pairs should be encoded
-				and added to the query string. [Optional]
-			no_cache:
-				If true, overrides the cache on the current request.
-				
 		Returns:
-			A string containing the body of the response.
+			False, leaving it alone, if key is being prefetched already.
 		'''
+		self._lock.acquire()
+		try:
+			if key in self._in_flight:
+				return False
+			self._in_flight[key] = threading.Event()
+			return True
+		finally:
+			self._lock.release()
+			
+	def FinishFetch(self, key, fetched):
+		self._lock.acquire()
+		try:
+			event = self._in_flight.pop(key)
+			if fetched:
+				self._stats['fetched'] += 1
+				self._unused.add(key)
+			else:
+				self._stats['errors'] += 1
+		finally:
+			self._lock.release()
+		event.set()
 		
-		# Build the extra parameteres dict
-		extra_params = {}
-		if self._default_params:
-			extra_params.update(self._default_params)
-		if parameters:
-			extra_params.update(parameters)
+	def WaitFor(self, key, deadline=None):
+		'''Wait for an in-flight prefetch of key.  Returns True if there was one.'''
+		event = self._in_flight.get(key)
+		if event is None:
+			return False
+		if deadline is None:
+			event.wait()
+		else:
+			event.wait(max(deadline.Remaining(), 0))
+		return True
+		
+	def NoteHit(self, key):
+		self._lock.acquire()
+		try:
+			if key in self._unused:
+				self._unused.remove(key)
+				self._stats['hits'] += 1
+		finally:
+			self._lock.release()
 			
-		http_method = "GET"
-		if post_data:
-			http_method = "POST"
+	def NoteSkipped(self):
+		self._Count('skipped')
 			
-		_debug = 0
-		if self._debugHTTP:
-			_debug = 1
+	def GetStats(self):
+		self._lock.acquire()
+		try:
+			stats = dict(self._stats)
+		finally:
+			self._lock.release()
+		fetched = stats['fetched']
+		stats['hit_ratio'] = fetched and float(stats['hits']) / fetched
+		stats['waste_ratio'] = fetched and float(fetched - stats['hits']) / fetched
+		return stats
+		
+	def _Count(self, name):
+		self._lock.acquire()
+		try:
+			self._stats[name] += 1
+		finally:
+			self._lock.release()
 			
-		http_handler = self._urllib.HTTPHandler(debuglevel=_debug)
-		https_handler = self._urllib.HTTPSHandler(debuglevel=_debug)
+	def _Done(self, request_key):
+		self._lock.acquire()
+		try:
+			self._pending.discard(request_key)
+		finally:
+			self._lock.release()
+			
+	def _Work(self):
+		while True:
+			request = self._queue.get()
+			if request is None:
+				return
+			if self._rate_limiter:
+				self._rate_limiter.Wait()
+			endpoint, parameters, entity_type, entity_id, deadline = request
+			try:
+				# The call that asked for this prefetch has given up already
+				if deadline and deadline.Expired():
+					self._Count('dropped')
+					continue
+				try:
+					self._api._FetchJson(endpoint, parameters, entity_type, entity_id,
+										 prefetch=True, deadline=deadline,
+										 priority=PRIORITY_BACKGROUND)
+				except Exception:
+					# Failures are counted in FinishFetch, or negatively cached;
+					# the foreground call will see them for itself.
+					pass
+			finally:
+				self._Done(_GetRequestKey(endpoint, parameters))
+
+class _IdentityMap(object):
+	'''Keeps at most one live model instance per entity type and id.'''
+	
+	MAX_INTERNED = 100000 # the least recently used values go past this
+	
+	def __init__(self):
+		self._instances = weakref.WeakValueDictionary()
+		# (type, value) -> value, least recently used first
+		self._values = collections.OrderedDict()
+		self._lock = threading.Lock()
 		
-		opener = self._urllib.OpenerDirector()
-		opener.add_handler(http_handler)
-		opener.add_handler(https_handler)
+	def Merge(self, instance):
+		'''Return the canonical instance for instance's entity.
 		
-		url = self._BuildUrl(url, extra_params=extra_params)
-		encoded_post_data = self._EncodePostData(post_data)
+		If an instance for the same entity is already live, the non-None
+		fields of instance are copied onto it and it is returned instead.
+		'''
+		if isinstance(instance, Album) and instance.tracks:
+			instance.tracks = [self.Merge(x) for x in instance.tracks]
+		self._InternFields(instance)
+		if instance.id is None:
+			return instance
 		
-		# Open and return the URL immediately if we're not going to cache
-		if encoded_post_data or no_cache or not self._cache or not self._cache_timeout:
-			response = opener.open(url, encoded_ost_data)
-			url_data = self._DecompressGzippedResponse(response)
-			opener.close()
-		else:
-			# Unique keys are a combination of the url and the developer key
-			if self._developer_key:
-				key = self._developer_key + ':' + url
-			else:
-				key = url
-				
-			# See if it has been cached before
-			last_cached = self._cache.GetCachedTime(key)
+		key = (instance.EXPORT_TYPE, instance.id)
+		self._lock.acquire()
+		try:
+			existing = self._instances.get(key)
+			if existing is None:
+				self._instances[key] = instance
+				return instance
+			for name, value in instance.__dict__.items():
+				if value is not None:
+					existing.__dict__[name] = value
+			return existing
+		finally:
+			self._lock.release()
 			
-			# If the cached version is outdated then fetch another and store it
-			if not last_cached or time.time() >= last_cached + self._cache_timeout:
-				try:
-					response = opener.open(url, encoded_post_data)
-					url_data = self._DecompressGzippedResponse(response)
-					self._cache.Set(key, url_data)
-				except urllib2.HTTPError, e:
-					print e
-				opener.close()
-			else:
-				url_data = self._cache.Get(key)
+	def _InternFields(self, instance):
+		values = self._values
+		self._lock.acquire()
+		try:
+			for name in instance._INTERNED_FIELDS:
+				value = instance.__dict__.get(name)
+				if value is None:
+					continue
+				# Keyed by type too, so True never stands in for 1, nor a
+				# str for a unicode
+				key = (value.__class__, value)
+				interned = values.pop(key, None)
+				if interned is None:
+					interned = value
+					if len(values) >= _IdentityMap.MAX_INTERNED:
+						values.popitem(last=False)
+				values[key] = interned
+				instance.__dict__[name] = interned
+		finally:
+			self._lock.release()
+
+class _BloomFilter(object):
+	'''A fixed-size set of strings that may give false positives.
+	
+	Membership is answered from a bit array with no false negatives, so a
+	miss means the key was definitely never added.  The bits are split
+	into SHARDS shards, and all of a key's bits fall in one of them, so
+	each shard can be saved and merged with other copies on its own.
+	'''
+	
+	SHARDS = 256
+	
+	def __init__(self, capacity, error_rate):
+		# Standard sizing for capacity keys at the given false positive rate
+		num_bits = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+		shard_bytes = max((num_bits // _BloomFilter.SHARDS + 7) // 8, 1)
+		self._shard_bits = shard_bytes * 8
+		self._num_hashes = max(int(round(self._shard_bits * _BloomFilter.SHARDS *
+										 math.log(2) / capacity)), 1)
+		self._shards = [bytearray(shard_bytes) for i in range(_BloomFilter.SHARDS)]
+		self._lock = threading.Lock()
 		
-		# Alwyas return the latest version
-		return url_data
+	def Add(self, key):
+		'''Add key.  Returns the index of the shard that changed.'''
+		shard, positions = self._GetPositions(key)
+		bits = self._shards[shard]
+		self._lock.acquire()
+		try:
+			for position in positions:
+				bits[position >> 3] |= 1 << (position & 7)
+		finally:
+			self._lock.release()
+		return shard
+			
+	def __contains__(self, key):
+		shard, positions = self._GetPositions(key)
+		bits = self._shards[shard]
+		for position in positions:
+			if not bits[position >> 3] & (1 << (position & 7)):
+				return False
+		return True
 		
-	def _BuildUrl(self, url, path_elements=None, extra_params=None):
-		# Break url into consituent parts
-		(scheme, netloc, path, params, query, fragment) = urlparse.urlparse(url)
+	def GetShard(self, key):
+		'''Return the index of the shard holding key's bits.'''
+		return self._GetPositions(key)[0]
 		
-		# Add any additional path elements to the path
-		if path_elements:
-			#Filter out the path elements that have a value of None
-			p = [i for i in path_elemnts if i]
-			if not path.endswith('/'):
-				path += '/'
-			path += '/'.join(p)
+	def GetShardData(self, shard):
+		'''Return a shard's bits as a string, for MergeShard.'''
+		self._lock.acquire()
+		try:
+			return str(self._shards[shard])
+		finally:
+			self._lock.release()
 		
-		# Add any additional query parameters to the query string
-		if extra_params and len(extra_params) > 0:
-			extra_query = self._EncodeParameters(extra_params)
-			# Add it to the existing query
-			if query:
-				query += '&' + extra_query
-			else:
-				query = extra_query
+	def MergeShard(self, shard, data):
+		'''Add the keys of a shard from another filter of the same size.'''
+		bits = self._shards[shard]
+		if len(data) != len(bits):
+			return
+		other = bytearray(data)
+		self._lock.acquire()
+		try:
+			for i in xrange(len(bits)):
+				bits[i] |= other[i]
+		finally:
+			self._lock.release()
 		
-		# Return the rebuilt URL
-		return urlparse.urlunparse((scheme, netloc, path, params, query, fragment))
-
-	def _DecompressGzippedResponse(self, response):
-		raw_data = response.read()
-		if response.headers.get('content-encoding', None) == 'gzip':
-			url_data = gzip.GzipFile(fileobj=StringIO.StringIO(raw_data)).read()
-		else:
-			url_data = raw_data
-		return url_data
-
-	def _Encode(self, s):
-		'''if self._input_encoding:
-			return unicode(s, self._input_encoding).encode('utf-8')
-		else:'''
-		return unicode(s).encode('utf-8')
+	def _GetPositions(self, key):
+		# Double hashing: two 64 bit halves of one md5 give the shard and
+		# every position in it
+		digest = md5(key).hexdigest()
+		first = int(digest[:16], 16)
+		second = int(digest[16:], 16) | 1
+		shard = first % _BloomFilter.SHARDS
+		first //= _BloomFilter.SHARDS
+		return shard, [(first + i * second) % self._shard_bits
+					   for i in xrange(self._num_hashes)]
 
-	def _EncodeParameters(self, parameters):
-		'''Return a string in key=value&key=value form
+class _WriteBehindCache(object):
+	'''Wraps a cache so that Set and Remove return before touching it.
+	
+	Writes wait in a bounded table keyed by cache key, so a key written
+	twice before the flush thread gets to it is only written once, and
+	reads check the table before the wrapped cache.  The table is bounded
+	both in entries and in bytes of data; one entry is always let in,
+	however big.
+	'''
+	
+	DEFAULT_MAX_PENDING = 1000
+	DEFAULT_MAX_PENDING_BYTES = 64 * 1024 * 1024 # 64MB
+	
+	def __init__(self, cache, max_pending=None, max_pending_bytes=None):
+		self._cache = cache
+		self._max_pending = max_pending or _WriteBehindCache.DEFAULT_MAX_PENDING
+		self._max_pending_bytes = (max_pending_bytes or
+								   _WriteBehindCache.DEFAULT_MAX_PENDING_BYTES)
+		# key -> (data, time), with None data for a pending Remove
+		self._pending = {}
+		self._pending_bytes = 0
+		self._order = collections.deque()
+		self._writing = 0
+		self._closed = False
+		self._stats = {'writes': 0, 'coalesced': 0, 'flushed': 0, 'blocked': 0, 'errors': 0}
+		self._last_error = None
+		self._condition = threading.Condition()
+		self._thread = threading.Thread(target=self._Run)
+		self._thread.setDaemon(True)
+		self._thread.start()
+		_write_behind_caches.add(self)
 		
-		Values of None are not included in the output string.
+	def GetCache(self):
+		return self._cache
 		
-		Args:
-			parameters:
-				A dict of (key, value) tuples, where value is encoded as
-				specified by self._encoding
-				
-		Returns:
-			A URL-encoded string in "key=value&key=value" form
-		'''
+	def Get(self, key):
+		self._condition.acquire()
+		try:
+			entry = self._pending.get(key)
+		finally:
+			self._condition.release()
+		if entry:
+			return entry[0]
+		return self._cache.Get(key)
 		
-		if parameters is None:
-			return None
-		else:
-			return urllib.urlencode(dict([(k, self._Encode(v)) for k, v in parameters.items() if v is not None]))
-	
-	def _EncodePostData(self, post_data):
-		'''Return a string in key=value&key=value form
+	def GetCachedTime(self, key):
+		self._condition.acquire()
+		try:
+			entry = self._pending.get(key)
+		finally:
+			self._condition.release()
+		if entry:
+			if entry[0] is None:
+				return None
+			return entry[1]
+		return self._cache.GetCachedTime(key)
 		
-		Values are assumed to be encoded in the format sprecified by self._encoding,
-		and are subsequently URL encoded.
+	def Set(self, key, data):
+		self._Put(key, data)
+		
+	def Remove(self, key):
+		self._Put(key, None)
+		
+	def Flush(self, timeout=None):
+		'''Block until every pending write has been made.
 		
-		Args:
-			post_data:
-				A dict of (key, value) tuples, where value is encoded as specified by self._encoding
-				
 		Returns:
-			A URL-encoded string in "key=value&key=value" form
+			False if timeout seconds passed first.
 		'''
-		if post_data is None:
-			return None
-		else:
-			return urllib.urlencode(dict([(k, self._Encode(v)) for k, v in post_data.items()]))
+		deadline = _AsDeadline(timeout)
+		self._condition.acquire()
+		try:
+			while self._pending:
+				if deadline:
+					remaining = deadline.Remaining()
+					if remaining <= 0:
+						return False
+					self._condition.wait(remaining)
+				else:
+					self._condition.wait()
+			return True
+		finally:
+			self._condition.release()
+			
+	def Close(self):
+		'''Flush pending writes and stop the flush thread.'''
+		self.Flush()
+		self._condition.acquire()
+		try:
+			self._closed = True
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+		self._thread.join()
+		_write_behind_caches.discard(self)
+		
+	def GetStats(self):
+		'''Return counts of writes, coalesced writes, flushed writes,
+		writes that blocked on a full queue, and failed writes, and the
+		entries and bytes still pending.'''
+		self._condition.acquire()
+		try:
+			stats = dict(self._stats)
+			stats['pending'] = len(self._pending)
+			stats['pending_bytes'] = self._pending_bytes
+			stats['last_error'] = self._last_error
+			return stats
+		finally:
+			self._condition.release()
+		
+	def _Put(self, key, data):
+		size = len(data or '')
+		self._condition.acquire()
+		try:
+			if self._closed:
+				raise _FileCacheError('Write-behind cache is closed')
+			self._stats['writes'] += 1
+			if self._IsFull(key, size):
+				self._stats['blocked'] += 1
+				while self._IsFull(key, size):
+					self._condition.wait()
+			# The flush thread may have written an older entry while we waited
+			entry = self._pending.get(key)
+			if entry is None:
+				self._order.append(key)
+			else:
+				self._stats['coalesced'] += 1
+				self._pending_bytes -= len(entry[0] or '')
+			self._pending[key] = (data, time.time())
+			self._pending_bytes += size
+			self._condition.notifyAll()
+		finally:
+			self._condition.release()
+			
+	def _IsFull(self, key, size):
+		'''Check whether a write of size bytes to key must wait.'''
+		if not self._pending:
+			return False
+		entry = self._pending.get(key)
+		if entry is None and len(self._pending) >= self._max_pending:
+			return True
+		replaced = entry and len(entry[0] or '') or 0
+		return self._pending_bytes - replaced + size > self._max_pending_bytes
+			
+	def _Run(self):
+		while True:
+			self._condition.acquire()
+			try:
+				while not self._order and not self._closed:
+					self._condition.wait()
+				if not self._order:
+					return
+				key = self._order.popleft()
+				entry = self._pending[key]
+			finally:
+				self._condition.release()
+			# A newer write to key replaces entry in the table; it stays
+			# there, and is written again, only if one arrives meanwhile.
+			error = None
+			try:
+				if entry[0] is None:
+					self._cache.Remove(key)
+				else:
+					self._cache.Set(key, entry[0])
+			except Exception, e:
+				error = e
+			self._condition.acquire()
+			try:
+				if error:
+					self._stats['errors'] += 1
+					self._last_error = error
+				else:
+					self._stats['flushed'] += 1
+				if self._pending.get(key) is entry:
+					del self._pending[key]
+					self._pending_bytes -= len(entry[0] or '')
+				elif key not in self._order:
+					self._order.append(key)
+				self._condition.notifyAll()
+			finally:
+				self._condition.release()
+
+_write_behind_caches = weakref.WeakSet()
+
+def _FlushWriteBehindCaches():
+	for cache in list(_write_behind_caches):
+		cache.Flush()
+
+atexit.register(_FlushWriteBehindCaches)
 
 class _FileCacheError(Exception):
 	'''Base exception class for Fileache related errors'''
 	
+class _CacheCodec(object):
+	'''A compression codec usable for _FileCache entries.
+	
+	Compressed entries are written as CACHE_ENTRY_MAGIC, followed by the
+	codec's one byte id, followed by the compressed payload.  Entries
+	without the magic prefix are read back as-is, so uncompressed entries
+	written by older versions keep working.
+	'''
+	
+	def __init__(self, name, id, compressor, decompress):
+		self.name = name
+		self.id = id
+		self._compressor = compressor
+		self._decompress = decompress
+		
+	def Compressor(self, level):
+		'''Return a new incremental compressor with compress() and flush().'''
+		return self._compressor(level)
+		
+	def Decompress(self, data):
+		return self._decompress(data)
+
+# JSON bodies never start with a NUL byte, so this can't collide with an
+# old, uncompressed entry.
+CACHE_ENTRY_MAGIC = '\x00BC'
+
+CACHE_CODECS = {}
+
+def _RegisterCacheCodec(codec):
+	CACHE_CODECS[codec.name] = codec
+	CACHE_CODECS[codec.id] = codec
+
+_RegisterCacheCodec(_CacheCodec('zlib', 'z',
+								lambda level: zlib.compressobj(level),
+								zlib.decompress))
+if bz2:
+	_RegisterCacheCodec(_CacheCodec('bz2', 'b',
+									lambda level: bz2.BZ2Compressor(level),
+									bz2.decompress))
+if lzma:
+	_RegisterCacheCodec(_CacheCodec('lzma', 'x',
+									lambda level: lzma.LZMACompressor(preset=level),
+									lzma.decompress))
+
 class _FileCache(object):
 	
 	DEPTH = 3
+	DEFAULT_COMPRESSION_LEVEL = 6
+	DEFAULT_COMPRESSION_THRESHOLD = 1024 # don't compress entries under 1KB
+	LOCK_STRIPES = 64
 	
-	def __init__(self, root_directory=None):
+	def __init__(self,
+				root_directory=None,
+				compression=None,
+				compression_level=DEFAULT_COMPRESSION_LEVEL,
+				compression_threshold=DEFAULT_COMPRESSION_THRESHOLD,
+				locking=False):
+		'''Instantiate a new bandcamp._FileCache.
+		
+		Args:
+			root_directory:
+				The directory to store entries under.  Defaults to a
+				per-user directory in the system temp dir. [Optional]
+			compression:
+				The name of the codec used to compress stored entries:
+				'zlib', 'bz2' or 'lzma' (when available).  Defaults to None,
+				which stores entries uncompressed. [Optional]
+			compression_level:
+				The level passed to the codec. [Optional]
+			compression_threshold:
+				Entries smaller than this many bytes are stored
+				uncompressed. [Optional]
+			locking:
+				Set to True when several processes share root_directory.
+				Lock then hands out one of LOCK_STRIPES file locks under
+				root_directory, which an Api holds while it refetches a
+				stale entry, so only one process fetches it.  Requires
+				fcntl. [Optional]
+		'''
 		self._InitializeRootDirectory(root_directory)
+		self.SetCompression(compression, compression_level, compression_threshold)
+		if locking and not fcntl:
+			raise _FileCacheError('Cache locking requires the fcntl module')
+		self._locking = locking
+		if locking:
+			self._MakeDirectory(os.path.join(self._root_directory, 'locks'))
+		
+	def SetCompression(self,
+						compression=None,
+						compression_level=DEFAULT_COMPRESSION_LEVEL,
+						compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
+		'''Change how new entries are compressed.
+		
+		Existing entries are read back whatever codec they were written with.
+		'''
+		if compression is None:
+			self._codec = None
+		elif compression in CACHE_CODECS:
+			self._codec = CACHE_CODECS[compression]
+		else:
+			raise _FileCacheError('Unsupported cache compression: %s' % compression)
+		self._compression_level = compression_level
+		self._compression_threshold = compression_threshold
 		
 	def Get(self, key):
 		path = self._GetPath(key)
-		if os.path.exists(path):
-			return open(path).read()
-		else:
-			return None
+		# Entries are only ever replaced by an atomic rename, so opening
+		# directly never sees a partial file; it may just not be there.
+		try:
+			fp = open(path, 'rb')
+		except IOError, e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		try:
+			data = fp.read()
+		finally:
+			fp.close()
+		return self._DecodeEntry(data)
+			
 	def Set(self, key, data):
+		writer = self.Open(key)
+		try:
+			writer.write(data)
+		except:
+			writer.abort()
+			raise
+		writer.commit()
+		
+	def Open(self, key):
+		'''Return a writer that streams an entry into the cache.
+		
+		Data written to the writer goes to a temp file next to the entry and
+		only replaces it when the writer is committed.
+		'''
 		path = self._GetPath(key)
-		directory = os.path.dirname(path)
-		if not os.path.exists(directory):
-			os.makedirs(directory)
-		if not os.path.isdir(directory):
-			raise _FileCacheError('%s exists but is not a direcotyr' % directory)
-		temp_fd, temp_path = tempfile.mkstemp()
-		temp_fp = os.fdopen(temp_fd, 'w')
-		temp_fp.write(data)
-		temp_fp.close()
 		if not path.startswith(self._root_directory):
 			raise _FileCacheError('%s does not appear to live under %s' %
 									(path, self._root_directory))
-		
-		if os.path.exists(path):
-			os.remove(path)
-		os.rename(temp_path, path)
+		directory = os.path.dirname(path)
+		self._MakeDirectory(directory)
+		return _FileCacheWriter(path, self._codec, self._compression_level,
+								self._compression_threshold)
 		
 	def Remove(self, key):
 		path = self._GetPath(key)
-		if not path.startswith(self._root_diretory):
+		if not path.startswith(self._root_directory):
 			raise _FileCacheError('%s does not appear to live under %s' %
 									(path, self._root_directory))
 		
-		if os.path.exists(path):
+		try:
 			os.remove(path)
+		except OSError, e:
+			if e.errno != errno.ENOENT:
+				raise
 	
 	def GetCachedTime(self, key):
 		path = self._GetPath(key)
-		if os.path.exists(path):
+		try:
 			return os.path.getmtime(path)
-		else:
+		except OSError, e:
+			if e.errno == errno.ENOENT:
+				return None
+			raise
+		
+	def Lock(self, key, deadline=None):
+		'''Take the lock that serializes refetching key across processes.
+		
+		Entries are replaced atomically, so reads and writes never need it.
+		It is for the check, fetch and Set of a stale entry: the holder
+		checks GetCachedTime again, since another process may have just
+		stored a fresh entry, and only fetches if it is still stale.
+		
+		Args:
+			key:
+				The cache key about to be refetched.
+			deadline:
+				A bandcamp.Deadline to stop waiting at. [Optional]
+				
+		Returns:
+			The held _FileLock, to Release once the entry is stored, or
+			None without locking or if the deadline ran out first.
+		'''
+		if not self._locking:
+			return None
+		hashed_key = os.path.basename(self._GetPath(key))
+		stripe = int(hashed_key[:8], 16) % _FileCache.LOCK_STRIPES
+		lock = _FileLock(os.path.join(self._root_directory, 'locks', '%02d.lock' % stripe))
+		if not lock.Acquire(deadline):
 			return None
+		return lock
+		
+	def _MakeDirectory(self, directory):
+		'''Create directory, tolerating another process creating it first.'''
+		try:
+			os.makedirs(directory)
+		except OSError, e:
+			if e.errno != errno.EEXIST:
+				raise
+		if not os.path.isdir(directory):
+			raise _FileCacheError('%s exists but is not a directory' % directory)
+		
+	def _DecodeEntry(self, data):
+		'''Return the original data for an entry read from disk.'''
+		if not data.startswith(CACHE_ENTRY_MAGIC):
+			return data
+		codec_id = data[len(CACHE_ENTRY_MAGIC)]
+		if codec_id not in CACHE_CODECS:
+			raise _FileCacheError('Unknown cache codec id: %r' % codec_id)
+		return CACHE_CODECS[codec_id].Decompress(data[len(CACHE_ENTRY_MAGIC) + 1:])
 		
 	def _GetUsername(self):
 		'''Attempt to find the username in a cross-platform fashion.'''
@@ -1128,10 +5278,7 @@ class _FileCache(object):
 		if not root_directory:
 			root_directory = self._GetTmpCachePath()
 		root_directory = os.path.abspath(root_directory)
-		if not os.path.exists(root_directory):
-			os.mkdir(root_directory)
-		if not os.path.isdir(root_directory):
-			raise _FileCacheError('%s exists but is not a direcotry' % root_direcotry)
+		self._MakeDirectory(root_directory)
 		
 		self._root_directory = root_directory
 		
@@ -1147,5 +5294,138 @@ class _FileCache(object):
 
 	def _GetPrefix(self, hashed_key):
 		return os.path.sep.join(hashed_key[0:_FileCache.DEPTH])
+
+class _FileCacheWriter(object):
+	'''A file-like object that streams a single _FileCache entry to disk.'''
+	
+	def __init__(self, path, codec=None, compression_level=None,
+				compression_threshold=0):
+		self._path = path
+		temp_fd, self._temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+		self._temp_fp = os.fdopen(temp_fd, 'wb')
+		self._codec = codec
+		self._compression_level = compression_level
+		self._compression_threshold = compression_threshold
+		self._compressor = None
+		# Held back until we know whether the entry is big enough to compress
+		self._pending = []
+		self._pending_size = 0
+		
+	def write(self, data):
+		if self._compressor:
+			self._temp_fp.write(self._compressor.compress(data))
+		elif not self._codec:
+			self._temp_fp.write(data)
+		else:
+			self._pending.append(data)
+			self._pending_size += len(data)
+			if self._pending_size >= self._compression_threshold:
+				self._StartCompressing()
+				
+	def _StartCompressing(self):
+		self._compressor = self._codec.Compressor(self._compression_level)
+		self._temp_fp.write(CACHE_ENTRY_MAGIC + self._codec.id)
+		for data in self._pending:
+			self._temp_fp.write(self._compressor.compress(data))
+		self._pending = []
+		
+	def commit(self):
+		'''Close the temp file and move it into place.'''
+		if self._compressor:
+			self._temp_fp.write(self._compressor.flush())
+		else:
+			# Never reached the threshold, so store it uncompressed
+			self._temp_fp.write(''.join(self._pending))
+		self._pending = []
+		self._temp_fp.close()
+		_ReplaceFile(self._temp_path, self._path)
+		
+	def abort(self):
+		'''Close and discard the temp file, leaving any old entry in place.'''
+		self._temp_fp.close()
+		if os.path.exists(self._temp_path):
+			os.remove(self._temp_path)
+
+class _FileLock(object):
+	'''An exclusive lock on a file, shared by every process that opens it.'''
+	
+	def __init__(self, path):
+		self._path = path
+		self._fp = None
+		
+	_POLL_INTERVAL = 0.05
+	
+	def Acquire(self, deadline=None):
+		'''Wait for the lock, until deadline if given.  Returns True once held.'''
+		# Opened per acquisition, so a forked child never inherits our lock
+		# and other threads of this process are locked out too
+		self._fp = open(self._path, 'a')
+		if deadline is None:
+			fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX)
+			return True
+		while True:
+			try:
+				fcntl.flock(self._fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				return True
+			except IOError, e:
+				if e.errno not in (errno.EAGAIN, errno.EACCES):
+					raise
+			remaining = deadline.Remaining()
+			if remaining <= 0:
+				self._fp.close()
+				self._fp = None
+				return False
+			time.sleep(min(_FileLock._POLL_INTERVAL, remaining))
 		
-			
\ No newline at end of file
+	def Release(self):
+		fcntl.flock(self._fp.fileno(), fcntl.LOCK_UN)
+		self._fp.close()
+		self._fp = None
+
+def _ReplaceFile(source, destination):
+	'''Move source over destination.
+	
+	On POSIX this is a single atomic rename, so readers see either the old
+	or the new file.  Windows can't rename over an existing file, so the
+	destination is removed first there.
+	'''
+	if os.name == 'nt' and os.path.exists(destination):
+		os.remove(destination)
+	os.rename(source, destination)
+
+def _Main(argv):
+	'''Run a bandcamp.Gateway from the command line.'''
+	parser = optparse.OptionParser(usage='%prog --key KEY [options]',
+								   description='Serve the Bandcamp API to local clients '
+											   'through one shared cache.')
+	parser.add_option('--key', action='append', default=[],
+					  help='a developer key; repeat to spread requests over several')
+	parser.add_option('--host', default='127.0.0.1', help='the address to listen on')
+	parser.add_option('--port', type='int', default=Gateway.DEFAULT_PORT,
+					  help='the port to listen on')
+	parser.add_option('--cache-dir', help='the directory to cache responses in')
+	parser.add_option('--cache-timeout', type='int', default=Api.DEFAULT_CACHE_TIMEOUT,
+					  help='the seconds a cached response is reused')
+	parser.add_option('--rate', type='float', help='the most upstream requests per second')
+	parser.add_option('--max-in-flight', type='int', help='the most upstream requests at once')
+	options, args = parser.parse_args(argv)
+	if not options.key:
+		parser.error('at least one --key is required')
+	if len(options.key) > 1:
+		key = KeyPool(options.key)
+	else:
+		key = options.key[0]
+	cache = DEFAULT_CACHE
+	if options.cache_dir:
+		cache = _FileCache(options.cache_dir, locking=fcntl is not None)
+	api = Api(key, cache_timeout=options.cache_timeout, cache=cache)
+	gateway = Gateway(api, options.host, options.port, rate=options.rate,
+					  max_in_flight=options.max_in_flight)
+	try:
+		gateway.Serve()
+	except KeyboardInterrupt:
+		pass
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(_Main(sys.argv[1:]))
@@ -0,0 +1,1331 @@
+#!/usr/bin/python2.4
+#
+# Copyright 2007 The Python-Bandcamp Developers
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''Unit tests for the bandcamp.py library'''
+
+import BaseHTTPServer
+import cStringIO
+import httplib
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import SocketServer
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import urlparse
+import zlib
+
+try:
+  # Python >= 2.6
+  import json as simplejson
+except ImportError:
+  import simplejson
+
+import bandcamp
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	daemon_threads = True
+
+	def handle_error(self, request, client_address):
+		# Clients that time out hang up before the answer is written
+		if not isinstance(sys.exc_info()[1], socket.error):
+			BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	'''Answers each GET with server.respond(endpoint, parameters).'''
+
+	def do_GET(self):
+		(scheme, netloc, path, query, fragment) = urlparse.urlsplit(self.path)
+		endpoint = path.lstrip('/')
+		parameters = dict(urlparse.parse_qsl(query))
+		self.server.requests.append((endpoint, parameters))
+		self.server.request_headers.append(self.headers)
+		response = self.server.respond(endpoint, parameters)
+		status, body = response[:2]
+		headers = len(response) > 2 and response[2] or {}
+		self.send_response(status)
+		for name, value in headers.items():
+			self.send_header(name, value)
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		if len(response) > 3:
+			self.wfile.flush()
+			time.sleep(response[3])
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class ApiTestCase(unittest.TestCase):
+	'''Runs a local HTTP server to stand in for api.bandcamp.com.
+
+	Set self.respond to a function of (endpoint, parameters) returning a
+	(status, body), (status, body, headers) or (status, body, headers,
+	seconds to wait between the headers and the body) tuple.
+	'''
+
+	def setUp(self):
+		self.respond = lambda endpoint, parameters: (200, '{}')
+		self._server = _Server(('127.0.0.1', 0), _RequestHandler)
+		self._server.requests = []
+		self._server.request_headers = []
+		self._server.respond = lambda *args: self.respond(*args)
+		thread = threading.Thread(target=self._server.serve_forever)
+		thread.setDaemon(True)
+		thread.start()
+		self._cache_directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		self._server.shutdown()
+		self._server.server_close()
+		shutil.rmtree(self._cache_directory, ignore_errors=True)
+
+	def _GetBaseUrl(self):
+		return 'http://%s:%d' % self._server.server_address
+
+	def _GetRequests(self, endpoint=None):
+		return [x for x in self._server.requests if endpoint in (None, x[0])]
+
+	def _NewApi(self, developer_key='key', **kwargs):
+		kwargs.setdefault('cache', bandcamp._FileCache(self._cache_directory))
+		kwargs.setdefault('base_url', self._GetBaseUrl())
+		return bandcamp.Api(developer_key, **kwargs)
+
+def _Album(album_id, **kwargs):
+	data = {'album_id': album_id, 'band_id': 1, 'title': 'Album %s' % album_id,
+			'tracks': []}
+	data.update(kwargs)
+	return simplejson.dumps(data)
+
+_STRESS_KEYS = ['key%d' % i for i in range(8)]
+
+def _StressFileCache(root_directory, worker, results, locking):
+	'''Fill, overwrite and remove random shared keys as Apis sharing a cache do.
+
+	Puts the number of fills, fetches of a key no other process had
+	stored, and of corrupt reads.  Each value repeats 'key:worker:' so a
+	read mixing two writes shows up.
+	'''
+	cache = bandcamp._FileCache(root_directory, compression='zlib',
+								compression_threshold=100, locking=locking)
+	fills = corrupt = 0
+	for i in range(100):
+		key = random.choice(_STRESS_KEYS)
+		value = ('%s:%d:' % (key, worker)) * random.randint(1, 200)
+		lock = cache.Lock(key)
+		try:
+			if cache.GetCachedTime(key) is None:
+				time.sleep(0.05) # the fetch
+				cache.Set(key, value)
+				fills += 1
+		finally:
+			if lock:
+				lock.Release()
+		if random.random() < 0.3:
+			cache.Set(key, value)
+		data = cache.Get(key)
+		if data is not None:
+			unit = ':'.join(data.split(':')[:2]) + ':'
+			if not unit.startswith(key + ':') or data != unit * (len(data) // len(unit)):
+				corrupt += 1
+	results.put((fills, corrupt))
+
+class FileCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self._root_directory = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self._root_directory, ignore_errors=True)
+
+	def _Stress(self, locking):
+		results = multiprocessing.Queue()
+		processes = [multiprocessing.Process(target=_StressFileCache,
+											 args=(self._root_directory, i, results, locking))
+					 for i in range(12)]
+		for process in processes:
+			process.start()
+		counts = [results.get(timeout=60) for process in processes]
+		for process in processes:
+			process.join()
+			self.assertEqual(0, process.exitcode)
+		return sum([x[0] for x in counts]), sum([x[1] for x in counts])
+
+	def testProcessesSharingKeys(self):
+		'''Test that many processes fill each key once and never corrupt it'''
+		fills, corrupt = self._Stress(locking=True)
+		self.assertEqual(len(_STRESS_KEYS), fills)
+		self.assertEqual(0, corrupt)
+		temp_files = [name for path, directories, names in os.walk(self._root_directory)
+					  for name in names if name.startswith('tmp')]
+		self.assertEqual([], temp_files)
+
+	def _ReadRaw(self, cache, key):
+		fp = open(cache._GetPath(key), 'rb')
+		try:
+			return fp.read()
+		finally:
+			fp.close()
+
+	def testCompressedRoundTrip(self):
+		'''Test that every available codec stores entries compressed and reads them back'''
+		data = _Album(1, about='x' * 5000)
+		for name in ('zlib', 'bz2', 'lzma'):
+			if name not in bandcamp.CACHE_CODECS:
+				continue
+			cache = bandcamp._FileCache(self._root_directory, compression=name)
+			cache.Set(name, data)
+			raw = self._ReadRaw(cache, name)
+			self.assertEqual(bandcamp.CACHE_ENTRY_MAGIC + bandcamp.CACHE_CODECS[name].id,
+							 raw[:len(bandcamp.CACHE_ENTRY_MAGIC) + 1])
+			self.assertTrue(len(raw) < len(data))
+			self.assertEqual(data, cache.Get(name))
+
+	def testStreamedWritesCrossTheThreshold(self):
+		'''Test that chunks written below the threshold are compressed once it is passed'''
+		cache = bandcamp._FileCache(self._root_directory, compression='zlib',
+									compression_threshold=100)
+		writer = cache.Open('key')
+		for i in range(50):
+			writer.write('chunk %02d;' % i)
+		writer.commit()
+		self.assertTrue(self._ReadRaw(cache, 'key').startswith(bandcamp.CACHE_ENTRY_MAGIC))
+		self.assertEqual(''.join(['chunk %02d;' % i for i in range(50)]), cache.Get('key'))
+
+	def testSmallEntriesAreStoredPlain(self):
+		'''Test that entries under the threshold are written uncompressed'''
+		cache = bandcamp._FileCache(self._root_directory, compression='zlib',
+									compression_threshold=100)
+		cache.Set('key', _Album(1))
+		self.assertEqual(_Album(1), self._ReadRaw(cache, 'key'))
+		self.assertEqual(_Album(1), cache.Get('key'))
+
+	def testLegacyEntriesAreRead(self):
+		'''Test that a plain entry written before compression existed still reads'''
+		data = _Album(1, about='x' * 5000)
+		bandcamp._FileCache(self._root_directory).Set('key', data)
+		cache = bandcamp._FileCache(self._root_directory, compression='zlib')
+		self.assertEqual(data, self._ReadRaw(cache, 'key'))
+		self.assertEqual(data, cache.Get('key'))
+
+	def testUnknownCodecIsAnError(self):
+		'''Test that an entry naming an unknown codec raises _FileCacheError'''
+		cache = bandcamp._FileCache(self._root_directory)
+		cache.Set('key', bandcamp.CACHE_ENTRY_MAGIC + '?data')
+		self.assertRaises(bandcamp._FileCacheError, cache.Get, 'key')
+
+class _GatedCache(object):
+	'''An in-memory cache whose writes wait until the gate is opened.'''
+
+	def __init__(self):
+		self.entries = {}
+		self.writes = []
+		self.gate = threading.Event()
+
+	def Get(self, key):
+		return self.entries.get(key, (None, None))[0]
+
+	def GetCachedTime(self, key):
+		return self.entries.get(key, (None, None))[1]
+
+	def Set(self, key, data):
+		self.gate.wait()
+		self.writes.append(key)
+		self.entries[key] = (data, time.time())
+
+	def Remove(self, key):
+		self.gate.wait()
+		self.writes.append(key)
+		self.entries.pop(key, None)
+
+class WriteBehindCacheTest(unittest.TestCase):
+
+	def setUp(self):
+		self._cache = _GatedCache()
+		self._caches = []
+
+	def tearDown(self):
+		self._cache.gate.set()
+		for cache in self._caches:
+			cache.Close()
+
+	def _NewCache(self, **kwargs):
+		cache = bandcamp._WriteBehindCache(self._cache, **kwargs)
+		self._caches.append(cache)
+		return cache
+
+	def _StartPut(self, function, *args):
+		thread = threading.Thread(target=function, args=args)
+		thread.setDaemon(True)
+		thread.start()
+		thread.join(0.2)
+		return thread
+
+	def testPendingWritesAreReadBack(self):
+		'''Test that reads see pending sets and removes before they are written'''
+		cache = self._NewCache()
+		cache.Set('key', 'data')
+		self.assertEqual('data', cache.Get('key'))
+		self.assertTrue(cache.GetCachedTime('key'))
+		cache.Remove('key')
+		self.assertEqual(None, cache.Get('key'))
+		self.assertEqual(None, cache.GetCachedTime('key'))
+		self._cache.gate.set()
+		self.assertTrue(cache.Flush(5))
+		self.assertFalse('key' in self._cache.entries)
+
+	def testWritesToOneKeyCoalesce(self):
+		'''Test that a key written many times while pending is written at most twice'''
+		cache = self._NewCache()
+		for i in range(10):
+			cache.Set('key', 'data %d' % i)
+		self._cache.gate.set()
+		self.assertTrue(cache.Flush(5))
+		self.assertEqual('data 9', self._cache.Get('key'))
+		self.assertTrue(len(self._cache.writes) <= 2)
+		self.assertEqual(9, cache.GetStats()['coalesced'])
+
+	def testFullTableBlocks(self):
+		'''Test that writes wait once max_pending entries are pending'''
+		cache = self._NewCache(max_pending=2)
+		cache.Set('a', 'data')
+		cache.Set('b', 'data')
+		thread = self._StartPut(cache.Set, 'c', 'data')
+		self.assertTrue(thread.isAlive())
+		self._cache.gate.set()
+		thread.join(5)
+		self.assertFalse(thread.isAlive())
+		self.assertTrue(cache.Flush(5))
+		self.assertEqual(1, cache.GetStats()['blocked'])
+		self.assertEqual(['a', 'b', 'c'], sorted(self._cache.entries))
+
+	def testByteBudgetBlocks(self):
+		'''Test that writes wait once max_pending_bytes are pending, but one big entry gets in'''
+		cache = self._NewCache(max_pending_bytes=100)
+		cache.Set('a', 'x' * 60)
+		thread = self._StartPut(cache.Set, 'b', 'x' * 60)
+		self.assertTrue(thread.isAlive())
+		self.assertEqual(60, cache.GetStats()['pending_bytes'])
+		self._cache.gate.set()
+		thread.join(5)
+		self.assertFalse(thread.isAlive())
+		self.assertTrue(cache.Flush(5))
+		self.assertEqual(0, cache.GetStats()['pending_bytes'])
+		cache.Set('c', 'x' * 500)
+		self.assertTrue(cache.Flush(5))
+		self.assertEqual('x' * 500, self._cache.Get('c'))
+
+	def testFlushTimesOut(self):
+		'''Test that Flush gives up after its timeout while writes are stuck'''
+		cache = self._NewCache()
+		cache.Set('key', 'data')
+		self.assertFalse(cache.Flush(0.1))
+		self._cache.gate.set()
+		self.assertTrue(cache.Flush(5))
+
+	def testCloseFlushesAndRefusesWrites(self):
+		'''Test that Close writes everything pending and later writes fail'''
+		self._cache.gate.set()
+		cache = self._NewCache()
+		for i in range(20):
+			cache.Set('key%d' % i, 'data')
+		cache.Close()
+		self.assertEqual(20, len(self._cache.entries))
+		self.assertRaises(bandcamp._FileCacheError, cache.Set, 'key', 'data')
+
+class ExportCsvTest(unittest.TestCase):
+
+	def testHeaderIsWrittenWithoutModels(self):
+		'''Test that an empty export still gets its header row'''
+		output = cStringIO.StringIO()
+		self.assertEqual(0, bandcamp.ExportCsv([], output, columns=('type', 'id')))
+		self.assertEqual('type,id\r\n', output.getvalue())
+
+	def testHeaderIsNotCounted(self):
+		'''Test that the row count leaves out the header'''
+		output = cStringIO.StringIO()
+		albums = [bandcamp.Album.NewFromJsonDict(simplejson.loads(_Album(i)))
+				  for i in (1, 2)]
+		self.assertEqual(2, bandcamp.ExportCsv(albums, output,
+											   columns=('type', 'title')))
+		self.assertEqual('type,title\r\nalbum,Album 1\r\nalbum,Album 2\r\n',
+						 output.getvalue())
+
+class ApiErrorTest(ApiTestCase):
+
+	def testNotFoundIsNegativelyCached(self):
+		'''Test that a 404 raises BandcampError and is neither cached nor refetched'''
+		self.respond = lambda endpoint, parameters: (404, 'Not Found')
+		api = self._NewApi()
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 404)
+		self.assertTrue(api.IsKnownMissing('album', 404))
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 404)
+		self.assertEqual(1, len(self._GetRequests('album/1/info')))
+
+	def testMissingIsSharedThroughTheCache(self):
+		'''Test that another Api on the same cache skips an id found missing'''
+		self.respond = lambda endpoint, parameters: (404, 'Not Found')
+		self.assertRaises(bandcamp.BandcampError, self._NewApi().GetAlbum, 404)
+		api = self._NewApi()
+		self.assertTrue(api.IsKnownMissing('album', 404))
+		self.assertFalse(api.IsKnownMissing('album', 405))
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 404)
+		self.assertEqual(1, len(self._GetRequests('album/1/info')))
+
+	def testErrorBodyIsNotCached(self):
+		'''Test that an API error or invalid JSON body is refetched, not served again'''
+		responses = [(200, simplejson.dumps({'error': True, 'error_message': 'No such album'})),
+					 (200, 'not json'),
+					 (200, _Album(5))]
+		self.respond = lambda endpoint, parameters: responses.pop(0)
+		api = self._NewApi()
+		api.SetNegativeCacheTimeout(None)
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 5)
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 5)
+		self.assertEqual('Album 5', api.GetAlbum(5).title)
+
+	def testIdFoundInDiscographyIsRefetched(self):
+		'''Test that an id missing before is fetched again once a discography lists it'''
+		def Respond(endpoint, parameters):
+			if endpoint == 'band/1/discography':
+				return 200, simplejson.dumps({'discography': [
+					{'album_id': 5, 'band_id': 1, 'title': 'Album 5'}]})
+			if len(self._GetRequests('album/1/info')) == 1:
+				return 200, simplejson.dumps({'error': True, 'error_message': 'No such album'})
+			return 200, _Album(5)
+		self.respond = Respond
+		api = self._NewApi()
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 5)
+		self.assertTrue(api.IsKnownMissing('album', 5))
+		api.GetDiscography(band_id=1)
+		self.assertFalse(api.IsKnownMissing('album', 5))
+		self.assertEqual('Album 5', api.GetAlbum(5).title)
+		self.assertEqual(2, len(self._GetRequests('album/1/info')))
+
+	def testForgetMissingDropsCachedResponses(self):
+		'''Test that forgetting a missing id drops what was cached for it'''
+		self.respond = lambda endpoint, parameters: (200, _Album(5))
+		api = self._NewApi()
+		api.GetAlbum(5)
+		api._RecordMissing('album', 5, 'No such album')
+		api._ForgetMissing('album', 5)
+		self.assertFalse(api.IsKnownMissing('album', 5))
+		api.GetAlbum(5)
+		self.assertEqual(2, len(self._GetRequests('album/1/info')))
+		api._ForgetMissing('album', 5)
+		api.GetAlbum(5)
+		self.assertEqual(2, len(self._GetRequests('album/1/info')))
+
+	def testServerErrorIsNotCached(self):
+		'''Test that an error body is never served from the cache'''
+		self.respond = lambda endpoint, parameters: (500, 'Internal Server Error')
+		api = self._NewApi()
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 1)
+		self.respond = lambda endpoint, parameters: (200, _Album(1))
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+
+	def testGetAlbumsKeepsGoingPastErrors(self):
+		'''Test that one dead id doesn't abort a bulk fetch'''
+		def Respond(endpoint, parameters):
+			if parameters['album_id'] == '2':
+				return 404, 'Not Found'
+			return 200, _Album(int(parameters['album_id']))
+		self.respond = Respond
+		results = self._NewApi().GetAlbums([1, 2, 3])
+		self.assertEqual('Album 1', results[1].title)
+		self.assertTrue(isinstance(results[2], bandcamp.BandcampError))
+		self.assertEqual('Album 3', results[3].title)
+
+	def testGetAlbumsKeepsGoingPastConnectionErrors(self):
+		'''Test that an unreachable server gives a BandcampError per id'''
+		listener = socket.socket()
+		listener.bind(('127.0.0.1', 0))
+		base_url = 'http://%s:%d' % listener.getsockname()
+		listener.close()
+		api = self._NewApi(base_url=base_url)
+		results = api.GetAlbums([1, 2, 3])
+		self.assertEqual([1, 2, 3], sorted(results))
+		for error in results.values():
+			self.assertTrue(isinstance(error, bandcamp.BandcampError))
+		self.assertFalse(api.IsKnownMissing('album', 1))
+
+class MediaDownloaderTest(ApiTestCase):
+
+	_CONTENT = ''.join(chr(i % 251) for i in range(200000))
+
+	def setUp(self):
+		ApiTestCase.setUp(self)
+		self._media_directory = tempfile.mkdtemp()
+		self._downloader = bandcamp.MediaDownloader(self._media_directory)
+
+	def tearDown(self):
+		self._downloader.Close()
+		shutil.rmtree(self._media_directory, ignore_errors=True)
+		ApiTestCase.tearDown(self)
+
+	def _RespondWithRanges(self, endpoint, parameters):
+		range_header = self._server.request_headers[-1].get('Range')
+		if range_header:
+			offset = int(range_header[len('bytes='):-1])
+			return 206, self._CONTENT[offset:], {
+				'Content-Range': 'bytes %d-%d/%d' % (offset, len(self._CONTENT) - 1,
+													 len(self._CONTENT))}
+		return 200, self._CONTENT
+
+	def _WritePartial(self, url, size):
+		path = os.path.join(self._media_directory, 'partial',
+							self._downloader._GetUrlKey(url))
+		fp = open(path, 'wb')
+		fp.write(self._CONTENT[:size])
+		fp.close()
+
+	def _Read(self, path):
+		fp = open(path, 'rb')
+		try:
+			return fp.read()
+		finally:
+			fp.close()
+
+	def testPartialFileIsResumed(self):
+		'''Test that a partial file is finished with a Range request'''
+		self.respond = self._RespondWithRanges
+		url = self._GetBaseUrl() + '/stream/1'
+		self._WritePartial(url, 50000)
+		path = self._downloader.DownloadUrl(url)
+		self.assertEqual(self._CONTENT, self._Read(path))
+		self.assertEqual('bytes=50000-', self._server.request_headers[-1].get('Range'))
+		stats = self._downloader.GetStats()
+		self.assertEqual(50000, stats['bytes_resumed'])
+		self.assertEqual(len(self._CONTENT) - 50000, stats['bytes_downloaded'])
+
+	def testRangeIgnoredStartsOver(self):
+		'''Test that a full 200 answer to a Range request replaces the partial file'''
+		self.respond = lambda endpoint, parameters: (200, self._CONTENT)
+		url = self._GetBaseUrl() + '/stream/1'
+		self._WritePartial(url, 50000)
+		path = self._downloader.DownloadUrl(url)
+		self.assertEqual(self._CONTENT, self._Read(path))
+		stats = self._downloader.GetStats()
+		self.assertEqual(0, stats['bytes_resumed'])
+		self.assertEqual(len(self._CONTENT), stats['bytes_downloaded'])
+
+	def testSameContentIsStoredOnce(self):
+		'''Test that two urls with the same content share one stored file'''
+		self.respond = lambda endpoint, parameters: (200, self._CONTENT)
+		first = self._GetBaseUrl() + '/stream/1'
+		second = self._GetBaseUrl() + '/stream/2'
+		paths = self._downloader.Download([bandcamp.Track(streaming_url=first),
+										   bandcamp.Track(streaming_url=second)])
+		self.assertEqual(paths[first], paths[second])
+		self.assertEqual(self._CONTENT, self._Read(paths[first]))
+		stats = self._downloader.GetStats()
+		self.assertEqual(2, stats['files'])
+		self.assertEqual(1, stats['duplicates'])
+		self.assertEqual(len(self._CONTENT), stats['bytes_deduplicated'])
+
+	def testSecondRunIsServedFromStorage(self):
+		'''Test that a url already stored is not fetched again'''
+		self.respond = lambda endpoint, parameters: (200, self._CONTENT)
+		track = bandcamp.Track(streaming_url=self._GetBaseUrl() + '/stream/1')
+		first = self._downloader.Download(track)
+		downloader = bandcamp.MediaDownloader(self._media_directory)
+		self.assertEqual(first, downloader.Download(track))
+		self.assertEqual(1, len(self._GetRequests()))
+		stats = downloader.GetStats()
+		self.assertEqual(1, stats['cached'])
+		self.assertEqual(0, stats['files'])
+		self.assertEqual(0, stats['bytes_downloaded'])
+
+class CachePolicyTest(ApiTestCase):
+
+	def _Age(self, cache, endpoint, parameters, seconds):
+		path = cache._GetPath('%s/%s?%s' % (self._GetBaseUrl(), endpoint, parameters))
+		mtime = os.path.getmtime(path) - seconds
+		os.utime(path, (mtime, mtime))
+
+	def testEndpointTimeoutOverridesApiTimeout(self):
+		'''Test that an endpoint timeout is used in place of the Api's'''
+		self.respond = lambda endpoint, parameters: (200, _Album(int(parameters['album_id'])))
+		cache = bandcamp._FileCache(self._cache_directory)
+		api = self._NewApi(cache=cache)
+		api.SetCacheTimeout(3600)
+		api.SetCachePolicy(bandcamp.CachePolicy(endpoint_timeouts={'album/1/info': 60}))
+		api.GetAlbum(1)
+		api.GetAlbum(2)
+		self._Age(cache, 'album/1/info', 'album_id=1', 120)
+		self._Age(cache, 'album/1/info', 'album_id=2', 120)
+		api.GetAlbum(1)
+		api.GetAlbum(2)
+		self.assertEqual(['1', '2', '1', '2'],
+						 [x[1]['album_id'] for x in self._GetRequests()])
+
+	def testPolicyWithoutARuleFallsBackToApiTimeout(self):
+		'''Test that requests the policy has no timeout for use the Api's'''
+		api = self._NewApi()
+		api.SetCacheTimeout(3600)
+		policy = bandcamp.CachePolicy(endpoint_timeouts={'band/1/discography': 60})
+		api.SetCachePolicy(policy)
+		self.assertEqual(3600, api._GetCacheTimeout('album/1/info', {'album_id': 1}))
+		self.assertEqual(60, api._GetCacheTimeout('band/1/discography', {'band_id': 1}))
+
+	def testEntityTimeoutOverridesEndpointTimeout(self):
+		'''Test that a timeout for one entity beats its endpoint's'''
+		self.respond = lambda endpoint, parameters: (200, _Album(int(parameters['album_id'])))
+		cache = bandcamp._FileCache(self._cache_directory)
+		policy = bandcamp.CachePolicy(default_timeout=3600)
+		policy.SetEndpointTimeout('album/1/info', 600)
+		policy.SetEntityTimeout('album', 2, 60)
+		self.assertEqual(600, policy.GetTimeout('album/1/info', {'album_id': 1}))
+		self.assertEqual(60, policy.GetTimeout('album/1/info', {'album_id': '2'}))
+		self.assertEqual(60, policy.GetTimeout('album/1/info', {'album_id': 2}))
+		self.assertEqual(3600, policy.GetTimeout('track/1/info', {'track_id': 2}))
+		api = self._NewApi(cache=cache)
+		api.SetCachePolicy(policy)
+		api.GetAlbum(1)
+		api.GetAlbum(2)
+		self._Age(cache, 'album/1/info', 'album_id=1', 120)
+		self._Age(cache, 'album/1/info', 'album_id=2', 120)
+		api.GetAlbum(1)
+		api.GetAlbum(2)
+		self.assertEqual(['1', '2', '2'], [x[1]['album_id'] for x in self._GetRequests()])
+
+	def testJitterIsBoundedAndStable(self):
+		'''Test that jitter stays within the fraction and is fixed per request'''
+		policy = bandcamp.CachePolicy(default_timeout=1000, jitter=0.1)
+		timeouts = [policy.GetTimeout('album/1/info', {'album_id': i}) for i in range(500)]
+		for timeout in timeouts:
+			self.assertTrue(900 <= timeout <= 1100, timeout)
+		self.assertEqual(timeouts, [policy.GetTimeout('album/1/info', {'album_id': i})
+									for i in range(500)])
+		self.assertTrue(min(timeouts) < 950 and max(timeouts) > 1050)
+
+class CacheLockTest(ApiTestCase):
+
+	def testSharedStaleEntryIsFetchedOnce(self):
+		'''Test that Apis sharing a locking cache fetch a stale entry once'''
+		def Respond(endpoint, parameters):
+			time.sleep(0.2)
+			return 200, _Album(1)
+		self.respond = Respond
+		apis = [self._NewApi(cache=bandcamp._FileCache(self._cache_directory, locking=True))
+				for i in range(4)]
+		threads = [threading.Thread(target=api.GetAlbum, args=(1,)) for api in apis]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(1, len(self._GetRequests()))
+
+class BloomFilterTest(unittest.TestCase):
+
+	def testConcurrentAddsAreKept(self):
+		'''Test that keys added from many threads are all found'''
+		bloom_filter = bandcamp._BloomFilter(10000, 0.01)
+		def Add(worker):
+			for i in range(500):
+				bloom_filter.Add('key:%d:%d' % (worker, i))
+		threads = [threading.Thread(target=Add, args=(i,)) for i in range(8)]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		self.assertEqual([], ['key:%d:%d' % (worker, i) for worker in range(8)
+							  for i in range(500)
+							  if 'key:%d:%d' % (worker, i) not in bloom_filter])
+
+	def testMergeShard(self):
+		'''Test that a merged shard carries its keys over'''
+		first = bandcamp._BloomFilter(10000, 0.01)
+		second = bandcamp._BloomFilter(10000, 0.01)
+		shard = first.Add('missing:album:1')
+		second.Add('missing:album:2')
+		self.assertFalse('missing:album:1' in second)
+		second.MergeShard(shard, first.GetShardData(shard))
+		self.assertTrue('missing:album:1' in second)
+		self.assertTrue('missing:album:2' in second)
+
+class SnapshotTest(ApiTestCase):
+
+	def setUp(self):
+		ApiTestCase.setUp(self)
+		self._path = os.path.join(self._cache_directory, 'catalog.snapshot')
+
+	def testRecordedResponsesAreServedOffline(self):
+		'''Test that a recorded crawl is served from the snapshot alone'''
+		def Respond(endpoint, parameters):
+			if endpoint == 'band/1/info':
+				return 200, simplejson.dumps({'band_id': 1, 'name': 'Band',
+											  'subdomain': 'band',
+											  'url': 'http://band.bandcamp.com'})
+			return 200, _Album(int(parameters['album_id']))
+		self.respond = Respond
+		writer = bandcamp.SnapshotWriter(self._path)
+		api = self._NewApi()
+		api.SetRecorder(writer)
+		api.GetBand(band_url='band')
+		api.GetAlbum(1)
+		api.GetAlbum(2)
+		writer.Close()
+		requests = len(self._GetRequests())
+		offline = bandcamp.Api(snapshot=self._path, cache=None)
+		self.assertEqual('Album 1', offline.GetAlbum(1).title)
+		self.assertEqual('Album 2', offline.GetAlbum(2).title)
+		self.assertEqual('Band', offline.GetBand(band_url='http://band.bandcamp.com/').name)
+		self.assertEqual('Band', offline.GetBand(band_id=1).name)
+		self.assertEqual(requests, len(self._GetRequests()))
+
+	def testCacheIsIgnoredOffline(self):
+		'''Test that an offline Api neither reads nor writes its cache'''
+		self.respond = lambda endpoint, parameters: (404, 'Not Found')
+		cache = _CountingCache(self._cache_directory)
+		online = self._NewApi(cache=cache)
+		self.assertRaises(bandcamp.BandcampError, online.GetAlbum, 5)
+		writer = bandcamp.SnapshotWriter(self._path)
+		writer.Add('album/1/info', {'album_id': 5}, _Album(5))
+		writer.Add('band/1/info', {'band_url': 'band'}, simplejson.dumps(
+			{'band_id': 1, 'name': 'Band', 'subdomain': 'band'}))
+		writer.Close()
+		del cache.set_keys[:]
+		offline = bandcamp.Api(snapshot=self._path, cache=cache)
+		self.assertEqual('Album 5', offline.GetAlbum(5).title)
+		self.assertEqual('Band', offline.GetBand(band_url='band').name)
+		self.assertEqual([], cache.set_keys)
+		self.assertEqual(None, bandcamp.Api(snapshot=self._path)._cache)
+
+	def testMissingRequestIsAnError(self):
+		'''Test that a request missing from the snapshot raises BandcampError'''
+		writer = bandcamp.SnapshotWriter(self._path)
+		writer.Add('album/1/info', {'album_id': 1}, _Album(1))
+		writer.Close()
+		offline = bandcamp.Api(snapshot=self._path, cache=None)
+		self.assertRaises(bandcamp.BandcampError, offline.GetAlbum, 2)
+		self.assertRaises(bandcamp.BandcampError, offline.GetTrack, 1)
+		self.assertEqual([], self._GetRequests())
+
+	def testEmptySnapshot(self):
+		'''Test that a snapshot with no entries opens and finds nothing'''
+		bandcamp.SnapshotWriter(self._path).Close()
+		snapshot = bandcamp.Snapshot(self._path)
+		self.assertEqual(0, len(snapshot))
+		self.assertEqual(None, snapshot.Get('album/1/info', {'album_id': 1}))
+		self.assertEqual(None, snapshot.GetBandId('band.bandcamp.com'))
+		snapshot.Close()
+
+	def testEveryEntryIsFound(self):
+		'''Test that the sorted index finds each of many entries, compressed or not'''
+		for compression in (None, 'zlib'):
+			writer = bandcamp.SnapshotWriter(self._path, compression=compression)
+			for i in range(300):
+				writer.Add('album/1/info', {'album_id': i}, _Album(i, about='x' * 2000))
+			writer.Add('album/1/info', {'album_id': 0}, _Album(0, title='Replaced'))
+			writer.Close()
+			snapshot = bandcamp.Snapshot(self._path)
+			self.assertEqual(300, len(snapshot))
+			self.assertEqual(_Album(0, title='Replaced'),
+							 snapshot.Get('album/1/info', {'album_id': 0}))
+			for i in range(1, 300):
+				self.assertEqual(_Album(i, about='x' * 2000),
+								 snapshot.Get('album/1/info', {'album_id': i}))
+			self.assertEqual(None, snapshot.Get('album/1/info', {'album_id': 300}))
+			snapshot.Close()
+			if compression:
+				self.assertTrue(os.path.getsize(self._path) < 300 * 2000)
+
+class AdaptiveConcurrencyTest(ApiTestCase):
+
+	def testThrottlingBacksOff(self):
+		'''Test that a 429 response cuts the adaptive limit'''
+		self.respond = lambda endpoint, parameters: (429, 'Too Many Requests')
+		concurrency = bandcamp.AdaptiveConcurrency(initial=8)
+		api = self._NewApi()
+		api.SetAdaptiveConcurrency(concurrency)
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 1)
+		self.assertEqual(4, concurrency.GetLimit())
+		self.assertEqual('throttled', concurrency.GetHistory()[-1][2])
+
+	def testThrottledKeyRetryStillBacksOff(self):
+		'''Test that a 429 retried under another key still counts'''
+		def Respond(endpoint, parameters):
+			if parameters['key'] == 'a':
+				return 429, 'Too Many Requests'
+			return 200, _Album(1)
+		self.respond = Respond
+		concurrency = bandcamp.AdaptiveConcurrency(initial=8)
+		api = self._NewApi(bandcamp.KeyPool({'a': 100, 'b': 10}))
+		api.SetAdaptiveConcurrency(concurrency)
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+		self.assertEqual(4, concurrency.GetLimit())
+
+	def testSuccessesGrowTheLimit(self):
+		'''Test that a limit's worth of clean responses adds one'''
+		self.respond = lambda endpoint, parameters: (200, _Album(int(parameters['album_id'])))
+		concurrency = bandcamp.AdaptiveConcurrency(initial=2, latency_tolerance=1000)
+		api = self._NewApi()
+		api.SetAdaptiveConcurrency(concurrency)
+		api.GetAlbum(1)
+		api.GetAlbum(2)
+		self.assertEqual(3, concurrency.GetLimit())
+
+	def testBaselineFollowsLastingLatencyShift(self):
+		'''Test that the limit grows again once slower responses are the norm'''
+		concurrency = bandcamp.AdaptiveConcurrency(initial=4)
+		concurrency.Acquire()
+		concurrency.Release('ok', 0.05)
+		for i in range(500):
+			concurrency.Acquire()
+			concurrency.Release('ok', 0.15)
+		self.assertTrue(concurrency.GetLimit() > 4)
+		self.assertEqual('increase', concurrency.GetHistory()[-1][2])
+
+class RequestSchedulerTest(unittest.TestCase):
+
+	def _WaitFor(self, scheduler, predicate):
+		for i in range(200):
+			if predicate(scheduler.GetStats()):
+				return
+			time.sleep(0.01)
+		self.fail('Scheduler never reached %r' % scheduler.GetStats())
+
+	def _Start(self, scheduler, priority, name, order, hold=None):
+		def Run():
+			scheduler.Acquire(priority)
+			order.append(name)
+			if hold:
+				hold.wait(5)
+			scheduler.Release(priority)
+		thread = threading.Thread(target=Run)
+		thread.start()
+		return thread
+
+	def testInteractiveOvertakesBackgroundBacklog(self):
+		'''Test that an interactive request is served before queued background ones'''
+		scheduler = bandcamp.RequestScheduler(max_in_flight=1)
+		scheduler.Acquire(bandcamp.PRIORITY_BACKGROUND)
+		order = []
+		threads = [self._Start(scheduler, bandcamp.PRIORITY_BACKGROUND, 'background', order)
+				   for i in range(5)]
+		self._WaitFor(scheduler, lambda x: x['waiting'][bandcamp.PRIORITY_BACKGROUND] == 5)
+		threads.append(self._Start(scheduler, bandcamp.PRIORITY_INTERACTIVE, 'interactive', order))
+		self._WaitFor(scheduler, lambda x: x['waiting'][bandcamp.PRIORITY_INTERACTIVE] == 1)
+		scheduler.Release(bandcamp.PRIORITY_BACKGROUND)
+		for thread in threads:
+			thread.join()
+		self.assertEqual(['interactive'] + ['background'] * 5, order)
+
+	def testBackgroundHoldsAtMostItsShare(self):
+		'''Test that background requests leave slots free for interactive ones'''
+		scheduler = bandcamp.RequestScheduler(max_in_flight=4, background_share=0.5)
+		order = []
+		hold = threading.Event()
+		threads = [self._Start(scheduler, bandcamp.PRIORITY_BACKGROUND, 'background', order, hold)
+				   for i in range(4)]
+		try:
+			self._WaitFor(scheduler, lambda x: x['waiting'][bandcamp.PRIORITY_BACKGROUND] == 2)
+			time.sleep(0.05)
+			stats = scheduler.GetStats()
+			self.assertEqual(2, stats['in_flight'][bandcamp.PRIORITY_BACKGROUND])
+			self.assertEqual(2, stats['waiting'][bandcamp.PRIORITY_BACKGROUND])
+			scheduler.Acquire(bandcamp.PRIORITY_INTERACTIVE, bandcamp.Deadline(1))
+			scheduler.Release(bandcamp.PRIORITY_INTERACTIVE)
+		finally:
+			hold.set()
+			for thread in threads:
+				thread.join()
+		self.assertEqual(4, len(order))
+
+	def testDeadlineExpiresWhileQueued(self):
+		'''Test that a queued request times out and leaves the queue'''
+		scheduler = bandcamp.RequestScheduler(max_in_flight=1)
+		scheduler.Acquire(bandcamp.PRIORITY_NORMAL)
+		self.assertRaises(bandcamp.BandcampTimeoutError, scheduler.Acquire,
+						  bandcamp.PRIORITY_NORMAL, bandcamp.Deadline(0.1))
+		stats = scheduler.GetStats()
+		self.assertEqual(0, sum(stats['waiting'].values()))
+		self.assertEqual(1, sum(stats['in_flight'].values()))
+
+	def testRateIsEnforced(self):
+		'''Test that requests start no faster than the rate allows'''
+		scheduler = bandcamp.RequestScheduler(max_in_flight=10, rate=20)
+		start = time.time()
+		for i in range(6):
+			scheduler.Acquire(bandcamp.PRIORITY_NORMAL)
+			scheduler.Release(bandcamp.PRIORITY_NORMAL)
+		self.assertTrue(time.time() - start >= 0.24)
+
+class GzipTest(ApiTestCase):
+
+	def testGzipResponseIsStreamedIntoTheCache(self):
+		'''Test that a gzipped body is asked for, decompressed in chunks and cached plain'''
+		body = _Album(1, tracks=[{'track_id': i, 'title': 'Track %d' % i}
+								 for i in range(2000)])
+		compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+		compressed = compressor.compress(body) + compressor.flush()
+		self.respond = lambda endpoint, parameters: (
+			200, compressed, {'Content-Encoding': 'gzip'})
+		cache = bandcamp._FileCache(self._cache_directory)
+		api = self._NewApi(cache=cache)
+		api._READ_CHUNK_SIZE = 1024
+		self.assertEqual(2000, len(api.GetAlbum(1).tracks))
+		self.assertTrue('gzip' in self._server.request_headers[0].get('Accept-Encoding'))
+		self.assertEqual(body, cache.Get('%s/album/1/info?album_id=1' % self._GetBaseUrl()))
+		self.assertEqual(2000, len(api.GetAlbum(1).tracks))
+		self.assertEqual(1, len(self._GetRequests()))
+
+class TimeoutTest(ApiTestCase):
+
+	def testConnectTimeoutLeavesBodyReadsAlone(self):
+		'''Test that a slow body is waited for without a read timeout'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1), {}, 0.3)
+		api = self._NewApi()
+		api.SetTimeout(connect_timeout=0.1)
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+
+	def testReadTimeoutBoundsBodyReads(self):
+		'''Test that a slow body times out under a read timeout'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1), {}, 0.3)
+		api = self._NewApi()
+		api.SetTimeout(connect_timeout=1, read_timeout=0.1)
+		self.assertRaises(bandcamp.BandcampTimeoutError, api.GetAlbum, 1)
+
+class KeyPoolTest(ApiTestCase):
+
+	def testThrottledKeyIsRotatedOut(self):
+		'''Test that a 429 cools the key down and retries under another'''
+		def Respond(endpoint, parameters):
+			if parameters['key'] == 'a':
+				return 429, 'Too Many Requests', {'Retry-After': '120'}
+			return 200, _Album(int(parameters['album_id']))
+		self.respond = Respond
+		pool = bandcamp.KeyPool({'a': 100, 'b': 10})
+		api = self._NewApi(pool)
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+		self.assertEqual(['a', 'b'], [x[1]['key'] for x in self._GetRequests()])
+		stats = pool.GetStats()
+		self.assertEqual(1, stats['a']['throttles'])
+		self.assertTrue(stats['a']['cooling'] > 60)
+		self.assertEqual('Album 2', api.GetAlbum(2).title)
+		self.assertEqual('b', self._GetRequests()[-1][1]['key'])
+
+	def testPoolCanBeDropped(self):
+		'''Test that an Api built with a pool still fetches after SetKeyPool(None)'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1))
+		api = self._NewApi(bandcamp.KeyPool({'a': 100}))
+		api.SetKeyPool(None)
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+		self.assertFalse('key' in self._GetRequests()[-1][1])
+
+	def testCacheIsSharedByKeys(self):
+		'''Test that the developer key is not part of the cache key'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1))
+		self._NewApi('a').GetAlbum(1)
+		self._NewApi('b').GetAlbum(1)
+		self.assertEqual(1, len(self._GetRequests()))
+
+class IdentityMapTest(ApiTestCase):
+
+	def testOnlyStringsAreInterned(self):
+		'''Test that a true field never replaces an equal id'''
+		def Respond(endpoint, parameters):
+			if endpoint == 'album/1/info':
+				return 200, _Album(5, downloadable=True, artist='Artist')
+			return 200, simplejson.dumps({'track_id': 11, 'album_id': 5, 'band_id': 1,
+										  'downloadable': 1})
+		self.respond = Respond
+		api = self._NewApi()
+		api.SetIdentityMap()
+		album = api.GetAlbum(5)
+		track = api.GetTrack(11)
+		self.assertTrue(track.band_id is not True)
+		self.assertTrue('"band_id": 1' in track.AsJsonString())
+		self.assertTrue(album.downloadable is True)
+		self.assertTrue(api.GetAlbum(5).artist is album.artist)
+
+	def testIdsAreInternedByType(self):
+		'''Test that equal ids from different responses share one object'''
+		self.respond = lambda endpoint, parameters: (200, simplejson.dumps(
+			{'track_id': int(parameters['track_id']), 'album_id': 5,
+			 'band_id': 123456789}))
+		api = self._NewApi()
+		api.SetIdentityMap()
+		first = api.GetTrack(11)
+		second = api.GetTrack(12)
+		self.assertTrue(first.band_id is second.band_id)
+
+	def testPoolKeepsRecentValues(self):
+		'''Test that the pool is bounded, evicting the least recently used values'''
+		identity_map = bandcamp._IdentityMap()
+		artist = u''.join([u'Art', u'ist'])
+		identity_map.Merge(bandcamp.Album(artist=artist))
+		for i in range(bandcamp._IdentityMap.MAX_INTERNED + 10):
+			identity_map.Merge(bandcamp.Album(artist=u'Artist %d' % i))
+			if i % 1000 == 0:
+				identity_map.Merge(bandcamp.Album(artist=u''.join([u'Art', u'ist'])))
+		self.assertEqual(bandcamp._IdentityMap.MAX_INTERNED, len(identity_map._values))
+		copy = u''.join([u'Art', u'ist'])
+		self.assertTrue(identity_map.Merge(bandcamp.Album(artist=copy)).artist is artist)
+		self.assertFalse((unicode, u'Artist 1') in identity_map._values)
+
+	def testRefetchReturnsTheSameInstance(self):
+		'''Test that a refetched entity is the live instance, updated in place'''
+		titles = ['Before', 'After']
+		self.respond = lambda endpoint, parameters: (200, _Album(1, title=titles[0]))
+		api = self._NewApi(cache=None)
+		api.SetIdentityMap()
+		album = api.GetAlbum(1)
+		self.assertEqual('Before', album.title)
+		titles.pop(0)
+		self.assertTrue(api.GetAlbum(1) is album)
+		self.assertEqual('After', album.title)
+
+class FieldsTest(ApiTestCase):
+
+	def testFieldsOutsideProjectionAreNeverSet(self):
+		'''Test that properties left out of fields read None and take no space'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1, about='About'))
+		album = self._NewApi().GetAlbum(1, fields=('id', 'title'))
+		self.assertEqual(1, album.id)
+		self.assertEqual('Album 1', album.title)
+		self.assertEqual(None, album.about)
+		self.assertEqual(None, album.band_id)
+		self.assertEqual(set(['_id', '_title']), set(album.__dict__))
+
+	def testTracksGetTheSameProjection(self):
+		'''Test that an album's tracks are built with the album's fields'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1, tracks=[
+			{'track_id': 7, 'title': 'Track 7', 'duration': 180.5, 'lyrics': 'La'}]))
+		album = self._NewApi().GetAlbum(1, fields=('id', 'title', 'duration', 'tracks'))
+		track, = album.tracks
+		self.assertEqual(7, track.id)
+		self.assertEqual('Track 7', track.title)
+		self.assertEqual(180.5, track.duration)
+		self.assertEqual(None, track.lyrics)
+		self.assertEqual(set(['_id', '_title', '_duration']), set(track.__dict__))
+
+	def testUnknownFieldsAreRejected(self):
+		'''Test that a field no model has raises before any request'''
+		api = self._NewApi()
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 1, fields=('id', 'colour'))
+		self.assertRaises(bandcamp.BandcampError, api.GetBand, band_id=1, fields=('title',))
+		self.assertEqual([], self._GetRequests())
+
+	def testProjectedBandStillTeachesResolution(self):
+		'''Test that GetBand by url with fields still records the url's band id'''
+		self.respond = lambda endpoint, parameters: (200, simplejson.dumps(
+			{'band_id': 42, 'name': 'Band', 'subdomain': 'band',
+			 'url': 'http://band.bandcamp.com'}))
+		api = self._NewApi()
+		band = api.GetBand(band_url='http://band.bandcamp.com', fields=('name',))
+		self.assertEqual('Band', band.name)
+		self.assertEqual(None, band.id)
+		self.assertEqual(42, api.ResolveBandId(band_url='http://band.bandcamp.com'))
+		self.assertEqual(42, api.ResolveBandId(band_subdomain='band'))
+
+class PrefetchTest(ApiTestCase):
+
+	def testAlbumIsPrefetchedOnce(self):
+		'''Test that an album listed twice in a discography is prefetched once'''
+		def Respond(endpoint, parameters):
+			if endpoint == 'band/1/discography':
+				return 200, simplejson.dumps({'discography': [
+					{'album_id': 1, 'band_id': 1, 'title': 'Album 1'},
+					{'track_id': 11, 'album_id': 1, 'band_id': 1, 'title': 'Track 11'}]})
+			time.sleep(0.2)
+			return 200, _Album(1)
+		self.respond = Respond
+		api = self._NewApi()
+		api.SetPrefetchPolicy(bandcamp.PrefetchPolicy(max_workers=2, rate=2))
+		api.GetDiscography(band_id=1)
+		self.assertEqual('Album 1', api.GetAlbum(1, deadline=5).title)
+		self.assertEqual(1, len(self._GetRequests('album/1/info')))
+		self.assertEqual(1, api.GetPrefetchStats()['submitted'])
+
+class GatewayTest(ApiTestCase):
+
+	def setUp(self):
+		ApiTestCase.setUp(self)
+		self._upstream = self._NewApi()
+		self._gateway = bandcamp.Gateway(self._upstream, port=0)
+		self._gateway.Start()
+
+	def tearDown(self):
+		self._gateway.Shutdown()
+		ApiTestCase.tearDown(self)
+
+	def _NewClient(self):
+		return bandcamp.Api('unused', cache=bandcamp._FileCache(tempfile.mkdtemp(
+								dir=self._cache_directory)),
+							base_url='http://%s:%d' % self._gateway.GetAddress())
+
+	def testUpstreamTimeoutIsNotMissing(self):
+		'''Test that a client recovers once a timed out upstream does'''
+		delays = [0.5]
+		def Respond(endpoint, parameters):
+			if delays:
+				time.sleep(delays.pop())
+			return 200, _Album(1)
+		self.respond = Respond
+		self._upstream.SetTimeout(connect_timeout=0.1, read_timeout=0.1)
+		client = self._NewClient()
+		self.assertRaises(bandcamp.BandcampError, client.GetAlbum, 1)
+		self.assertFalse(client.IsKnownMissing('album', 1))
+		self.assertEqual('Album 1', client.GetAlbum(1).title)
+
+	def testMissingIdIsMissingForClients(self):
+		'''Test that a missing id reaches clients as a Bandcamp error'''
+		self.respond = lambda endpoint, parameters: (404, 'Not Found')
+		client = self._NewClient()
+		self.assertRaises(bandcamp.BandcampError, client.GetAlbum, 1)
+		self.assertTrue(client.IsKnownMissing('album', 1))
+
+	def testBandUrlAndIdShareOneFetch(self):
+		'''Test that a band asked for by url and then by id is fetched once'''
+		self.respond = lambda endpoint, parameters: (200, simplejson.dumps(
+			{'band_id': 1, 'name': 'Band', 'subdomain': 'band',
+			 'url': 'http://band.bandcamp.com'}))
+		self.assertEqual('Band', self._NewClient().GetBand(band_url='band').name)
+		self.assertEqual('Band', self._NewClient().GetBand(band_id=1).name)
+		self.assertEqual(1, len(self._GetRequests('band/1/info')))
+
+	def _Request(self, method, path, body=None):
+		connection = httplib.HTTPConnection(*self._gateway.GetAddress())
+		try:
+			connection.request(method, path, body)
+			response = connection.getresponse()
+			return response.status, simplejson.loads(response.read())
+		finally:
+			connection.close()
+
+	def testMissingParametersAreBadRequests(self):
+		'''Test that a request without an id is answered with a 400'''
+		for path in ('/band/1/info', '/band/1/discography?band_url=',
+					 '/album/1/info', '/track/1/info?album_id=1'):
+			status, data = self._Request('GET', path)
+			self.assertEqual(400, status)
+			self.assertTrue('gateway_error' in data)
+		self.assertEqual([], self._GetRequests())
+
+	def testMalformedBatchIsBadRequest(self):
+		'''Test that a batch of anything but paths is answered with a 400'''
+		status, data = self._Request('POST', '/batch', '[1]')
+		self.assertEqual(400, status)
+		self.assertTrue('gateway_error' in data)
+		self.assertEqual('gateway_error', self._gateway.HandleBatch([None])[0].keys()[0])
+
+class RequestPlanTest(ApiTestCase):
+
+	def testConnectionErrorsAreRecordedPerStep(self):
+		'''Test that an unreachable server gives each covered entity its error'''
+		listener = socket.socket()
+		listener.bind(('127.0.0.1', 0))
+		base_url = 'http://%s:%d' % listener.getsockname()
+		listener.close()
+		plan = self._NewApi(base_url=base_url).Plan(band_ids=[1], album_ids=[2],
+													track_ids=[3])
+		results = plan.Execute()
+		self.assertEqual([('album', 2), ('band', 1), ('track', 3)], sorted(results))
+		for error in results.values():
+			self.assertTrue(isinstance(error, bandcamp.BandcampError))
+
+	def testTracksFoldIntoRequestedAlbum(self):
+		'''Test that tracks of a requested album are read from its response'''
+		self.respond = lambda endpoint, parameters: (200, _Album(
+			1, tracks=[{'track_id': 11, 'title': 'Track 11'},
+					   {'track_id': 12, 'title': 'Track 12'}]))
+		api = self._NewApi()
+		api.SetRelationTracking()
+		api.GetAlbum(1)
+		api.Invalidate('album', 1)
+		plan = api.Plan(album_ids=[1], track_ids=[11, 12])
+		self.assertEqual(1, plan.GetUpstreamCalls())
+		results = plan.Execute()
+		self.assertEqual('Track 12', results[('track', 12)].title)
+		self.assertEqual(1, results[('track', 12)].album_id)
+		self.assertEqual(2, len(self._GetRequests()))
+
+class _CountingCache(bandcamp._FileCache):
+	'''A _FileCache that remembers the keys it was asked to Set.'''
+
+	def __init__(self, *args, **kwargs):
+		bandcamp._FileCache.__init__(self, *args, **kwargs)
+		self.set_keys = []
+
+	def Set(self, key, data):
+		self.set_keys.append(key)
+		bandcamp._FileCache.Set(self, key, data)
+
+class InvalidationTest(ApiTestCase):
+
+	def setUp(self):
+		ApiTestCase.setUp(self)
+		self.albums = {1: _Album(1, tracks=[{'track_id': 11, 'title': 'Track 11'},
+											{'track_id': 12, 'title': 'Track 12'}])}
+		self.respond = self._Respond
+
+	def _Respond(self, endpoint, parameters):
+		if endpoint == 'band/1/discography':
+			return 200, simplejson.dumps({'discography': [
+				{'album_id': 1, 'band_id': 1, 'title': 'Album 1'},
+				{'album_id': 2, 'band_id': 1, 'title': 'Album 2'},
+				{'track_id': 21, 'album_id': 2, 'band_id': 1, 'title': 'Track 21'}]})
+		if endpoint == 'album/1/info':
+			return 200, self.albums[int(parameters['album_id'])]
+		track_id = int(parameters['track_id'])
+		return 200, simplejson.dumps({'track_id': track_id, 'album_id': track_id // 10,
+									  'band_id': 1, 'title': 'Track %d' % track_id})
+
+	def testInvalidateDropsDependents(self):
+		'''Test that invalidating an album drops its tracks and its band's discography'''
+		api = self._NewApi()
+		api.SetRelationTracking()
+		api.GetDiscography(band_id=1)
+		api.GetAlbum(1)
+		api.GetTrack(11)
+		self.assertEqual(['album/1/info?album_id=1',
+						  'band/1/discography?band_id=1',
+						  'track/1/info?track_id=11',
+						  'track/1/info?track_id=12'],
+						 api.Invalidate('album', 1))
+		api.GetTrack(11)
+		api.GetDiscography(band_id=1)
+		self.assertEqual(2, len(self._GetRequests('track/1/info')))
+		self.assertEqual(2, len(self._GetRequests('band/1/discography')))
+
+	def testInvalidateWithoutDependents(self):
+		'''Test that dependents=False only drops the entity itself'''
+		api = self._NewApi()
+		api.SetRelationTracking()
+		api.GetAlbum(1)
+		api.GetTrack(11)
+		self.assertEqual(['album/1/info?album_id=1'],
+						 api.Invalidate('album', 1, dependents=False))
+		api.GetTrack(11)
+		self.assertEqual(1, len(self._GetRequests('track/1/info')))
+
+	def testChangedAlbumCascades(self):
+		'''Test that a changed album response drops its cached tracks'''
+		api = self._NewApi()
+		api.SetCascadingInvalidation()
+		api.GetAlbum(1)
+		api.GetTrack(11)
+		api.GetTrack(12)
+		api.Invalidate('album', 1, dependents=False)
+		api.GetAlbum(1)
+		api.GetTrack(11)
+		self.assertEqual(2, len(self._GetRequests('track/1/info')))
+		self.albums[1] = _Album(1, title='Renamed', tracks=[{'track_id': 11}])
+		api.Invalidate('album', 1, dependents=False)
+		self.assertEqual('Renamed', api.GetAlbum(1).title)
+		api.GetTrack(11)
+		api.GetTrack(12)
+		self.assertEqual(4, len(self._GetRequests('track/1/info')))
+
+	def testChangeIsSeenAcrossApis(self):
+		'''Test that the last digest is kept in the cache, not the Api'''
+		api = self._NewApi()
+		api.SetCascadingInvalidation()
+		api.GetAlbum(1)
+		api.GetTrack(11)
+		self.albums[1] = _Album(1, title='Renamed', tracks=[{'track_id': 11}])
+		other = self._NewApi()
+		other.SetCascadingInvalidation()
+		other.Invalidate('album', 1, dependents=False)
+		self.assertEqual('Renamed', other.GetAlbum(1).title)
+		api.GetTrack(11)
+		self.assertEqual(2, len(self._GetRequests('track/1/info')))
+
+	def testCascadeRefreshesDependents(self):
+		'''Test that refresh=True fetches the dropped responses again'''
+		api = self._NewApi()
+		api.SetCascadingInvalidation(refresh=True)
+		api.GetAlbum(1)
+		api.GetTrack(11)
+		self.albums[1] = _Album(1, title='Renamed', tracks=[{'track_id': 11}])
+		api.Invalidate('album', 1, dependents=False)
+		api.GetAlbum(1)
+		# Both tracks the album held before it changed are refetched
+		self.assertEqual(3, len(self._GetRequests('track/1/info')))
+		api.GetTrack(11)
+		self.assertEqual(3, len(self._GetRequests('track/1/info')))
+
+	def testRelationsAreOffByDefault(self):
+		'''Test that no relations are written to the cache unless asked for'''
+		cache = _CountingCache(self._cache_directory)
+		api = self._NewApi(cache=cache)
+		api.GetDiscography(band_id=1)
+		api.GetAlbum(1)
+		self.assertEqual([], [x for x in cache.set_keys if x.startswith('related:')])
+		self.assertEqual(['album/1/info?album_id=1'], api.Invalidate('album', 1))
+
+	def testRelationsAreWrittenOncePerResponse(self):
+		'''Test that each related entity is written once for a discography'''
+		cache = _CountingCache(self._cache_directory)
+		api = self._NewApi(cache=cache)
+		api.SetRelationTracking()
+		api.GetDiscography(band_id=1)
+		self.assertEqual(['related:album:1', 'related:album:2', 'related:band:1',
+						  'related:track:21'],
+						 sorted([x for x in cache.set_keys if x.startswith('related:')]))
+		del cache.set_keys[:]
+		api.GetDiscography(band_id=1)
+		self.assertEqual([], [x for x in cache.set_keys if x.startswith('related:')])
+
+class MiddlewareTest(ApiTestCase):
+
+	def testRetryMiddlewareRetriesThrottling(self):
+		'''Test that a 429 is retried, and gives up after retries'''
+		self.respond = lambda endpoint, parameters: (429, 'Too Many Requests')
+		api = self._NewApi()
+		api.SetMiddleware(network_middleware=[bandcamp.RetryMiddleware(retries=2, backoff=0.01)])
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 1)
+		self.assertEqual(3, len(self._GetRequests()))
+
+	def testRetryMiddlewareRecovers(self):
+		'''Test that a retried 503 can still succeed, and is cached'''
+		responses = [(503, 'Service Unavailable'), (200, _Album(1))]
+		self.respond = lambda endpoint, parameters: responses.pop(0)
+		api = self._NewApi()
+		api.SetMiddleware(network_middleware=[bandcamp.RetryMiddleware(retries=2, backoff=0.01)])
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+		self.assertEqual('Album 1', api.GetAlbum(1).title)
+		self.assertEqual(2, len(self._GetRequests()))
+
+	def testRetryMiddlewareSkipsNotFound(self):
+		'''Test that a 404 is not retried'''
+		self.respond = lambda endpoint, parameters: (404, 'Not Found')
+		api = self._NewApi()
+		api.SetMiddleware(network_middleware=[bandcamp.RetryMiddleware(retries=2, backoff=0.01)])
+		self.assertRaises(bandcamp.BandcampError, api.GetAlbum, 1)
+		self.assertEqual(1, len(self._GetRequests()))
+
+	def testMetricsMiddlewareCountsCacheHits(self):
+		'''Test that middleware before the cache sees every fetch'''
+		self.respond = lambda endpoint, parameters: (200, _Album(1))
+		metrics = bandcamp.MetricsMiddleware()
+		api = self._NewApi()
+		api.SetMiddleware([metrics])
+		api.GetAlbum(1)
+		api.GetAlbum(1)
+		stats = metrics.GetStats()
+		self.assertEqual(2, stats['requests'])
+		self.assertEqual(1, stats['cache_hits'])
+
+if __name__ == '__main__':
+	unittest.main()